@@ -26,152 +26,2344 @@ import socket
 import re
 import time
 import datetime
-import select
-
-try:
-    import elasticsearch
-except ModuleNotFoundError:
-    print("ERROR: elasticsearch library not found, please install by typing 'pip3 install elasticsearch'")
-    sys.exit(1)
+import selectors
+import heapq
+import bisect
+import array
+import math
+import errno
+import random
+import functools
+import http.server
+import collections
+import queue
+import threading
+import multiprocessing
+import importlib
+import json
+import signal
+import configparser
+import urllib.request
+import concurrent.futures
+import urllib.parse
+import urllib.error
+import gzip
+import zlib
 
 try:
     import serial
 except ModuleNotFoundError:
-    print("ERROR: pyserial library not found, please install by typing 'pip3 install pyserial'")
-    sys.exit(1)
+    # only needed for serial inputs
+    serial = None
 
 __version__ = '0.0.1'
 
-"""
-#TODO: conversion names
-convert_map = {
-    "0-0:96.1.1.255": "electricity.identifier",
-    "1-0:1.8.(\d+).255": "electricity.meter_reading.to_client.tarrif.{}",
-    "1-0:2.8.(\d+).255": "electricity.meter_reading.by_client.tarrif.{}",
+DSMR_TIMEZONES = {
+    'W': datetime.timezone(datetime.timedelta(hours=1)),
+    'S': datetime.timezone(datetime.timedelta(hours=2)),
 }
 
-# text, keyword, boolean, long, double, histogram, ip, date,
-elastic_template = {
-    "index_patterns": ["test-*"],
-    "settings": {},
-    "mappings": {
-        "dsmr": {
-            "timestamp": {"type": "date"},
-            "electricity.identifier": {"type": "keyword"},  # 0-0:96.1.1.255
-            "electricity.meter_reading.to_client.tarrif.1": {"type": "float"},  # 1-0:1.8.1.255
-            "electricity.meter_reading.to_client.tarrif.2": {"type": "float"},  # 1-0:1.8.2.255
-            "electricity.meter_reading.to_client.tarrif.3": {"type": "float"},  # 1-0:1.8.3.255
-            "electricity.meter_reading.to_client.tarrif.4": {"type": "float"},  # 1-0:1.8.4.255
-            "electricity.meter_reading.to_client.tarrif.5": {"type": "float"},  # 1-0:1.8.5.255
-            "electricity.meter_reading.to_client.tarrif.6": {"type": "float"},  # 1-0:1.8.6.255
-            "electricity.meter_reading.to_client.tarrif.7": {"type": "float"},  # 1-0:1.8.7.255
-            "electricity.meter_reading.to_client.tarrif.8": {"type": "float"},  # 1-0:1.8.8.255
-            "electricity.meter_reading.to_client.tarrif.9": {"type": "float"},  # 1-0:1.8.9.255
-            "electricity.meter_reading.to_client.tarrif.10": {"type": "float"},  # 1-0:1.8.10.255
-            "electricity.meter_reading.to_client.tarrif.11": {"type": "float"},  # 1-0:1.8.11.255
-            "electricity.meter_reading.to_client.tarrif.12": {"type": "float"},  # 1-0:1.8.12.255
-            "electricity.meter_reading.to_client.tarrif.13": {"type": "float"},  # 1-0:1.8.13.255
-            "electricity.meter_reading.to_client.tarrif.14": {"type": "float"},  # 1-0:1.8.14.255
-            "electricity.meter_reading.to_client.tarrif.15": {"type": "float"},  # 1-0:1.8.15.255
-            "electricity.meter_reading.to_client.tarrif.16": {"type": "float"},  # 1-0:1.8.16.255
-            "electricity.meter_reading.by_client.tarrif.1": {"type": "float"},  # 1-0:2.8.1.255
-            "electricity.meter_reading.by_client.tarrif.2": {"type": "float"},  # 1-0:2.8.2.255
-            "electricity.meter_reading.by_client.tarrif.3": {"type": "float"},  # 1-0:2.8.3.255
-            "electricity.meter_reading.by_client.tarrif.4": {"type": "float"},  # 1-0:2.8.4.255
-            "electricity.meter_reading.by_client.tarrif.5": {"type": "float"},  # 1-0:2.8.5.255
-            "electricity.meter_reading.by_client.tarrif.6": {"type": "float"},  # 1-0:2.8.6.255
-            "electricity.meter_reading.by_client.tarrif.7": {"type": "float"},  # 1-0:2.8.7.255
-            "electricity.meter_reading.by_client.tarrif.8": {"type": "float"},  # 1-0:2.8.8.255
-            "electricity.meter_reading.by_client.tarrif.9": {"type": "float"},  # 1-0:2.8.9.255
-            "electricity.meter_reading.by_client.tarrif.10": {"type": "float"},  # 1-0:2.8.10.255
-            "electricity.meter_reading.by_client.tarrif.11": {"type": "float"},  # 1-0:2.8.11.255
-            "electricity.meter_reading.by_client.tarrif.12": {"type": "float"},  # 1-0:2.8.12.255
-            "electricity.meter_reading.by_client.tarrif.13": {"type": "float"},  # 1-0:2.8.13.255
-            "electricity.meter_reading.by_client.tarrif.14": {"type": "float"},  # 1-0:2.8.14.255
-            "electricity.meter_reading.by_client.tarrif.15": {"type": "float"},  # 1-0:2.8.15.255
-            "electricity.meter_reading.by_client.tarrif.16": {"type": "float"},  # 1-0:2.8.16.255
-            "electricity.tarrif.indicator": {"type": "text"},  # 0-0:96.14.0.255
-            "electricity.voltage.sags.l1": {"type": "long"},  # 1-0:32.32.0.255
-            "electricity.voltage.sags.l2": {"type": "long"},  # 1-0:52.32.0.255
-            "electricity.voltage.sags.l3": {"type": "long"},  # 1-0:72.32.0.255
-            "electricity.voltage.swells.l1": {"type": "long"},  # 1-0:32.36.0.255
-            "electricity.voltage.swells.l2": {"type": "long"},  # 1-0:52.36.0.255
-            "electricity.voltage.swells.l3": {"type": "long"},  # 1-0:72.36.0.255
-            "electricity.voltage.l1": {"type": "float"},  # 1-0:32.7.0.255
-            "electricity.voltage.l2": {"type": "float"},  # 1-0:52.7.0.255
-            "electricity.voltage.l3   ": {"type": "float"},  # 1-0:72.7.0.255
-            "electricity.current.l1   ": {"type": "float"},  # 1-0:31.7.0.255
-            "electricity.current.l2   ": {"type": "float"},  # 1-0:51.7.0.255
-            "electricity.current.l3   ": {"type": "float"},  # 1-0:71.7.0.255
-            "electricity.power.to_client.l1   ": {"type": "float"},  # 1-0:21.7.0.255
-            "electricity.power.to_client.l2   ": {"type": "float"},  # 1-0:41.7.0.255
-            "electricity.power.to_client.l3   ": {"type": "float"},  # 1-0:61.7.0.255
-            "electricity.power.by_client.l1   ": {"type": "float"},  # 1-0:22.7.0.255
-            "electricity.power.by_client.l2   ": {"type": "float"},  # 1-0:42.7.0.255
-            "electricity.power.by_client.l3   ": {"type": "float"},  # 1-0:62.7.0.255
-            "electricity.power.failures.any_fase": {"type": "long"},  # 0-0:96.7.21.255
-            "electricity.power.failures.long.any_fase": {"type": "long"},  # 0-0:96.7. 9.255
-            "electricity.power.failures.log": {"type": "text"},  # 1-0:99:97.0.255
-            "electricity.power.to_client.total": {"type": "long"},  # 1-0:1.7.0.255
-            "electricity.power.by_client.total": {"type": "long"},  # 1-0:2.7.0.255
-            "electricity.breaker.state": {"type": "keyword"},  # 0-0:96.3.10.255
-        }
-    }
+
+@functools.lru_cache(maxsize=256)
+def parse_dsmr_timestamp(value):
+    """ YYMMDDhhmmssX, X is W for winter time (UTC+1) and S for summer time (UTC+2) """
+    return datetime.datetime(2000 + int(value[0:2]), int(value[2:4]), int(value[4:6]),
+                             int(value[6:8]), int(value[8:10]), int(value[10:12]),
+                             tzinfo=DSMR_TIMEZONES[value[12]])
+
+
+def obis_float(doc, key, groups):
+    doc[key] = float(groups[0].split('*', 1)[0])
+
+
+def obis_int(doc, key, groups):
+    doc[key] = int(groups[0].split('*', 1)[0])
+
+
+def obis_string(doc, key, groups):
+    doc[key] = groups[0]
+
+
+def obis_timestamp(doc, key, groups):
+    doc[key] = parse_dsmr_timestamp(groups[0])
+
+
+def obis_timestamped_float(doc, key, groups):
+    """ (timestamp)(value*unit), used by m-bus readings (gas, water) and maximum demand """
+    doc[key] = float(groups[1].split('*', 1)[0])
+    doc[key + "_timestamp"] = parse_dsmr_timestamp(groups[0])
+
+
+def obis_power_failure_log(doc, key, groups):
+    """
+    (count)(0-0:96.7.19)(end timestamp)(duration*s)...
+
+    key keeps the log as a string, the shape older versions sent (indices created by them map it as text), the
+    decoded events are in key_events
+    """
+    events = []
+    for i in range(2, 2 + 2 * int(groups[0]), 2):
+        events.append({"end": parse_dsmr_timestamp(groups[i]), "duration": int(groups[i + 1].split('*', 1)[0])})
+    doc[key] = ")(".join(groups)
+    doc[key + "_events"] = events
+
+
+def obis_generic(doc, key, groups):
+    """ fallback for unknown codes: the last group as float if possible, otherwise as string """
+    value = groups[-1].split('*', 1)[0]
+    try:
+        doc[key] = float(value)
+    except ValueError:
+        doc[key] = value
+
+
+# kind is 'counter' for cumulative registers, 'gauge' for instantaneous values and None for other values
+ObisCode = collections.namedtuple('ObisCode', ['name', 'convert', 'unit', 'kind'])
+
+OBIS_CODES = {
+    "1-3:0.2.8": ObisCode("version", obis_string, None, None),
+    "0-0:96.1.4": ObisCode("version.belgium", obis_string, None, None),
+    "0-0:1.0.0": ObisCode("timestamp", obis_timestamp, None, None),
+    "0-0:96.1.1": ObisCode("electricity.identifier", obis_string, None, None),
+    "1-0:1.8.0": ObisCode("electricity.meter_reading.to_client.total", obis_float, "kWh", "counter"),
+    "1-0:2.8.0": ObisCode("electricity.meter_reading.by_client.total", obis_float, "kWh", "counter"),
+    "0-0:96.14.0": ObisCode("electricity.tariff.indicator", obis_string, None, None),
+    "1-0:1.7.0": ObisCode("electricity.power.to_client.total", obis_float, "kW", "gauge"),
+    "1-0:2.7.0": ObisCode("electricity.power.by_client.total", obis_float, "kW", "gauge"),
+    "0-0:96.7.21": ObisCode("electricity.power.failures.any_phase", obis_int, None, "counter"),
+    "0-0:96.7.9": ObisCode("electricity.power.failures.long.any_phase", obis_int, None, "counter"),
+    "1-0:99.97.0": ObisCode("electricity.power.failures.log", obis_power_failure_log, None, None),
+    "0-0:96.13.0": ObisCode("electricity.message.text", obis_string, None, None),
+    "0-0:96.13.1": ObisCode("electricity.message.code", obis_string, None, None),
+    "0-0:96.3.10": ObisCode("electricity.breaker.state", obis_int, None, "gauge"),
+    "0-0:17.0.0": ObisCode("electricity.limiter.threshold", obis_float, "kW", "gauge"),
+    "1-0:31.4.0": ObisCode("electricity.fuse.threshold.l1", obis_float, "A", "gauge"),
+    "1-0:1.4.0": ObisCode("electricity.demand.current_average", obis_float, "kW", "gauge"),
+    "1-0:1.6.0": ObisCode("electricity.demand.maximum_month", obis_timestamped_float, "kW", "gauge"),
+}
+for _tariff in range(1, 17):
+    OBIS_CODES["1-0:1.8.{}".format(_tariff)] = ObisCode(
+        "electricity.meter_reading.to_client.tariff.{}".format(_tariff), obis_float, "kWh", "counter")
+    OBIS_CODES["1-0:2.8.{}".format(_tariff)] = ObisCode(
+        "electricity.meter_reading.by_client.tariff.{}".format(_tariff), obis_float, "kWh", "counter")
+for _phase, _group in ((1, 20), (2, 40), (3, 60)):
+    OBIS_CODES["1-0:{}.32.0".format(_group + 12)] = ObisCode(
+        "electricity.voltage.sags.l{}".format(_phase), obis_int, None, "counter")
+    OBIS_CODES["1-0:{}.36.0".format(_group + 12)] = ObisCode(
+        "electricity.voltage.swells.l{}".format(_phase), obis_int, None, "counter")
+    OBIS_CODES["1-0:{}.7.0".format(_group + 12)] = ObisCode(
+        "electricity.voltage.l{}".format(_phase), obis_float, "V", "gauge")
+    OBIS_CODES["1-0:{}.7.0".format(_group + 11)] = ObisCode(
+        "electricity.current.l{}".format(_phase), obis_float, "A", "gauge")
+    OBIS_CODES["1-0:{}.7.0".format(_group + 1)] = ObisCode(
+        "electricity.power.to_client.l{}".format(_phase), obis_float, "kW", "gauge")
+    OBIS_CODES["1-0:{}.7.0".format(_group + 2)] = ObisCode(
+        "electricity.power.by_client.l{}".format(_phase), obis_float, "kW", "gauge")
+for _channel in range(1, 5):
+    OBIS_CODES["0-{}:24.1.0".format(_channel)] = ObisCode(
+        "mbus.{}.device_type".format(_channel), obis_int, None, None)
+    OBIS_CODES["0-{}:96.1.0".format(_channel)] = ObisCode(
+        "mbus.{}.identifier".format(_channel), obis_string, None, None)
+    OBIS_CODES["0-{}:96.1.1".format(_channel)] = ObisCode(
+        "mbus.{}.identifier".format(_channel), obis_string, None, None)
+    OBIS_CODES["0-{}:24.4.0".format(_channel)] = ObisCode(
+        "mbus.{}.valve_position".format(_channel), obis_int, None, "gauge")
+    # gas is 24.2.1 in dsmr and 24.2.3 in e-MUCS (belgium), water is 24.2.1 on its own channel
+    OBIS_CODES["0-{}:24.2.1".format(_channel)] = ObisCode(
+        "mbus.{}.meter_reading".format(_channel), obis_timestamped_float, "m3", "counter")
+    OBIS_CODES["0-{}:24.2.3".format(_channel)] = ObisCode(
+        "mbus.{}.meter_reading".format(_channel), obis_timestamped_float, "m3", "counter")
+
+OBIS_CONVERTERS = {key: obis_code.convert for key, obis_code in OBIS_CODES.items()}
+# the codes whose decoded lines may be cached: not the meter time, it never repeats, and not the power failure
+# log, its value is a list
+OBIS_CACHE_CANDIDATES = frozenset(key for key, obis_code in OBIS_CODES.items()
+                                  if obis_code.convert not in (obis_timestamp, obis_power_failure_log))
+
+# fields added by DerivedMetrics: 'delta' fields are the change since the previous telegram of the input (summed by
+# aggregation), 'gauge' fields are instantaneous values (averaged) and 'total' fields are totals of the day
+DERIVED_FIELDS = {
+    "derived.interval": "delta",
+    "derived.energy.to_client": "delta",
+    "derived.energy.by_client": "delta",
+    "derived.today.to_client.total": "total",
+    "derived.today.by_client.total": "total",
+    "derived.power.net": "gauge",
+    "derived.power.imbalance": "gauge",
+    "derived.current.imbalance": "gauge",
+}
+# register: (delta field, day total field), the deltas of the tariff registers are added up
+DERIVED_REGISTERS = {
+    "1-0:1.8.0": ("derived.energy.to_client", "derived.today.to_client.total"),
+    "1-0:2.8.0": ("derived.energy.by_client", "derived.today.by_client.total"),
+}
+DERIVED_TARIFF_REGISTERS = set()
+for _tariff in range(1, 17):
+    for _direction, _group in (("to_client", 1), ("by_client", 2)):
+        DERIVED_FIELDS["derived.today.{}.tariff.{}".format(_direction, _tariff)] = "total"
+        DERIVED_REGISTERS["1-0:{}.8.{}".format(_group, _tariff)] = (
+            "derived.energy." + _direction, "derived.today.{}.tariff.{}".format(_direction, _tariff))
+        DERIVED_TARIFF_REGISTERS.add("1-0:{}.8.{}".format(_group, _tariff))
+for _channel in range(1, 5):
+    DERIVED_FIELDS["derived.mbus.{}.delta".format(_channel)] = "delta"
+    DERIVED_FIELDS["derived.today.mbus.{}".format(_channel)] = "total"
+    for _code in ("24.2.1", "24.2.3"):
+        DERIVED_REGISTERS["0-{}:{}".format(_channel, _code)] = (
+            "derived.mbus.{}.delta".format(_channel), "derived.today.mbus.{}".format(_channel))
+
+
+# elasticsearch field mapping per converter, numbers are not indexed (they are aggregated, not searched) but keep
+# doc_values, strings are keywords instead of text + keyword multi-fields
+ELASTIC_NUMBER = {"type": "float", "index": False}
+ELASTIC_INTEGER = {"type": "long", "index": False}
+ELASTIC_KEYWORD = {"type": "keyword", "ignore_above": 1024}
+ELASTIC_DATE = {"type": "date"}
+ELASTIC_CONVERTER_MAPPINGS = {
+    obis_float: ELASTIC_NUMBER,
+    obis_int: ELASTIC_INTEGER,
+    obis_string: ELASTIC_KEYWORD,
+    obis_timestamp: ELASTIC_DATE,
+    obis_timestamped_float: ELASTIC_NUMBER,
+    obis_power_failure_log: ELASTIC_KEYWORD,
 }
-"""
+ELASTIC_POWER_FAILURE_EVENTS = {"properties": {"end": ELASTIC_DATE, "duration": ELASTIC_INTEGER}}
+
+
+def mapping_path_conflicts(fields):
+    """ the fields that are also the dotted path of another field, like a.b next to a.b.c """
+    fields = set(fields)
+    conflicts = set()
+    for field in fields:
+        parts = field.split('.')
+        for end in range(1, len(parts)):
+            prefix = '.'.join(parts[:end])
+            if prefix in fields:
+                conflicts.add(prefix)
+    return sorted(conflicts)
+
+
+def elastic_mappings(synthetic_source=False):
+    """ explicit mappings for the documents, generated from OBIS_CODES """
+    properties = {
+        "@timestamp": ELASTIC_DATE,
+        "host.name": ELASTIC_KEYWORD,
+        "host.port": {"type": "integer"},
+        "serial.port": ELASTIC_KEYWORD,
+        "aggregate.count": ELASTIC_INTEGER,
+        "aggregate.window": ELASTIC_NUMBER,
+    }
+    for key, obis_code in OBIS_CODES.items():
+        properties[key] = ELASTIC_CONVERTER_MAPPINGS[obis_code.convert]
+        if obis_code.convert is obis_timestamped_float:
+            properties[key + "_timestamp"] = ELASTIC_DATE
+        elif obis_code.convert is obis_power_failure_log:
+            properties[key + "_events"] = ELASTIC_POWER_FAILURE_EVENTS
+        if obis_code.kind == "gauge":
+            # minimum and maximum of aggregated documents
+            properties[key + "_min"] = ELASTIC_NUMBER
+            properties[key + "_max"] = ELASTIC_NUMBER
+    for key, kind in DERIVED_FIELDS.items():
+        properties[key] = ELASTIC_NUMBER
+        if kind == "gauge":
+            properties[key + "_min"] = ELASTIC_NUMBER
+            properties[key + "_max"] = ELASTIC_NUMBER
+    conflicts = mapping_path_conflicts(properties)
+    if conflicts:
+        # elasticsearch reads dots as object paths, a field can't be both a value and an object
+        raise ValueError("fields that are also object paths: {}".format(", ".join(conflicts)))
+    mappings = {
+        # codes missing from OBIS_CODES (obis_generic)
+        "dynamic_templates": [
+            {"strings": {"match_mapping_type": "string", "mapping": ELASTIC_KEYWORD}},
+            {"numbers": {"match_mapping_type": "double", "mapping": ELASTIC_NUMBER}},
+            {"integers": {"match_mapping_type": "long", "mapping": ELASTIC_INTEGER}},
+        ],
+        "properties": properties,
+    }
+    if synthetic_source:
+        # every field has doc_values, so _source can be rebuilt from them instead of being stored (elasticsearch 8.4+)
+        mappings["_source"] = {"mode": "synthetic"}
+    return mappings
+
+
+def elastic_index_template(index_patterns, synthetic_source=False, lifecycle=None, rollover_alias=None):
+    """ composable index template (elasticsearch 7.8+) for the dsmr indices """
+    settings = {"index.number_of_shards": 1, "index.codec": "best_compression", "index.refresh_interval": "10s"}
+    if lifecycle is not None:
+        settings["index.lifecycle.name"] = lifecycle
+        settings["index.lifecycle.rollover_alias"] = rollover_alias
+    return {"index_patterns": index_patterns, "priority": 200,
+            "template": {"settings": settings, "mappings": elastic_mappings(synthetic_source)}}
+
+
+def elastic_lifecycle_policy(retention_days=None, max_size="10gb", max_age="30d"):
+    """ ilm policy: roll over the write index by size or age, optionally delete indices after retention_days """
+    phases = {"hot": {"actions": {"rollover": {"max_size": max_size, "max_age": max_age}}}}
+    if retention_days:
+        phases["delete"] = {"min_age": "{}d".format(retention_days), "actions": {"delete": {}}}
+    return {"policy": {"phases": phases}}
+
+
+def _crc16_table(polynomial=0xA001):
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ polynomial if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data, crc=0):
+    """ dsmr 4/5 crc16 (polynomial 0xA001, initial value 0) over bytes, bytearray or memoryview """
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
+
+
+class TelegramFramer:
+    """
+    incremental telegram framer for one p1 input
+
+    keeps the bytes of a partially received telegram across reads and returns every complete
+    telegram, from the '/' header up to and including the '!CRC' trailer line
+    """
+    def __init__(self, max_telegram_size=16384):
+        self.max_telegram_size = max_telegram_size
+        self.buffer = bytearray()
+        # bytes before this offset are already checked for '/' and '!'
+        self.scan_offset = 0
+        self.accepted = 0
+        self.crc_failed = 0
+        self.truncated = 0
+
+    def feed(self, data):
+        """ add data to the buffer and return a list of complete telegrams (bytes) """
+        if not self.buffer:
+            # only keep data from the start of a telegram
+            start = data.find(b'/')
+            if start == -1:
+                return []
+            data = data[start:]
+            self.scan_offset = 1
+        self.buffer += data
+
+        telegrams = []
+        while self.buffer:
+            end = self.buffer.find(b'!', self.scan_offset)
+            restart = self.buffer.find(b'/', self.scan_offset, len(self.buffer) if end == -1 else end)
+            if restart != -1:
+                # a new header before the end of the current telegram, the current telegram is truncated
+                self.truncated += 1
+                del self.buffer[:restart]
+                self.scan_offset = 1
+                continue
+            if end == -1:
+                self.scan_offset = len(self.buffer)
+                if len(self.buffer) > self.max_telegram_size:
+                    self.truncated += 1
+                    self.reset()
+                break
+            eol = self.buffer.find(b'\n', end)
+            if eol == -1:
+                # crc line not complete yet, check again from the '!' on the next read
+                self.scan_offset = end
+                break
+            telegrams.append(bytes(self.buffer[:eol + 1]))
+            start = self.buffer.find(b'/', eol + 1)
+            if start == -1:
+                self.reset()
+            else:
+                del self.buffer[:start]
+                self.scan_offset = 1
+        return telegrams
+
+    def verify(self, telegram):
+        """
+        check the crc trailer of a complete telegram and count the result
+
+        dsmr 2.2 and 3 telegrams end with a bare '!' and have no crc to check
+        """
+        end = telegram.rindex(b'!')
+        trailer = telegram[end + 1:].strip()
+        if trailer:
+            try:
+                expected = int(trailer, 16)
+            except ValueError:
+                expected = None
+            if len(trailer) != 4 or expected != crc16(memoryview(telegram)[:end + 1]):
+                self.crc_failed += 1
+                return False
+        self.accepted += 1
+        return True
+
+    def stats(self):
+        return {"accepted": self.accepted, "crc_failed": self.crc_failed, "truncated": self.truncated}
+
+    def reset(self):
+        self.buffer.clear()
+        self.scan_offset = 0
+
+
+CAPTURE_MARKER = b'#ts '
+CAPTURE_FILE_NAME = re.compile(r"^(.*)-\d{8}T\d{6}Z\.gz$")
+
+
+class TelegramCapture:
+    """
+    writes the raw telegrams of all inputs to gzip files, a new file every interval seconds
+
+    every telegram is preceded by a '#ts <receive time> <input labels as json>' line, import reads the files
+    back with the same framer and parser as the live inputs
+    """
+    def __init__(self, directory, name="p1", interval=3600, flush_interval=10):
+        self.directory = directory
+        self.name = name
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.file = None
+        self.path = None
+        self.rotate_time = 0
+        self.flush_time = 0
+        self.written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, received, labels, raw_telegram):
+        if received >= self.rotate_time or self.file is None:
+            self.rotate(received)
+        self.file.write(CAPTURE_MARKER + "{:.3f} {}\n".format(received, json.dumps(labels, sort_keys=True)).encode())
+        self.file.write(raw_telegram)
+        self.written += 1
+        if received >= self.flush_time:
+            # a flushed file can be read up to here after a crash
+            self.file.flush()
+            self.flush_time = received + self.flush_interval
+
+    def rotate(self, now):
+        self.close()
+        start = now - now % self.interval
+        name_time = start
+        while True:
+            self.path = os.path.join(self.directory, "{}-{}.gz".format(
+                self.name, time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(name_time))))
+            if not os.path.exists(self.path):
+                break
+            # never append to a file that a crash may have cut off in the middle of a gzip member: after a restart
+            # within the interval the new file is named after the restart time, which sorts after the first file
+            name_time = max(name_time + 1, int(now))
+        self.file = gzip.open(self.path, 'xb')
+        self.rotate_time = start + self.interval
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_chunks(fileobj, chunk_size=64 * 1024):
+    """ the data of a plain file, in chunks """
+    return iter(functools.partial(fileobj.read, chunk_size), b'')
+
+
+def gzip_chunks(fileobj, chunk_size=64 * 1024):
+    """
+    the decompressed data of a gzip file with one or more members, in chunks
+
+    unlike GzipFile, a file that ends in the middle of a member (the writer was killed) yields everything that can be
+    decompressed before it raises EOFError
+    """
+    decompressor = zlib.decompressobj(31)
+    pending = False
+    for data in read_chunks(fileobj, chunk_size):
+        while data:
+            if not pending:
+                # the zero padding some writers add after a member
+                data = data.lstrip(b'\0')
+                if not data:
+                    break
+            pending = True
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            if not decompressor.eof:
+                break
+            # the next member
+            data = decompressor.unused_data
+            decompressor = zlib.decompressobj(31)
+            pending = False
+    if pending:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+        raise EOFError("compressed file ended before the end of a gzip member")
+
+
+def read_capture(chunks):
+    """
+    yields (receive time, labels, data) of a capture file, data is raw p1 data to feed to a framer
+
+    chunks is the data of the file (read_chunks, gzip_chunks).  Data before the first marker, or a p1 log without
+    markers, has no receive time and labels (None).  When reading the file fails the data read so far is yielded
+    before the error is raised.
+    """
+    received = labels = None
+    buffer = b''
+    chunks = iter(chunks)
+    error = None
+    while True:
+        try:
+            chunk = next(chunks, b'')
+        except (OSError, EOFError, zlib.error) as e:
+            chunk = b''
+            error = e
+        buffer += chunk
+        start = 0
+        while True:
+            marker = buffer.find(CAPTURE_MARKER, start)
+            eol = -1 if marker == -1 else buffer.find(b'\n', marker)
+            if eol == -1:
+                break
+            if marker > start:
+                yield received, labels, buffer[start:marker]
+            timestamp, _, labels = buffer[marker + len(CAPTURE_MARKER):eol].decode().partition(' ')
+            received = float(timestamp)
+            labels = json.loads(labels) if labels.strip() else None
+            start = eol + 1
+        if not chunk:
+            if start < len(buffer):
+                yield received, labels, buffer[start:]
+            if error is not None:
+                raise error
+            return
+        # keep a marker that is not complete yet for the next chunk
+        end = len(buffer) - len(CAPTURE_MARKER) if marker == -1 else marker
+        if end > start:
+            yield received, labels, buffer[start:end]
+            start = end
+        buffer = buffer[start:]
+
+
+class OutputError(Exception):
+    """ temporary output failure, the documents are kept and sent again later """
+
+
+def import_optional(name, package=None):
+    """ import an optional dependency when the feature that needs it is used """
+    try:
+        return importlib.import_module(name)
+    except ModuleNotFoundError:
+        raise ImportError("{} library not found, please install by typing 'pip3 install {}'".format(
+            name, package or name))
+
+
+def json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError("{} is not json serializable".format(type(value).__name__))
+
+
+def doc_input_name(doc):
+    """ the input a document was read from, serial port or host:port """
+    if "serial.port" in doc:
+        return doc["serial.port"]
+    return "{}:{}".format(doc.get("host.name"), doc.get("host.port"))
+
+
+def document_id(doc):
+    """
+    deterministic elasticsearch _id: the meter identifier (or the input) and the meter time (or the receive time),
+    a telegram that is sent again (spool replay, import) replaces the stored document instead of duplicating it.
+    Aggregated documents use the window length and start, they never share an id with a raw telegram.
+    """
+    window = doc.get("aggregate.window")
+    timestamp = doc["@timestamp"] if window is not None else doc.get("0-0:1.0.0") or doc["@timestamp"]
+    if isinstance(timestamp, str):
+        # entries replayed from the spool
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    meter = doc.get("0-0:96.1.1") or doc_input_name(doc)
+    if window is not None:
+        return "{}-agg{}-{}".format(meter, window, int(timestamp.timestamp()))
+    return "{}-{}".format(meter, int(timestamp.timestamp()))
+
+
+GAUGE_CODES = frozenset(key for key, obis_code in OBIS_CODES.items() if obis_code.kind == "gauge")
+# fields averaged and summed by aggregation
+AVERAGED_FIELDS = GAUGE_CODES | frozenset(key for key, kind in DERIVED_FIELDS.items() if kind == "gauge")
+SUMMED_FIELDS = frozenset(key for key, kind in DERIVED_FIELDS.items() if kind == "delta")
+
+
+class RunningStats:
+    """ count, sum, minimum and maximum of a value without keeping the samples """
+    __slots__ = ('count', 'total', 'minimum', 'maximum')
+
+    def __init__(self, value):
+        self.count = 1
+        self.total = value
+        self.minimum = value
+        self.maximum = value
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value < self.minimum:
+            self.minimum = value
+        elif value > self.maximum:
+            self.maximum = value
+
+
+class AggregateWindow:
+    """ running statistics of the telegrams of one input within one window """
+    __slots__ = ('start', 'count', 'stats', 'sums', 'last')
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.stats = {}
+        self.sums = {}
+        self.last = {}
+
+    def add(self, doc):
+        self.count += 1
+        stats = self.stats
+        for key, value in doc.items():
+            if key in AVERAGED_FIELDS and type(value) in (float, int):
+                running = stats.get(key)
+                if running is None:
+                    stats[key] = RunningStats(value)
+                else:
+                    running.add(value)
+            elif key in SUMMED_FIELDS:
+                self.sums[key] = self.sums.get(key, 0) + value
+            else:
+                self.last[key] = value
+
+    def document(self, window):
+        doc = dict(self.last)
+        doc['@timestamp'] = datetime.datetime.fromtimestamp(self.start, datetime.timezone.utc)
+        for key, running in self.stats.items():
+            doc[key] = running.total / running.count
+            doc[key + "_min"] = running.minimum
+            doc[key + "_max"] = running.maximum
+        for key, total in self.sums.items():
+            doc[key] = round(total, 6)
+        doc["aggregate.count"] = self.count
+        doc["aggregate.window"] = window
+        return doc
+
+
+class TelegramAggregator:
+    """
+    reduces the telegrams of every input to one document per window of `window` seconds
+
+    instantaneous values (power, voltage, current) become the average, with _min and _max fields, derived
+    deltas are summed, cumulative registers (1.8.x, 2.8.x, gas) and all other fields keep their last value.  Windows are
+    aligned to the clock and closed by the first telegram of the next window, or by flush_expired()
+    when an input stops sending.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.windows = {}
+
+    def add(self, doc):
+        """ add a telegram document, returns the documents of the windows it closed """
+        finished = []
+        input_name = doc_input_name(doc)
+        start = int(doc['@timestamp'].timestamp() // self.window * self.window)
+        current = self.windows.get(input_name)
+        if current is not None and current.start != start:
+            finished.append(current.document(self.window))
+            current = None
+        if current is None:
+            current = self.windows[input_name] = AggregateWindow(start)
+        current.add(doc)
+        return finished
+
+    def flush_expired(self, now=None):
+        """ close the windows that ended more than one window ago """
+        if now is None:
+            now = time.time()
+        finished = []
+        for input_name, current in list(self.windows.items()):
+            if current.start + 2 * self.window <= now:
+                finished.append(current.document(self.window))
+                del self.windows[input_name]
+        return finished
+
+    def flush_all(self):
+        finished = [current.document(self.window) for current in self.windows.values()]
+        self.windows.clear()
+        return finished
+
+
+class MeterState:
+    """ the previous readings of one input and its totals of the day """
+    __slots__ = ('time', 'day', 'readings', 'today')
+
+    def __init__(self):
+        self.time = None
+        self.day = None
+        self.readings = {}
+        self.today = {}
+
+
+class DerivedMetrics:
+    """
+    adds the DERIVED_FIELDS to every document, computed from the previous telegram of the same input
+
+    intervals use the meter time (0-0:1.0.0) when the telegram has one.  A register that goes down (meter replaced or
+    reset) has no delta and continues from the new reading.  Daily totals start at midnight meter time, or when the
+    exporter starts.
+    """
+    registers = DERIVED_REGISTERS
+    tariff_registers = DERIVED_TARIFF_REGISTERS
+    daily_totals = {"derived.energy.to_client": "derived.today.to_client.total",
+                    "derived.energy.by_client": "derived.today.by_client.total"}
+    counters = frozenset(DERIVED_REGISTERS)
+    phase_power = (("1-0:21.7.0", "1-0:22.7.0"), ("1-0:41.7.0", "1-0:42.7.0"), ("1-0:61.7.0", "1-0:62.7.0"))
+    phase_current = ("1-0:31.7.0", "1-0:51.7.0", "1-0:71.7.0")
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.meters = {}
+        self.resets = 0
+
+    def add(self, doc):
+        """ add the derived fields to a parsed telegram document """
+        if "1-0:1.7.0" in doc and "1-0:2.7.0" in doc:
+            doc["derived.power.net"] = round(doc["1-0:1.7.0"] - doc["1-0:2.7.0"], 6)
+        net = [doc[to_client] - doc[by_client] for to_client, by_client in self.phase_power
+               if to_client in doc and by_client in doc]
+        if len(net) == 3:
+            doc["derived.power.imbalance"] = round(max(net) - min(net), 6)
+        currents = [doc[key] for key in self.phase_current if key in doc]
+        if len(currents) == 3:
+            doc["derived.current.imbalance"] = max(currents) - min(currents)
+
+        input_name = doc_input_name(doc)
+        state = self.meters.get(input_name)
+        if state is None:
+            state = self.meters[input_name] = MeterState()
+        meter_time = doc.get("0-0:1.0.0") or doc['@timestamp'].astimezone()
+        interval = 0 if state.time is None else (meter_time - state.time).total_seconds()
+        state.time = meter_time
+        if meter_time.date() != state.day:
+            state.day = meter_time.date()
+            state.today = {}
+        readings = state.readings
+        deltas = {}
+        for key in self.counters & doc.keys():
+            value = doc[key]
+            previous = readings.get(key)
+            readings[key] = value
+            if previous is None or interval <= 0:
+                continue
+            if value < previous:
+                self.resets += 1
+                self.logger.warning("WARNING| {} of input {} went back from {} to {}, counter reset".format(
+                    key, input_name, previous, value))
+                continue
+            deltas[key] = value - previous
+        if interval <= 0:
+            # first telegram of the input, or the meter time didn't advance
+            return doc
+
+        doc["derived.interval"] = interval
+        today = state.today
+        tariff_deltas = {}
+        for key, delta in deltas.items():
+            total = today[key] = today.get(key, 0.0) + delta
+            delta_field, total_field = self.registers[key]
+            doc[total_field] = round(total, 6)
+            if key in self.tariff_registers:
+                tariff_deltas[delta_field] = tariff_deltas.get(delta_field, 0.0) + delta
+            else:
+                doc[delta_field] = round(delta, 6)
+        # meters with tariff registers: the sum of the tariffs, even when the meter also sends the 1.8.0 total
+        for delta_field, delta in tariff_deltas.items():
+            doc[delta_field] = round(delta, 6)
+            doc[self.daily_totals[delta_field]] = round(sum(
+                total for key, total in today.items()
+                if key in self.tariff_registers and self.registers[key][0] == delta_field), 6)
+        return doc
+
+
+class OutputSink:
+    """
+    base class of the outputs
+
+    every sink has its own bounded queue and writer thread, so a slow or failing output never delays the
+    inputs or the other outputs.  Subclasses implement add() and optionally flush_if_due() and close(),
+    they are only called from the writer thread of the sink.
+    """
+    name = "output"
+    # outputs that serve the latest values get every telegram, also when telegrams are aggregated
+    latest_values = False
+
+    def __init__(self, logger, interval=1, queue_size=1000):
+        self.logger = logger
+        self.interval = interval
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.add_timer = StageTimer()
+
+    def submit(self, doc):
+        """ queue a document for this output, never blocks """
+        try:
+            self.queue.put_nowait(doc)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="dsmr-{}".format(self.name), daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=10):
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        while 1:
+            try:
+                doc = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                pass
+            else:
+                if doc is None:
+                    break
+                add_start = time.perf_counter()
+                try:
+                    self.add(doc)
+                except Exception as e:
+                    self.failed += 1
+                    self.logger.error("ERROR| {} output failed: {}".format(self.name, e))
+                self.add_timer.observe(time.perf_counter() - add_start)
+            try:
+                self.flush_if_due()
+            except Exception as e:
+                self.logger.error("ERROR| {} output failed: {}".format(self.name, e))
+        try:
+            self.close()
+        except Exception as e:
+            self.logger.error("ERROR| {} output close failed: {}".format(self.name, e))
+
+    def add(self, doc):
+        raise NotImplementedError
+
+    def flush_if_due(self):
+        pass
+
+    def close(self):
+        pass
+
+    def backlog_size(self):
+        return 0
+
+    def stats(self):
+        return {"sent": self.sent, "failed": self.failed, "dropped": self.dropped}
+
+    def stage_timers(self):
+        """ the stage timers of this output, by stage name """
+        return {"{}.add".format(self.name): self.add_timer}
+
+
+class DiskSpool:
+    """
+    append-only log of backlog entries in size capped segment files
+
+    entries are json lines in spool-<sequence>.log segments, writes are fsynced at most every fsync_interval
+    seconds.  read() returns entries from the oldest unacknowledged position, ack() commits that read and
+    removes the segments that are completely sent, rewind() gives the read back after a failed send.  The
+    acknowledged position is kept in spool.offset so a restart continues where it stopped.  When the spool
+    grows beyond max_size the oldest segment is dropped.
+    """
+    segment_prefix = "spool-"
+    segment_suffix = ".log"
+
+    def __init__(self, directory, segment_size=16 * 1024 * 1024, max_size=1024 * 1024 * 1024, fsync_interval=1):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.fsync_interval = fsync_interval
+        self.offset_path = os.path.join(directory, "spool.offset")
+        os.makedirs(directory, exist_ok=True)
+        self.segments = collections.deque(self.list_segments())
+        self.sizes = {sequence: os.path.getsize(self.segment_path(sequence)) for sequence in self.segments}
+        self.read_segment, self.read_offset = self.load_offset()
+        self.pending = None
+        self.entries = self.count_entries()
+        self.dropped = 0
+        self.corrupt = 0
+        self.synced = True
+        self.last_sync = time.monotonic()
+        # never append behind a line that may have been cut off by a crash
+        self.write_segment = (self.segments[-1] + 1) if self.segments else 0
+        self.segments.append(self.write_segment)
+        self.sizes[self.write_segment] = 0
+        self.file = open(self.segment_path(self.write_segment), 'ab')
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, "{}{:012d}{}".format(self.segment_prefix, sequence, self.segment_suffix))
+
+    def list_segments(self):
+        sequences = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self.segment_prefix) and name.endswith(self.segment_suffix):
+                try:
+                    sequences.append(int(name[len(self.segment_prefix):-len(self.segment_suffix)]))
+                except ValueError:
+                    pass
+        return sorted(sequences)
+
+    def load_offset(self):
+        try:
+            with open(self.offset_path) as f:
+                segment, offset = (int(value) for value in f.read().split())
+        except (OSError, ValueError):
+            segment, offset = 0, 0
+        if not self.segments or segment < self.segments[0]:
+            return (self.segments[0] if self.segments else 0), 0
+        return segment, offset
+
+    def save_offset(self):
+        temp_path = self.offset_path + ".tmp"
+        with open(temp_path, 'w') as f:
+            f.write("{} {}\n".format(self.read_segment, self.read_offset))
+        os.replace(temp_path, self.offset_path)
+
+    def count_entries(self):
+        count = 0
+        for sequence in self.segments:
+            if sequence < self.read_segment:
+                continue
+            with open(self.segment_path(sequence), 'rb') as f:
+                if sequence == self.read_segment:
+                    f.seek(self.read_offset)
+                for chunk in iter(functools.partial(f.read, 1024 * 1024), b''):
+                    count += chunk.count(b'\n')
+        return count
+
+    def __len__(self):
+        return self.entries
+
+    def size(self):
+        return sum(self.sizes.values())
+
+    def append(self, entry):
+        line = json.dumps(entry, default=json_default, separators=(',', ':')).encode() + b'\n'
+        if self.sizes[self.write_segment] and self.sizes[self.write_segment] + len(line) > self.segment_size:
+            self.rotate()
+        self.file.write(line)
+        self.sizes[self.write_segment] += len(line)
+        self.entries += 1
+        self.synced = False
+        self.sync_if_due()
+        while self.size() > self.max_size and len(self.segments) > 1:
+            self.drop_oldest()
+
+    def rotate(self):
+        self.sync()
+        self.file.close()
+        self.write_segment += 1
+        self.segments.append(self.write_segment)
+        self.sizes[self.write_segment] = 0
+        self.file = open(self.segment_path(self.write_segment), 'ab')
+
+    def drop_oldest(self):
+        """ remove the oldest segment to stay below max_size, its unsent entries are lost """
+        sequence = self.segments.popleft()
+        with open(self.segment_path(sequence), 'rb') as f:
+            if sequence == self.read_segment:
+                f.seek(self.read_offset)
+            lost = f.read().count(b'\n')
+        self.entries -= lost
+        self.dropped += lost
+        os.remove(self.segment_path(sequence))
+        del self.sizes[sequence]
+        self.pending = None
+        if self.read_segment <= sequence:
+            self.read_segment, self.read_offset = self.segments[0], 0
+            self.save_offset()
+
+    def sync_if_due(self, now=None):
+        if self.synced:
+            return
+        if now is None:
+            now = time.monotonic()
+        if now - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.synced = True
+        self.last_sync = time.monotonic()
+
+    def read(self, count):
+        """ returns up to count entries from the oldest unacknowledged position """
+        self.file.flush()
+        entries = []
+        read = 0
+        segment, offset = self.read_segment, self.read_offset
+        while read < count:
+            with open(self.segment_path(segment), 'rb') as f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    offset += len(line)
+                    read += 1
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        self.corrupt += 1
+                    if read >= count:
+                        break
+            if read >= count or segment == self.write_segment:
+                break
+            segment, offset = segment + 1, 0
+        self.pending = (segment, offset, read)
+        return entries
+
+    def ack(self):
+        """ commit the last read() and remove the segments that are completely sent """
+        if self.pending is None:
+            return
+        self.read_segment, self.read_offset, read = self.pending
+        self.pending = None
+        self.entries -= read
+        while self.segments[0] < self.read_segment:
+            sequence = self.segments.popleft()
+            os.remove(self.segment_path(sequence))
+            del self.sizes[sequence]
+        self.save_offset()
+
+    def rewind(self):
+        self.pending = None
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class BatchingSink(OutputSink):
+    """
+    collects documents in a bounded backlog and sends them in batches
+
+    a batch is sent when batch_size documents are waiting or when the oldest waiting document was
+    enqueued interval seconds ago, the enqueue times are kept next to the backlog.  When send() raises
+    OutputError the batch goes back to the front of the backlog and is retried with an exponential
+    backoff.  When the backlog is full the overflow policy drops the oldest or the newest documents.
+
+    With a DiskSpool every entry is appended to the spool instead of the in memory backlog and batches
+    are read back from disk, so memory stays flat during an outage and a restart loses nothing.  The spool
+    only keeps the time its oldest entry was enqueued, until it is empty again.  After an outage up to
+    replay_batches batches are sent back to back before the queue is read again.
+    """
+    overflow_policies = ('drop-oldest', 'drop-newest')
+    replay_batches = 10
+
+    def __init__(self, logger, batch_size=500, interval=1, backlog_size=100000, overflow_policy='drop-oldest',
+                 max_retry_delay=60, queue_size=1000, spool=None):
+        super().__init__(logger, interval=interval, queue_size=queue_size)
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError("not a valid overflow policy: {}".format(overflow_policy))
+        self.batch_size = batch_size
+        self.max_backlog_size = backlog_size
+        self.overflow_policy = overflow_policy
+        self.max_retry_delay = max_retry_delay
+        self.backlog = collections.deque()
+        self.backlog_times = collections.deque()
+        self.spool = spool
+        # entries left in the spool by the previous run are due right away
+        self.spool_since = 0
+        self.retry_delay = 0
+        self.retry_at = 0
+        self.batch_since = 0
+        self.retries = 0
+        self.requests = 0
+        self.request_seconds = 0.0
+        self.request_timer = StageTimer()
+        self.latency = 0.0
+
+    def add(self, doc):
+        entry = self.prepare(doc)
+        if entry is None:
+            return
+        now = time.monotonic()
+        if self.spool is not None:
+            if not len(self.spool):
+                self.spool_since = now
+            self.spool.append(entry)
+            return
+        self.backlog.append(entry)
+        self.backlog_times.append(now)
+        self.trim_backlog()
+
+    def prepare(self, doc):
+        """ convert a document to a backlog entry, None skips the document """
+        return doc
+
+    def trim_backlog(self):
+        while len(self.backlog) > self.max_backlog_size:
+            self.dropped += 1
+            if self.overflow_policy == 'drop-oldest':
+                self.backlog.popleft()
+                self.backlog_times.popleft()
+            else:
+                self.backlog.pop()
+                self.backlog_times.pop()
+
+    def backlog_size(self):
+        if self.spool is not None:
+            return len(self.spool)
+        return len(self.backlog)
+
+    def flush_due(self, now=None):
+        backlog_size = self.backlog_size()
+        if not backlog_size:
+            return False
+        if now is None:
+            now = time.monotonic()
+        if now < self.retry_at:
+            return False
+        if backlog_size >= self.batch_size:
+            return True
+        oldest = self.spool_since if self.spool is not None else self.backlog_times[0]
+        return now - oldest >= self.interval
+
+    def flush_if_due(self):
+        if self.spool is not None:
+            self.spool.sync_if_due()
+        for _ in range(self.replay_batches):
+            if not self.flush_due():
+                break
+            self.flush()
+
+    def flush(self):
+        """ send one batch, failed documents are put back in front of the backlog """
+        if self.spool is not None:
+            batch = self.spool.read(self.batch_size)
+        else:
+            count = min(self.batch_size, len(self.backlog))
+            batch = [self.backlog.popleft() for _ in range(count)]
+            if count:
+                self.batch_since = self.backlog_times[0]
+            for _ in range(count):
+                self.backlog_times.popleft()
+        if not batch:
+            if self.spool is not None:
+                self.spool.ack()
+            return
+        request_start = time.monotonic()
+        try:
+            rejected = self.send(batch)
+        except OutputError as e:
+            self.logger.warning("WARNING| {} output error, {} documents in backlog: {}".format(
+                self.name, self.backlog_size() + (0 if self.spool is not None else len(batch)), e))
+            self.retry(batch)
+            return
+        request_seconds = time.monotonic() - request_start
+        self.requests += 1
+        self.request_seconds += request_seconds
+        self.request_timer.observe(request_seconds)
+        if self.spool is not None:
+            self.spool.ack()
+        if rejected:
+            self.logger.warning("WARNING| {} output backpressure for {} documents".format(self.name, len(rejected)))
+            self.retry(rejected)
+        else:
+            self.retry_delay = 0
+            self.retry_at = 0
+
+    def send(self, batch):
+        """ send a batch, returns the entries to retry """
+        raise NotImplementedError
+
+    def retry(self, batch):
+        self.retries += 1
+        if self.spool is None:
+            self.backlog.extendleft(reversed(batch))
+            # the documents of the batch are as old as its oldest document
+            self.backlog_times.extendleft([self.batch_since] * len(batch))
+            self.trim_backlog()
+        elif self.spool.pending is not None:
+            # the whole batch failed, read it again from the spool
+            self.spool.rewind()
+        else:
+            # rejected documents of an acknowledged batch go to the end of the spool
+            for entry in batch:
+                self.spool.append(entry)
+        self.retry_delay = min(self.retry_delay * 2 or 1, self.max_retry_delay)
+        self.retry_at = time.monotonic() + self.retry_delay
+
+    def close(self):
+        """ best effort flush of the remaining backlog, a spool is kept on disk for the next start """
+        if self.spool is not None:
+            self.spool.close()
+            return
+        self.retry_at = 0
+        while self.backlog and self.retry_at == 0:
+            self.flush()
+
+    def stats(self):
+        stats = super().stats()
+        if self.spool is not None:
+            stats["dropped"] += self.spool.dropped
+            stats["failed"] += self.spool.corrupt
+        return stats
+
+    def stage_timers(self):
+        return dict(super().stage_timers(), **{"{}.request".format(self.name): self.request_timer})
+
+
+class ElasticBulkSink(BatchingSink):
+    """
+    sends documents to elasticsearch with the _bulk api, 429 and 5xx responses are retried
+
+    before the first request the index template (and with rollover the ilm policy and the first write index
+    behind the index alias) is installed.  index is a strftime pattern, or the alias name with rollover.
+    """
+    name = "elasticsearch"
+
+    def __init__(self, client, index, logger, template=True, rollover=False, retention_days=None,
+                 synthetic_source=False, document_time=False, **kwargs):
+        super().__init__(logger, **kwargs)
+        self.elasticsearch = import_optional('elasticsearch')
+        self.client = client
+        self.index = index
+        self.template = template
+        self.rollover = rollover
+        self.retention_days = retention_days
+        self.synthetic_source = synthetic_source
+        # resolve the index pattern with the document time instead of the current time (import)
+        self.document_time = document_time
+        self.index_ready = not (template or rollover)
+        self.index_name = None
+        self.index_expires = 0
+
+    @staticmethod
+    def index_pattern(index):
+        """ index pattern matching every index a strftime index name resolves to """
+        if '%' in index:
+            return index.split('%', 1)[0] + '*'
+        return index
+
+    def current_index(self):
+        """ the index name for a document sent now, strftime is resolved at most once per second """
+        now = time.time()
+        if now >= self.index_expires:
+            self.index_expires = int(now) + 1
+            self.index_name = time.strftime(self.index, time.gmtime(now))
+        return self.index_name
+
+    def prepare(self, doc):
+        if self.document_time:
+            return time.strftime(self.index, doc['@timestamp'].utctimetuple()), doc
+        return self.current_index(), doc
+
+    def setup_index(self):
+        """ install the ilm policy, index template and first write index, runs before the first bulk request """
+        name = self.index_pattern(self.index).rstrip('*-_.') or "dsmr"
+        try:
+            if self.rollover:
+                self.client.ilm.put_lifecycle(policy=name, body=elastic_lifecycle_policy(self.retention_days))
+                self.client.indices.put_index_template(name=name, body=elastic_index_template(
+                    ["{}-*".format(self.index)], self.synthetic_source, lifecycle=name, rollover_alias=self.index))
+                if not self.client.indices.exists_alias(name=self.index):
+                    self.client.indices.create(index="{}-000001".format(self.index),
+                                               body={"aliases": {self.index: {"is_write_index": True}}})
+                    self.logger.info("- created index {}-000001 behind alias {}".format(self.index, self.index))
+            else:
+                self.client.indices.put_index_template(name=name, body=elastic_index_template(
+                    [self.index_pattern(self.index)], self.synthetic_source))
+        except self.elasticsearch.exceptions.ConnectionError as e:
+            raise OutputError("connection error: {}".format(e))
+        except self.elasticsearch.exceptions.TransportError as e:
+            if e.status_code == 429 or (isinstance(e.status_code, int) and e.status_code >= 500):
+                raise OutputError("backpressure ({})".format(e.status_code))
+            self.logger.error("ERROR| elastic index template not installed: {}".format(e))
+        else:
+            self.logger.info("- elastic index template {} installed".format(name))
+        self.index_ready = True
+
+    def send(self, batch):
+        if not self.index_ready:
+            self.setup_index()
+        body = []
+        for index, doc in batch:
+            body.append({"index": {"_index": index, "_id": document_id(doc)}})
+            body.append(doc)
+        try:
+            res = self.client.bulk(body=body)
+        except self.elasticsearch.exceptions.ConnectionError as e:
+            raise OutputError("connection error: {}".format(e))
+        except self.elasticsearch.exceptions.TransportError as e:
+            if e.status_code == 429 or (isinstance(e.status_code, int) and e.status_code >= 500):
+                raise OutputError("backpressure ({})".format(e.status_code))
+            self.failed += len(batch)
+            self.logger.error("ERROR| elastic refused bulk request, {} documents lost: {}".format(len(batch), e))
+            return []
+        oldest = batch[0][1].get('@timestamp')
+        if isinstance(oldest, str):
+            # entries replayed from the spool
+            oldest = datetime.datetime.fromisoformat(oldest)
+        if oldest is not None:
+            self.latency = (datetime.datetime.now(datetime.timezone.utc) - oldest).total_seconds()
+
+        rejected = []
+        for entry, item in zip(batch, res.get("items", [])):
+            result = item.get("index", {})
+            status = result.get("status", 0)
+            if status == 429:
+                rejected.append(entry)
+            elif status >= 300:
+                self.failed += 1
+                self.logger.error("ERROR| elastic refused document: {}".format(result.get("error")))
+            else:
+                self.sent += 1
+        return rejected
+
+
+class InfluxLineSink(BatchingSink):
+    """
+    writes documents in influxdb line protocol to a http write endpoint
+
+    the url is the full write url, like http://influx:8086/write?db=dsmr (1.x) or
+    http://influx:8086/api/v2/write?org=home&bucket=dsmr (2.x)
+    """
+    name = "influxdb"
+    tags = (("serial.port", "serial_port"), ("host.name", "host_name"), ("host.port", "host_port"))
+    tag_keys = frozenset(key for key, _ in tags)
+
+    def __init__(self, url, logger, measurement="dsmr", token=None, timeout=10, **kwargs):
+        super().__init__(logger, **kwargs)
+        self.url = url
+        self.measurement = measurement
+        self.token = token
+        self.timeout = timeout
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+    def prepare(self, doc):
+        """ one line of line protocol, None for a document without numeric fields (not a valid line) """
+        tags = "".join(",{}={}".format(tag, self.escape(doc[key])) for key, tag in self.tags if key in doc)
+        fields = ",".join("{}={}".format(self.escape(key), repr(float(value)))
+                          for key, value in doc.items() if type(value) in (float, int) and key not in self.tag_keys)
+        if not fields:
+            return None
+        line = "{}{} {}".format(self.measurement, tags, fields)
+        timestamp = doc.get('@timestamp')
+        if timestamp is not None:
+            line += " {}".format(int(timestamp.timestamp() * 1000000) * 1000)
+        return line
+
+    def send(self, batch):
+        request = urllib.request.Request(self.url, data="\n".join(batch).encode(), method="POST")
+        request.add_header("Content-Type", "text/plain; charset=utf-8")
+        if self.token:
+            request.add_header("Authorization", "Token {}".format(self.token))
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            if e.code == 429 or e.code >= 500:
+                raise OutputError("http {}".format(e.code))
+            body = e.read().decode(errors='replace')
+            if e.code == 400 and "partial write" in body:
+                # the valid lines are written, 1.x reports dropped=<n>, 2.x one "line <n>:" per rejected line
+                match = re.search(r"dropped=(\d+)", body)
+                dropped = min(len(batch), int(match.group(1)) if match else len(re.findall(r"line \d+:", body)))
+                self.sent += len(batch) - dropped
+                self.failed += dropped
+                self.logger.error("ERROR| influxdb refused {} of {} lines: {}".format(dropped, len(batch), body))
+                return []
+            self.failed += len(batch)
+            self.logger.error("ERROR| influxdb refused {} lines: http {} {}".format(len(batch), e.code, body))
+            return []
+        except (urllib.error.URLError, OSError) as e:
+            raise OutputError(e)
+        self.sent += len(batch)
+        return []
+
+
+class FileSink(OutputSink):
+    """ appends every document as a json line to a file """
+    name = "file"
+
+    def __init__(self, path, logger, **kwargs):
+        super().__init__(logger, **kwargs)
+        self.path = path
+        self.file = open(path, 'a')
+        self.last_flush = time.monotonic()
+
+    def add(self, doc):
+        self.file.write(json.dumps(doc, default=json_default) + "\n")
+        self.sent += 1
+
+    def flush_if_due(self):
+        now = time.monotonic()
+        if now - self.last_flush >= self.interval:
+            self.last_flush = now
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MqttSink(OutputSink):
+    """
+    publishes every document as json on <topic>/<meter>
+
+    the meter is the equipment identifier, or the input when the telegram has none.  The paho mqtt
+    client reconnects in the background, documents published while disconnected are counted as failed.
+    """
+    name = "mqtt"
+
+    def __init__(self, host, port, logger, topic="dsmr", qos=0, client=None, **kwargs):
+        super().__init__(logger, **kwargs)
+        self.topic = topic.rstrip('/')
+        self.qos = qos
+        if client is None:
+            mqtt = import_optional('paho.mqtt.client', 'paho-mqtt')
+            client = mqtt.Client()
+            client.max_queued_messages_set(self.queue.maxsize)
+            client.connect_async(host, port)
+            client.loop_start()
+        self.client = client
+
+    def add(self, doc):
+        meter = doc.get("0-0:96.1.1") or doc_input_name(doc)
+        topic = "{}/{}".format(self.topic, re.sub('[^A-Za-z0-9_.:-]', '_', str(meter)))
+        result = self.client.publish(topic, json.dumps(doc, default=json_default), qos=self.qos)
+        if result.rc == 0:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class ForwardSink(OutputSink):
+    """
+    output of a worker process, sends documents in batches to the supervisor
+
+    one queue item (and one pickle) per batch of documents, sent when it is full or interval seconds after its
+    first document.  When the supervisor doesn't keep up for interval seconds the batch is dropped.
+    """
+    name = "forward"
+
+    def __init__(self, documents, worker, logger, batch_size=100, interval=0.2, **kwargs):
+        super().__init__(logger, interval=interval, **kwargs)
+        self.documents = documents
+        self.worker = worker
+        self.batch_size = batch_size
+        self.batch = []
+        self.batch_since = 0
+
+    def add(self, doc):
+        if not self.batch:
+            self.batch_since = time.monotonic()
+        self.batch.append(doc)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush_if_due(self):
+        if self.batch and time.monotonic() - self.batch_since >= self.interval:
+            self.flush()
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        try:
+            self.documents.put(("documents", self.worker, batch), timeout=self.interval)
+        except queue.Full:
+            self.dropped += len(batch)
+            return
+        self.sent += len(batch)
+
+    def close(self):
+        if self.batch:
+            self.flush()
+
+
+def prometheus_labels(labels):
+    return ",".join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                    for key, value in labels)
+
+
+def prometheus_metric(obis_code):
+    """ metric name of an OBIS code """
+    name = "dsmr_" + obis_code.name.replace('.', '_')
+    if obis_code.unit:
+        name += "_" + obis_code.unit.lower()
+    if obis_code.kind == "counter":
+        name += "_total"
+    return name
+
+
+def prometheus_families(obis_codes):
+    """
+    {metric name: (type, help text)} of the OBIS codes with a kind
+
+    codes with the same name (gas is 24.2.1 or 24.2.3) are one family, the exposition format allows one HELP and TYPE
+    per name
+    """
+    codes = {}
+    for obis, obis_code in obis_codes.items():
+        if obis_code.kind is not None:
+            codes.setdefault(prometheus_metric(obis_code), []).append((obis, obis_code))
+    return {name: (entries[0][1].kind, "{} {}".format("/".join(obis for obis, _ in entries), entries[0][1].name))
+            for name, entries in codes.items()}
+
+
+class PrometheusSink(OutputSink):
+    """
+    serves the latest values of every meter and the exporter internals on /metrics
+
+    the samples of a meter are replaced as a whole when its telegram arrives, a scrape only joins the
+    precomputed samples and never parses anything
+    """
+    name = "prometheus"
+    latest_values = True
+    input_labels = (("serial.port", "serial_port"), ("host.name", "host_name"), ("host.port", "host_port"))
+    metrics = {obis: prometheus_metric(obis_code)
+               for obis, obis_code in OBIS_CODES.items() if obis_code.kind is not None}
+    families = prometheus_families(OBIS_CODES)
+
+    def __init__(self, logger, **kwargs):
+        super().__init__(logger, **kwargs)
+        self.lock = threading.Lock()
+        self.meters = {}
+        self.internal_metrics = ""
+        self.output = b""
+        self.dirty = True
+        self.server = None
+
+    def add(self, doc):
+        labels = prometheus_labels((label, doc[key]) for key, label in self.input_labels if key in doc)
+        samples = {}
+        for key, value in doc.items():
+            metric = self.metrics.get(key)
+            if metric is not None and type(value) in (float, int):
+                samples[metric] = value
+        with self.lock:
+            self.meters[labels] = samples
+            self.dirty = True
+        self.sent += 1
+
+    def set_internal_metrics(self, text):
+        with self.lock:
+            self.internal_metrics = text
+            self.dirty = True
+
+    def render(self):
+        with self.lock:
+            if not self.dirty:
+                return self.output
+            families = {}
+            for labels, samples in self.meters.items():
+                for name, value in samples.items():
+                    families.setdefault(name, []).append("{}{{{}}} {}".format(name, labels, value))
+            lines = []
+            for name, samples in sorted(families.items()):
+                kind, help_text = self.families[name]
+                lines.append("# HELP {} {}".format(name, help_text))
+                lines.append("# TYPE {} {}".format(name, kind))
+                lines.extend(samples)
+            lines.append(self.internal_metrics)
+            self.output = "\n".join(lines).encode()
+            self.dirty = False
+            return self.output
+
+    def listen(self, port, address=''):
+        exporter = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                output = exporter.render()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(output)))
+                self.end_headers()
+                self.wfile.write(output)
+
+            def log_message(self, format, *args):
+                exporter.logger.debug("DEBUG| prometheus " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="dsmr-prometheus-http", daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class MeterSeries:
+    """
+    the last size samples of the numeric fields of one meter
+
+    every field has a ring buffer (array of doubles) sharing the position and the time buffer of the meter, a
+    field missing from a telegram stores NaN.  Memory is 8 bytes per sample per field and doesn't grow once
+    every field was seen.
+    """
+    __slots__ = ('size', 'times', 'fields', 'next', 'count')
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array.array('d', bytes(8 * size))
+        self.fields = {}
+        self.next = 0
+        self.count = 0
+
+    def add(self, timestamp, values):
+        position = self.next
+        self.times[position] = timestamp
+        fields = self.fields
+        for field, buffer in fields.items():
+            buffer[position] = values.get(field, math.nan)
+        for field, value in values.items():
+            if field not in fields:
+                buffer = fields[field] = array.array('d', [math.nan]) * self.size
+                buffer[position] = value
+        self.next = (position + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def position(self, n):
+        """ buffer position of the n-th oldest sample """
+        return (self.next - self.count + n) % self.size
+
+    def find(self, timestamp, after=False):
+        """ number of samples older than timestamp, or older than or at timestamp when after is set """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            value = self.times[self.position(middle)]
+            if value < timestamp or (after and value == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, field, start, end, step=None, aggregate="avg"):
+        """ [[time, value], ...] between start and end, downsampled to one point per step seconds when step is set """
+        buffer = self.fields.get(field)
+        if buffer is None:
+            return []
+        times = self.times
+        points = []
+        buckets = {}
+        for n in range(self.find(start), self.find(end, after=True)):
+            position = self.position(n)
+            value = buffer[position]
+            if value != value:
+                # NaN, field missing in this telegram
+                continue
+            if not step:
+                points.append([times[position], value])
+                continue
+            bucket_start = times[position] // step * step
+            bucket = buckets.get(bucket_start)
+            if bucket is None:
+                buckets[bucket_start] = [value, 1, value, value, value]
+            else:
+                bucket[0] += value
+                bucket[1] += 1
+                bucket[2] = min(bucket[2], value)
+                bucket[3] = max(bucket[3], value)
+                bucket[4] = value
+        if not step:
+            return points
+        if aggregate == "avg":
+            return [[bucket_start, bucket[0] / bucket[1]] for bucket_start, bucket in buckets.items()]
+        index = {"min": 2, "max": 3, "last": 4}[aggregate]
+        return [[bucket_start, bucket[index]] for bucket_start, bucket in buckets.items()]
+
+
+class RecentStore(OutputSink):
+    """
+    keeps the recent values of every meter in memory and answers range queries over http
+
+        GET /meters                 inputs with their fields, number of samples and time range
+        GET /query?meter=<input>&field=<obis>&since=3600&step=60&aggregate=avg
+
+    meter is the input (serial port or host:port), field can be repeated (all fields when omitted), the range is
+    since seconds ago or start and end in epoch seconds, aggregate is avg, min, max or last.
+    """
+    name = "store"
+    latest_values = True
+    fields = frozenset(obis for obis, obis_code in OBIS_CODES.items() if obis_code.kind is not None) | \
+        frozenset(DERIVED_FIELDS)
+    aggregates = ("avg", "min", "max", "last")
+
+    def __init__(self, logger, size=3600, **kwargs):
+        super().__init__(logger, **kwargs)
+        self.size = size
+        self.lock = threading.Lock()
+        self.meters = {}
+        self.server = None
+
+    def add(self, doc):
+        fields = self.fields
+        values = {key: value for key, value in doc.items() if key in fields and type(value) in (float, int)}
+        meter = doc_input_name(doc)
+        with self.lock:
+            series = self.meters.get(meter)
+            if series is None:
+                series = self.meters[meter] = MeterSeries(self.size)
+            series.add(doc['@timestamp'].timestamp(), values)
+        self.sent += 1
+
+    def describe(self):
+        with self.lock:
+            return {meter: {"fields": sorted(series.fields), "samples": series.count,
+                            "start": series.times[series.position(0)] if series.count else None,
+                            "end": series.times[series.position(series.count - 1)] if series.count else None}
+                    for meter, series in self.meters.items()}
+
+    def query(self, meter, fields=None, start=None, end=None, step=None, aggregate="avg"):
+        """ the points per field of a meter, raises KeyError for an unknown meter """
+        if aggregate not in self.aggregates:
+            raise ValueError("aggregate must be one of {}".format(", ".join(self.aggregates)))
+        if step is not None and step <= 0:
+            raise ValueError("step must be positive")
+        now = time.time()
+        start = now - self.size if start is None else start
+        end = now if end is None else end
+        with self.lock:
+            series = self.meters[meter]
+            return {"meter": meter, "start": start, "end": end, "step": step, "aggregate": aggregate,
+                    "fields": {field: series.query(field, start, end, step, aggregate)
+                               for field in (fields or sorted(series.fields))}}
+
+    def handle_request(self, path):
+        """ returns the http status and the json response for a request path """
+        path, _, query_string = path.partition('?')
+        if path == '/meters':
+            return 200, self.describe()
+        if path != '/query':
+            return 404, {"error": "not found, use /meters or /query"}
+        params = urllib.parse.parse_qs(query_string)
+        try:
+            meter = params["meter"][0]
+            start = float(params["start"][0]) if "start" in params else None
+            end = float(params["end"][0]) if "end" in params else None
+            if "since" in params:
+                start = time.time() - float(params["since"][0])
+            step = float(params["step"][0]) if "step" in params else None
+            return 200, self.query(meter, params.get("field"), start, end, step,
+                                   params.get("aggregate", ["avg"])[0])
+        except KeyError:
+            if "meter" not in params:
+                return 400, {"error": "meter is required"}
+            return 404, {"error": "unknown meter {}".format(params["meter"][0])}
+        except ValueError as e:
+            return 400, {"error": str(e)}
+
+    def listen(self, port, address=''):
+        store = self
+
+        class QueryHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = store.handle_request(self.path)
+                output = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(output)))
+                self.end_headers()
+                self.wfile.write(output)
+
+            def log_message(self, format, *args):
+                store.logger.debug("DEBUG| store " + format, *args)
+
+        self.server = http.server.ThreadingHTTPServer((address, port), QueryHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="dsmr-store-http", daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class WarningLimiter:
+    """
+    logs a warning at most once per key every interval seconds, for warnings that can fire for every telegram
+
+    the message is formatted by logging (lazy arguments) only when it is logged, the warnings suppressed in between
+    are counted in the next one
+    """
+    def __init__(self, logger, interval=60):
+        self.logger = logger
+        self.interval = interval
+        self.next_time = {}
+        self.suppressed = collections.Counter()
+
+    def warning(self, key, message, *args):
+        now = time.monotonic()
+        if now < self.next_time.get(key, 0):
+            self.suppressed[key] += 1
+            return
+        self.next_time[key] = now + self.interval
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            message += ", %d more since the previous warning"
+            args += (suppressed,)
+        self.logger.warning(message, *args)
+
+
+class StageTimer:
+    """
+    duration histogram of a pipeline stage
+
+    observe() is a few additions and a bisect on a short tuple, cheap enough to keep the timers always on.
+    The buckets are upper bounds in seconds, like prometheus histograms.
+    """
+    __slots__ = ('count', 'total', 'maximum', 'counts')
+    buckets = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+               0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.maximum:
+            self.maximum = seconds
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def quantile(self, q):
+        """ upper bound of the bucket that holds quantile q """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.maximum
+
+    def stats(self):
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "max": self.maximum}
+
+
+class SamplingProfiler:
+    """
+    statistical profiler of all threads
+
+    a thread looks at the stacks of the other threads every interval seconds and counts how often every
+    function is running (self) or on the stack (total), per thread.  Samples of threads waiting for a
+    lock, queue or selector are only counted as samples of the thread, so idle time shows as missing
+    percentages instead of filling the report.
+    """
+    idle_functions = frozenset([("threading.py", "wait"), ("selectors.py", "select"), ("queue.py", "get"),
+                                ("threading.py", "_wait_for_tstate_lock"), ("socket.py", "accept")])
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.thread_samples = collections.Counter()
+        self.self_counts = collections.Counter()
+        self.total_counts = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="dsmr-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread = names.get(ident, str(ident))
+                self.thread_samples[thread] += 1
+                if (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name) in self.idle_functions:
+                    continue
+                seen = set()
+                top = True
+                while frame is not None:
+                    code = frame.f_code
+                    key = (thread, code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+                    if top:
+                        self.self_counts[key] += 1
+                        top = False
+                    if key not in seen:
+                        seen.add(key)
+                        self.total_counts[key] += 1
+                    frame = frame.f_back
+
+    def report(self, limit=20):
+        """ the functions with the most samples, as a percentage of the samples of their thread """
+        lines = ["{:>7} {:>7}  {}".format("self", "total", "function")]
+        for key, count in self.self_counts.most_common(limit):
+            thread, name, filename, line = key
+            samples = self.thread_samples[thread]
+            lines.append("{:6.1f}% {:6.1f}%  {} {}:{} [{}]".format(
+                100.0 * count / samples, 100.0 * self.total_counts[key] / samples, name, filename, line, thread))
+        return "\n".join(lines)
+
+
+class P1Source:
+    """
+    one p1 input, a serial port or a tcp host: its framer, last data time and, for tcp, connection state and metrics
+
+    name and labels are computed once.  Connected inputs are registered by file descriptor in
+    DsmrExporter.sources, a tcp input keeps its source (and counters) across reconnects.
+    """
+    __slots__ = ('name', 'labels', 'host', 'port', 'family', 'address', 'fileobj', 'fd', 'framer', 'last_data',
+                 'stall_tick', 'connecting', 'connect_started', 'connect_timer', 'retry_timer', 'attempts',
+                 'connects', 'failures', 'consecutive_failures', 'last_connect_latency')
+
+    def __init__(self, name, labels, host=None, port=None, family=None, address=None):
+        self.name = name
+        self.labels = labels
+        self.host = host
+        self.port = port
+        self.family = family
+        self.address = address
+        self.fileobj = None
+        self.fd = None
+        self.framer = TelegramFramer()
+        self.last_data = 0
+        self.stall_tick = None
+        self.connecting = None
+        self.connect_started = 0
+        self.connect_timer = None
+        self.retry_timer = None
+        self.attempts = 0
+        self.connects = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_connect_latency = None
+
+    def stats(self):
+        return {
+            "attempts": self.attempts,
+            "connects": self.connects,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "last_connect_latency": self.last_connect_latency,
+        }
+
+
+class StallWheel:
+    """
+    stall deadlines of all inputs in one second slots, checked by one timer instead of a timer per input
+
+    reading data only moves the last data time of a source forward.  When the slot of a source comes up and it
+    received data meanwhile it moves to the slot of its new deadline, so a check only looks at the sources in the
+    slots that passed.  Slots are seconds of the monotonic clock.
+    """
+    def __init__(self):
+        self.slots = {}
+        self.tick = int(time.monotonic())
+
+    def schedule(self, source, deadline):
+        self.remove(source)
+        tick = max(math.ceil(deadline), self.tick + 1)
+        slot = self.slots.get(tick)
+        if slot is None:
+            slot = self.slots[tick] = set()
+        slot.add(source)
+        source.stall_tick = tick
+
+    def remove(self, source):
+        if source.stall_tick is not None:
+            slot = self.slots.get(source.stall_tick)
+            if slot is not None:
+                slot.discard(source)
+            source.stall_tick = None
+
+    def expired(self, now):
+        """ the sources in the slots up to now, they are no longer scheduled """
+        sources = []
+        while self.tick < int(now):
+            self.tick += 1
+            slot = self.slots.pop(self.tick, None)
+            if slot:
+                for source in slot:
+                    source.stall_tick = None
+                sources.extend(slot)
+        return sources
 
 
 class DsmrExporter:
     def __init__(self):
         self.socket_stall_detect_timeout = 10
         self.logger = None
-        self.p1serial_ports = []
-        self.p1hosts = []
-        self.p1host_last_data_time = {}
+        self.warnings = None
+        self.selector = selectors.DefaultSelector()
+        self.timers = []
+        self.timer_sequence = 0
+        # connected inputs by file descriptor, and all configured inputs
+        self.sources = {}
+        self.serial_inputs = {}
+        self.tcp_inputs = {}
+        # tcp inputs added by a reload, waiting for the resolver thread
+        self.resolving = {}
+        self.resolver = None
+        self.resolve_poll_interval = 0.1
+        self.stall_wheel = StallWheel()
+        self.stall_check_interval = 1
+        self.reconnect_min_delay = 1
+        self.reconnect_max_delay = 300
         self.tcp_buffer_size = 8000
-        self.re_validate_telegram_line = re.compile("^(\d-\d:\d+?\.\d+?\.\d+?)\((.*)\)")
+        # decoded lines that repeat between telegrams, see count_cache_lookup
+        self.obis_line_cache = {}
+        self.obis_line_cache_size = 4096
+        self.obis_cached_codes = set(OBIS_CACHE_CANDIDATES)
+        self.obis_cache_trial = {key: [0, 0] for key in OBIS_CACHE_CANDIDATES}
+        self.obis_cache_trial_size = 200
+        self.re_validate_obis_code = re.compile(r"^\d+-\d+:\d+\.\d+\.\d+$")
         self.elastic_host = None
         self.elastic_index = ''
-        self.elastic_backlog = []
+        self.elastic_output = None
+        self.outputs = []
+        self.elastic_interval = 1
+        self.elastic_batch_size = 500
+        self.elastic_backlog_size = 100000
+        self.elastic_backlog_policy = 'drop-oldest'
+        self.elastic_template = True
+        self.elastic_rollover = False
+        self.elastic_retention = None
+        self.elastic_synthetic_source = False
+        self.spool_dir = None
+        self.spool_size = 1024 * 1024 * 1024
+        self.queue_size = 1000
+        self.capture_dir = None
+        self.capture_interval = 3600
+        self.capture_name = "p1"
+        self.capture = None
+        self.derived_metrics = False
+        self.derived = None
+        self.parse_queue = None
+        self.pipeline_threads = []
+        self.dropped_telegrams = 0
+        self.parsed_telegrams = 0
+        self.parse_seconds = 0.0
+        self.prometheus = None
+        self.prometheus_interval = 1
+        self.aggregator = None
+        self.running = False
+        self.supervisor = None
+        self.worker_stats = {}
+        self.stages = {stage: StageTimer() for stage in ("read", "frame", "crc", "enqueue", "parse")}
+        self.profile_interval = None
+        self.profile_sampling = False
+        self.profiler = None
+        self.config = None
+        self.config_reload = None
+        self.config_check_interval = 2
+        self.reload_requested = False
+
+    def set_logger(self, logger):
+        self.logger = logger
+        self.warnings = WarningLimiter(logger)
+
+    def call_later(self, delay, callback, *args):
+        """ run callback(*args) from the event loop after delay seconds, returns a handle for cancel_timer() """
+        self.timer_sequence += 1
+        timer = [time.monotonic() + delay, self.timer_sequence, callback, args]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    @staticmethod
+    def cancel_timer(timer):
+        if timer is not None:
+            timer[2] = None
+
+    def run_timers(self):
+        """ run the expired timers and return the number of seconds until the next one """
+        while self.timers:
+            when, _, callback, args = self.timers[0]
+            if callback is None:
+                heapq.heappop(self.timers)
+                continue
+            delay = when - time.monotonic()
+            if delay > 0:
+                return delay
+            heapq.heappop(self.timers)
+            callback(*args)
+        return None
+
+    def add_source(self, source, fileobj, callback):
+        """ register a connected input by its file descriptor and start its stall detection """
+        source.fileobj = fileobj
+        source.fd = fileobj.fileno()
+        source.framer.reset()
+        source.last_data = time.monotonic()
+        self.sources[source.fd] = source
+        self.selector.register(fileobj, selectors.EVENT_READ, callback)
+        self.stall_wheel.schedule(source, source.last_data + self.socket_stall_detect_timeout)
+
+    def remove_source(self, source):
+        self.selector.unregister(source.fileobj)
+        self.stall_wheel.remove(source)
+        del self.sources[source.fd]
+        fileobj = source.fileobj
+        source.fileobj = None
+        source.fd = None
+        return fileobj
+
+    def connect_serial_input(self, serial_port_input):
+        serial_port = serial.Serial(serial_port_input, 115200, timeout=0)
+        source = self.serial_inputs[serial_port_input] = P1Source(serial_port_input,
+                                                                  {"serial.port": serial_port_input})
+        self.add_source(source, serial_port, self.read_serial_input)
+
+    def close_serial_input(self, source):
+        del self.serial_inputs[source.name]
+        self.remove_source(source).close()
+
+    def connect_tcp_input(self, host, port):
+        """ resolve a tcp input and start connecting, failed connects are retried in the background """
+        port = int(port)
+        if port < 1 or port > 65535:
+            raise ValueError("not a valid port: {}".format(port))
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)[0]
+        self.open_tcp_input(host, port, family, address)
+
+    def add_tcp_input(self, host, port):
+        """
+        connect_tcp_input for a running exporter: getaddrinfo blocks, a resolver thread looks the name up and a timer
+        picks up the result, so a slow dns server doesn't stall the inputs that are running
+        """
+        if self.resolver is None:
+            self.resolver = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="dsmr-resolver")
+        future = self.resolver.submit(socket.getaddrinfo, host, port, type=socket.SOCK_STREAM)
+        self.resolving[(host, port)] = future
+        self.call_later(self.resolve_poll_interval, self.finish_add_tcp_input, host, port, future)
+
+    def finish_add_tcp_input(self, host, port, future):
+        if self.resolving.get((host, port)) is not future:
+            # removed again by a later reload
+            return
+        if not future.done():
+            self.call_later(self.resolve_poll_interval, self.finish_add_tcp_input, host, port, future)
+            return
+        del self.resolving[(host, port)]
+        try:
+            family, _, _, _, address = future.result()[0]
+        except (OSError, UnicodeError) as e:
+            self.logger.error("ERROR| can not add tcp input {}:{}: {}".format(host, port, e))
+            return
+        self.open_tcp_input(host, port, family, address)
+
+    def open_tcp_input(self, host, port, family, address):
+        source = P1Source("{}:{}".format(host, port), {"host.name": host, "host.port": port},
+                          host, port, family, address)
+        self.tcp_inputs[(host, port)] = source
+        self.start_tcp_connect(source)
+
+    def start_tcp_connect(self, source):
+        source.retry_timer = None
+        source.attempts += 1
+        source.connect_started = time.monotonic()
+        s = socket.socket(source.family, socket.SOCK_STREAM)
+        s.setblocking(False)
+        error = s.connect_ex(source.address)
+        if error not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            s.close()
+            self.tcp_connect_failed(source, os.strerror(error))
+            return
+        source.connecting = s
+        self.selector.register(s, selectors.EVENT_WRITE, functools.partial(self.finish_tcp_connect, source))
+        source.connect_timer = self.call_later(self.socket_stall_detect_timeout, self.tcp_connect_timeout, source, s)
+
+    def finish_tcp_connect(self, source, s):
+        self.selector.unregister(s)
+        self.cancel_timer(source.connect_timer)
+        source.connecting = None
+        error = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            s.close()
+            self.tcp_connect_failed(source, os.strerror(error))
+            return
+        source.connects += 1
+        source.last_connect_latency = time.monotonic() - source.connect_started
+        self.logger.info("connected to host {} in {:.3f}s".format(source.name, source.last_connect_latency))
+        self.add_source(source, s, self.read_tcp_input)
+
+    def tcp_connect_timeout(self, source, s):
+        if source.connecting is not s:
+            return
+        self.selector.unregister(s)
+        s.close()
+        source.connecting = None
+        self.tcp_connect_failed(source, "timeout")
+
+    def tcp_connect_failed(self, source, reason):
+        source.failures += 1
+        source.consecutive_failures += 1
+        delay = self.reconnect_delay(source.consecutive_failures)
+        self.logger.warning("WARNING| connecting host {} failed ({}), retrying in {:.1f} seconds".format(
+            source.name, reason, delay))
+        source.retry_timer = self.call_later(delay, self.start_tcp_connect, source)
+
+    def reconnect_delay(self, failures):
+        """ exponential backoff with jitter, so hosts that failed together don't retry together """
+        delay = min(self.reconnect_min_delay * 2 ** (failures - 1), self.reconnect_max_delay)
+        return random.uniform(delay / 2, delay)
+
+    def close_tcp_input(self, source):
+        s = self.remove_source(source)
+        try:
+            s.close()
+        except OSError:
+            pass
+
+    def remove_tcp_input(self, host, port):
+        """ close a tcp input and stop reconnecting it """
+        source = self.tcp_inputs.pop((host, port))
+        self.cancel_timer(source.retry_timer)
+        self.cancel_timer(source.connect_timer)
+        if source.connecting is not None:
+            self.selector.unregister(source.connecting)
+            source.connecting.close()
+            source.connecting = None
+        if source.fileobj is not None:
+            self.close_tcp_input(source)
+
+    def update_inputs(self, serial_ports, hosts):
+        """
+        open the inputs that are new and close the inputs that are gone, the others keep their connection
+
+        hosts are (host, port number) like parse_p1_hosts returns them
+        """
+        hosts = set(hosts)
+        configured = set(self.tcp_inputs) | set(self.resolving)
+        for host, port in configured - hosts:
+            self.logger.info("- removing tcp input {}:{}".format(host, port))
+            if self.resolving.pop((host, port), None) is None:
+                self.remove_tcp_input(host, port)
+        for host, port in hosts - configured:
+            self.logger.info("- adding tcp input {}:{}".format(host, port))
+            self.add_tcp_input(host, port)
+        serial_ports = set(serial_ports)
+        for name, source in list(self.serial_inputs.items()):
+            if name not in serial_ports:
+                self.logger.info("- removing serial input {}".format(name))
+                self.close_serial_input(source)
+        for port in serial_ports - set(self.serial_inputs):
+            self.logger.info("- adding serial input {}".format(port))
+            if serial is None:
+                self.logger.error("ERROR| can not add serial input {}: pyserial library not found".format(port))
+                continue
+            try:
+                self.connect_serial_input(port)
+            except (serial.serialutil.SerialException, OSError) as e:
+                self.logger.error("ERROR| can not add serial input {}: {}".format(port, e))
+
+    def update_output_settings(self, batch_size, interval, backlog_size, overflow_policy):
+        """ change the batching settings of the running outputs, the writer threads pick them up on their next loop """
+        self.elastic_batch_size = batch_size
+        self.elastic_interval = interval
+        self.elastic_backlog_size = backlog_size
+        self.elastic_backlog_policy = overflow_policy
+        for sink in self.outputs:
+            if isinstance(sink, BatchingSink):
+                sink.batch_size = batch_size
+                sink.interval = interval
+                sink.max_backlog_size = backlog_size
+                sink.overflow_policy = overflow_policy
+        if self.aggregator is not None:
+            self.aggregator.window = interval
+
+    def request_stop(self, signum=None, frame=None):
+        """ SIGTERM handler, run() returns after the next event loop iteration and the caller calls stop() """
+        self.running = False
 
-    def set_logger(self, logger):
-        self.logger = logger
+    def request_reload(self, signum=None, frame=None):
+        """ SIGHUP handler, the config file is reloaded by the next watch_config timer """
+        self.reload_requested = True
 
-    def connect_serial_input(self, serial_port_input):
-        serial_port = serial.Serial(serial_port_input, 115200, timeout=1)
-        self.p1serial_ports.append(serial_port)
+    def watch_config(self):
+        """ timer in the event loop: reload the config file after SIGHUP or when it changed on disk """
+        if self.reload_requested or self.config.changed():
+            self.reload_requested = False
+            self.config_reload()
+        self.call_later(self.config_check_interval, self.watch_config)
 
-    def connect_tcp_input(self, host, port):
-        port = int(port)
-        if port < 1 or port > 65535:
-            raise ValueError("not a valid port: {}".format(port))
-        s = socket.socket()
-        s.settimeout(self.socket_stall_detect_timeout)
-        s.connect((host, port))
-        self.p1hosts.append(s)
-        self.p1host_last_data_time[(s.getpeername()[0], s.getpeername()[1])] = datetime.datetime.now()
-
-    def reconnect_tcp_input(self, existing_socket):
-        (existing_host, existing_port) = existing_socket.getpeername()
-        s = socket.socket()
-        s.settimeout(self.socket_stall_detect_timeout)
-        try:
-            s.connect((existing_host, existing_port))
-        except socket.timeout:
-            del s
-            return
-        except OSError:
-            del s
-            return
+    def reconnect_tcp_input(self, source, reason):
+        """
+        close a tcp input and connect again after the backoff delay
+
+        consecutive_failures is only reset when data arrives, so a host that accepts and closes the connection
+        right away backs off like a host that refuses it
+        """
+        self.close_tcp_input(source)
+        source.consecutive_failures += 1
+        delay = self.reconnect_delay(source.consecutive_failures)
+        self.logger.warning("WARNING| host {} {}, reconnecting in {:.1f} seconds".format(source.name, reason, delay))
+        source.retry_timer = self.call_later(delay, self.start_tcp_connect, source)
+
+    def reconnect_stats(self):
+        """ reconnect attempts and connect latency per tcp input, including the inputs of worker processes """
+        stats = {source.name: source.stats() for source in self.tcp_inputs.values()}
+        for worker_stats in list(self.worker_stats.values()):
+            stats.update(worker_stats["reconnects"])
+        return stats
 
-        for sock in self.p1hosts:
-            if sock.getpeername()[0] == existing_host and sock.getpeername()[1] == existing_port:
-                self.logger.debug("Socket already exists, deleting before reconnecting")
-                self.p1hosts.remove(sock)
-        self.p1hosts.append(s)
-        self.p1host_last_data_time[(s.getpeername()[0], s.getpeername()[1])] = datetime.datetime.now()
+    def input_stats(self):
+        """ accepted, crc failed and truncated telegram counters per input, including worker processes """
+        stats = {source.name: source.framer.stats()
+                 for inputs in (self.serial_inputs, self.tcp_inputs) for source in inputs.values()}
+        for worker_stats in list(self.worker_stats.values()):
+            stats.update(worker_stats["inputs"])
+        return stats
+
+    def worker_stats_snapshot(self):
+        """ the counters a worker process sends to the supervisor """
+        output_dropped = sum(sink.dropped for sink in self.outputs)
+        return {"inputs": self.input_stats(), "reconnects": self.reconnect_stats(),
+                "parsed": self.parsed_telegrams, "parse_seconds": self.parse_seconds,
+                "dropped": self.dropped_telegrams + output_dropped}
+
+    def add_output(self, sink):
+        self.outputs.append(sink)
+
+    def open_spool(self, name):
+        """ returns the disk spool for an output, or None when spooling is off """
+        if self.spool_dir is None:
+            return None
+        spool = DiskSpool(os.path.join(self.spool_dir, name), max_size=self.spool_size)
+        if len(spool):
+            self.logger.info("- {} spool has {} documents to replay".format(name, len(spool)))
+        return spool
 
     def connect_elastic_output(self, host, port):
+        elasticsearch = import_optional('elasticsearch')
         port = int(port)
         if port < 1 or port > 65535:
             raise ValueError("elastic host port {} is not a valid port ".format(port))
@@ -183,137 +2375,906 @@ class DsmrExporter:
         except elasticsearch.exceptions.TransportError:
             self.logger.info("warning: elasticsearch not sniffable, continuing without sniffing")
             self.elastic_host = elasticsearch.Elasticsearch([host + ':' + str(port)])
-        # todo: index template upload
+        self.elastic_output = ElasticBulkSink(self.elastic_host, self.elastic_index, self.logger,
+                                              batch_size=self.elastic_batch_size,
+                                              interval=self.elastic_interval,
+                                              backlog_size=self.elastic_backlog_size,
+                                              overflow_policy=self.elastic_backlog_policy,
+                                              queue_size=self.queue_size,
+                                              spool=self.open_spool(ElasticBulkSink.name),
+                                              template=self.elastic_template,
+                                              rollover=self.elastic_rollover,
+                                              retention_days=self.elastic_retention,
+                                              synthetic_source=self.elastic_synthetic_source)
+        self.add_output(self.elastic_output)
 
-    def telegram_to_json(self, telegram):
-        # todo: detect if input is ok
-        doc = {'@timestamp': datetime.datetime.now(datetime.timezone.utc)}
-        self.logger.debug("DEBUG| telegram {}".format(telegram))
+    def telegram_to_json(self, telegram, received=None):
+        if received is None:
+            doc = {'@timestamp': datetime.datetime.now(datetime.timezone.utc)}
+        else:
+            doc = {'@timestamp': datetime.datetime.fromtimestamp(received, datetime.timezone.utc)}
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug("DEBUG| telegram %s", telegram)
+        converters = OBIS_CONVERTERS
+        cached_codes = self.obis_cached_codes
+        cache_trial = self.obis_cache_trial
+        line_cache = self.obis_line_cache
         for item in telegram:
-            validated_data = self.re_validate_telegram_line.search(item)
-            if validated_data:
-                key, value = validated_data.groups()
-                value = value.split('*')[0]
-                try:
-                    value = float(value)
-                except ValueError:
-                    pass
-                doc[key] = value
-        self.logger.debug("DEBUG| doc={}".format(doc))
-        self.logger.debug("DEBUG| telegram_to_json --------------------------------------------")
+            key, _, value = item.partition('(')
+            cached = key in cached_codes
+            if cached:
+                fields = line_cache.get(item)
+                if key in cache_trial:
+                    cached = self.count_cache_lookup(key, fields is not None)
+                if fields is not None:
+                    doc.update(fields)
+                    continue
+            convert = converters.get(key)
+            if convert is None:
+                if not self.re_validate_obis_code.match(key):
+                    continue
+                convert = obis_generic
+            if value[-1:] != ')':
+                continue
+            fields = {}
+            try:
+                convert(fields, key, value[:-1].split(')('))
+            except (ValueError, IndexError, KeyError):
+                if debug:
+                    self.logger.debug("DEBUG| invalid value for %s: %s", key, value)
+                continue
+            doc.update(fields)
+            if cached:
+                if len(line_cache) >= self.obis_line_cache_size:
+                    line_cache.clear()
+                line_cache[item] = fields
+        if debug:
+            self.logger.debug("DEBUG| doc=%s", doc)
+            self.logger.debug("DEBUG| telegram_to_json --------------------------------------------")
         return doc
 
+    def count_cache_lookup(self, key, hit):
+        """
+        whether a line repeats depends on the meter and its load: identifiers, settings and gas repeat, power at 1 W
+        resolution rarely does.  After its first obis_cache_trial_size lookups a code stays cached only when most of
+        them were hits, the other codes are decoded every time without filling the cache.  Returns whether key stays
+        cached.
+        """
+        counts = self.obis_cache_trial[key]
+        counts[0] += 1
+        counts[1] += hit
+        if counts[0] >= self.obis_cache_trial_size:
+            del self.obis_cache_trial[key]
+            if counts[1] * 2 < counts[0]:
+                self.obis_cached_codes.discard(key)
+                prefix = key + "("
+                for line in [line for line in self.obis_line_cache if line.startswith(prefix)]:
+                    del self.obis_line_cache[line]
+                return False
+        return True
+
     def doc_put(self, doc):
-        index_and_date = datetime.datetime.now(datetime.timezone.utc).strftime(self.elastic_index)
-        self.logger.debug("DEBUG| index_and_date: {}".format(index_and_date))
-        try:
-            res = self.elastic_host.index(index=str(index_and_date), body=doc)
-        except elasticsearch.exceptions.ConnectionError as e:
-            self.logger.error("elastic connection error: {}".format(e))
-            res = None
-            # todo: with backlog buffer
-        if res:
-            result = res.get("result")
-            if result != "created":
-                print(result)
-        else:
-            print('!', end='')
+        """ hand a document to every output """
+        for sink in self.outputs:
+            sink.submit(doc)
+
+    def publish(self, doc):
+        """ hand a parsed telegram to the outputs, through the aggregator when aggregation is enabled """
+        if self.aggregator is None:
+            self.doc_put(doc)
+            return
+        for sink in self.outputs:
+            if sink.latest_values:
+                sink.submit(doc)
+        for window_doc in self.aggregator.add(doc):
+            self.doc_put_aggregated(window_doc)
+
+    def doc_put_aggregated(self, doc):
+        for sink in self.outputs:
+            if not sink.latest_values:
+                sink.submit(doc)
+
+    def flush_aggregator(self, expired=True):
+        """ hand the finished windows (or all windows) to the outputs, only from the thread that calls publish """
+        for window_doc in self.aggregator.flush_expired() if expired else self.aggregator.flush_all():
+            self.doc_put_aggregated(window_doc)
 
     def run(self):
+        self.running = True
+        self.start_pipeline()
+        if self.prometheus is not None:
+            self.update_prometheus_internals()
+        if self.profile_interval:
+            if self.profile_sampling:
+                self.profiler = SamplingProfiler()
+                self.profiler.start()
+            self.call_later(self.profile_interval, self.log_profile)
+        if self.config is not None:
+            self.call_later(self.config_check_interval, self.watch_config)
+        self.call_later(self.stall_check_interval, self.check_stalls)
+        while self.running:
+            timeout = self.run_timers()
+            for key, _ in self.selector.select(timeout):
+                key.data(key.fileobj)
+
+    def stop_loop(self):
+        """ make run() return, call it from the event loop (with call_later) """
+        self.running = False
+
+    def read_tcp_input(self, s):
+        source = self.sources.get(s.fileno())
+        if source is None:
+            # closed by an earlier callback of the same select
+            return
+        read_start = time.perf_counter()
+        try:
+            input_buffer = s.recv(self.tcp_buffer_size)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.reconnect_tcp_input(source, "read error ({})".format(e))
+            return
+        if not input_buffer:
+            self.reconnect_tcp_input(source, "closed the connection")
+            return
+        self.stages["read"].observe(time.perf_counter() - read_start)
+        # todo: rate limit wrong data?
+        source.last_data = time.monotonic()
+        source.consecutive_failures = 0
+        self.handle_input_data(source, input_buffer)
+
+    def read_serial_input(self, serial_port):
+        source = self.sources.get(serial_port.fileno())
+        if source is None:
+            return
+        read_start = time.perf_counter()
+        try:
+            input_buffer = serial_port.read(self.tcp_buffer_size)
+        except serial.serialutil.SerialException as e:
+            self.logger.error("ERROR| serial port {} read error, closing: {}".format(source.name, e))
+            self.close_serial_input(source)
+            return
+        if not input_buffer:
+            return
+        self.stages["read"].observe(time.perf_counter() - read_start)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("DEBUG| serial data for port %s\n%s", source.name, input_buffer)
+        source.last_data = time.monotonic()
+        self.handle_input_data(source, input_buffer)
+
+    def handle_input_data(self, source, input_buffer):
+        framer = source.framer
+        stages = self.stages
+        frame_start = time.perf_counter()
+        raw_telegrams = framer.feed(input_buffer)
+        stages["frame"].observe(time.perf_counter() - frame_start)
+        for raw_telegram in raw_telegrams:
+            crc_start = time.perf_counter()
+            valid = framer.verify(raw_telegram)
+            stages["crc"].observe(time.perf_counter() - crc_start)
+            if not valid:
+                self.warnings.warning(("crc", source.name), "WARNING| crc error for input %s, telegram skipped",
+                                      source.name)
+                continue
+            self.enqueue_telegram(source, raw_telegram)
+
+    def start_pipeline(self):
+        """ start the parser stage and the outputs, joined to the input reader by bounded queues """
+        self.parse_queue = queue.Queue(self.queue_size)
+        if self.derived_metrics:
+            self.derived = DerivedMetrics(self.logger)
+        if self.capture_dir is not None:
+            self.capture = TelegramCapture(self.capture_dir, self.capture_name, self.capture_interval)
+        self.pipeline_threads = [threading.Thread(target=self.parse_loop, name="dsmr-parser", daemon=True)]
+        for thread in self.pipeline_threads:
+            thread.start()
+        for sink in self.outputs:
+            sink.start()
+
+    def stop_pipeline(self, timeout=10):
+        if not self.pipeline_threads:
+            return
+        try:
+            self.parse_queue.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        for thread in self.pipeline_threads:
+            thread.join(timeout)
+        self.pipeline_threads = []
+        if self.capture is not None:
+            self.capture.close()
+        for sink in self.outputs:
+            sink.stop(timeout)
+
+    def enqueue_telegram(self, source, raw_telegram):
+        """ hand a telegram to the parser stage, never blocks the input reader """
+        enqueue_start = time.perf_counter()
+        try:
+            self.parse_queue.put_nowait((source.labels, raw_telegram, time.time()))
+            self.stages["enqueue"].observe(time.perf_counter() - enqueue_start)
+        except queue.Full:
+            self.dropped_telegrams += 1
+            self.warnings.warning("parse queue", "WARNING| parse queue full, telegram of input %s dropped",
+                                  source.name)
+
+    def stage_timers(self):
+        """ the timers of the input and parse stages and of every output """
+        timers = dict(self.stages)
+        for sink in self.outputs:
+            timers.update(sink.stage_timers())
+        return timers
+
+    def log_profile(self):
+        """ --profile report, runs from the event loop every profile_interval seconds """
+        for stage, timer in self.stage_timers().items():
+            stats = timer.stats()
+            self.logger.info("PROFILE| %-24s count %9d  mean %9.3fms  p50 <%8.3fms  p99 <%8.3fms  max %9.3fms",
+                             stage, stats["count"], stats["mean"] * 1000, stats["p50"] * 1000, stats["p99"] * 1000,
+                             stats["max"] * 1000)
+        self.logger.info("PROFILE| queues %s, dropped telegrams %d", self.queue_depths(), self.dropped_telegrams)
+        if self.profiler is not None:
+            self.logger.info("PROFILE| sampled functions\n%s", self.profiler.report())
+        self.call_later(self.profile_interval, self.log_profile)
+
+    def queue_depths(self):
+        depths = {"parse": self.parse_queue.qsize() if self.parse_queue else 0}
+        for sink in self.outputs:
+            depths[sink.name] = sink.queue.qsize()
+        return depths
+
+    def output_stats(self):
+        """ sent, failed and dropped documents and the backlog size per output """
+        return {sink.name: dict(sink.stats(), backlog=sink.backlog_size()) for sink in self.outputs}
+
+    def parse_telegram(self, labels, raw_telegram, received=None):
+        try:
+            lines = raw_telegram.decode().split()
+        except UnicodeDecodeError:
+            self.logger.debug("DEBUG| decode error for input %s", labels)
+            return None
+        telegram = [line for line in lines if "(" in line and ")" in line]
+        doc = self.telegram_to_json(telegram, received)
+        if doc is not None:
+            doc.update(labels)
+            if self.derived is not None:
+                self.derived.add(doc)
+        return doc
+
+    def parse_loop(self):
+        # with workers the receiver thread of the supervisor publishes, and expires the aggregation windows
+        aggregator = self.aggregator if self.supervisor is None else None
+        timeout = None if aggregator is None else aggregator.window
+        next_expiry_check = time.monotonic()
         while 1:
-            read_sockets = select.select(self.p1hosts + self.p1serial_ports, [], [], self.socket_stall_detect_timeout)[
-                0]
-            self.logger.debug("DEBUG| read_sockets: {}".format(read_sockets))
-            if read_sockets:
-                for s in read_sockets:
+            try:
+                item = self.parse_queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+            if item is None:
+                if aggregator is not None:
+                    self.flush_aggregator(expired=False)
+                return
+            if item:
+                if self.capture is not None:
                     try:
-                        if type(s).__name__ == "Serial":
-                            input_buffer = s.read(self.tcp_buffer_size).decode()
-                            self.logger.debug("DEBUG| serial data for port {}\n{}".format(s.port, input_buffer))
-                        else:
-                            input_buffer = s.recv(self.tcp_buffer_size).decode()
-                            # todo: rate limit wrong data?
-                            self.logger.debug("DEBUG| read_sockets: {}".format(read_sockets))
-                            self.reset_p1host_timeout(s)
-                    except TimeoutError:
-                        if type(s).__name__ == "Serial":
-                            self.logger.debug("DEBUG| serial timeout for port {}".format(s.port))
-                        else:
-                            self.reconnect_tcp_input(s)
-                        continue
-                    except UnicodeDecodeError:
-                        if type(s).__name__ == "Serial":
-                            self.logger.debug("DEBUG| decode error for serial port {}".format(s.port))
-                        else:
-                            self.logger.debug("DEBUG| decode error for host {}:{}".format(s.getpeername()[0], s.getpeername()[1]))
-                        continue
-                    telegram = []
-                    for line in input_buffer.split():
-                        if line.startswith('/'):
-                            telegram = []
-                        elif line.startswith('!'):
-                            doc = self.telegram_to_json(telegram)
-                            if doc is not None:
-                                if type(s).__name__ == "Serial":
-                                    doc["serial.port"] = s.port
-                                else:
-                                    doc["host.name"] = s.getpeername()[0]
-                                    doc["host.port"] = s.getpeername()[1]
-                                try:
-                                    self.doc_put(doc)
-                                except elasticsearch.exceptions.TransportError:
-                                    self.logger.error("elastic backpressure 429 NOT_IMPLEMENTED")
-                                    # TransportError(429
-                            telegram = []
-                        elif "(" in line and ")" in line:
-                            telegram.append(line)
+                        self.capture.write(item[2], *item[:2])
+                    except OSError as e:
+                        self.logger.error("ERROR| capture file {} not written: {}".format(self.capture.path, e))
+                        self.capture.close()
+                parse_start = time.perf_counter()
+                doc = self.parse_telegram(*item)
+                parse_seconds = time.perf_counter() - parse_start
+                self.parse_seconds += parse_seconds
+                self.stages["parse"].observe(parse_seconds)
+                self.parsed_telegrams += 1
+                if doc is not None:
+                    self.publish(doc)
+            if aggregator is not None and time.monotonic() >= next_expiry_check:
+                next_expiry_check = time.monotonic() + aggregator.window
+                self.flush_aggregator()
 
+    def check_stalls(self):
+        """ stall detection timer, reconnects tcp inputs that stopped sending data and warns about serial ports """
+        now = time.monotonic()
+        for source in self.stall_wheel.expired(now):
+            deadline = source.last_data + self.socket_stall_detect_timeout
+            if deadline > now:
+                self.stall_wheel.schedule(source, deadline)
+            elif source.address is None:
+                self.logger.warning("WARNING| serial port {} didn't receive data in a timely fassion".format(
+                    source.name))
+                self.stall_wheel.schedule(source, now + self.socket_stall_detect_timeout)
             else:
-                self.logger.warning("WARNING| run didn't receive data in a timely fassion")
-            self.check_p1host_timeout()
-            time.sleep(1)
-
-    def check_p1host_timeout(self):
-        socket_stall_detect_timeout = datetime.timedelta(seconds=self.socket_stall_detect_timeout)
-        for s in self.p1hosts:
-            self.logger.debug(
-                "DEBUG| check_p1host_timeout[{}:{}]: delta {}".format(s.getpeername()[0], s.getpeername()[1],
-                                                                      self.p1host_last_data_time[
-                                                                          (s.getpeername()[0],s.getpeername()[1])]
-                                                                      + socket_stall_detect_timeout)
-            )
-            if (self.p1host_last_data_time[(s.getpeername()[0],s.getpeername()[1])] + socket_stall_detect_timeout) < datetime.datetime.now():
-                self.logger.warning("WARNING| host {} timeout, reconnecting".format(s))
-                self.reconnect_tcp_input(s)
-
-    def reset_p1host_timeout(self, peer_socket):
-        (host, port) = peer_socket.getpeername()
-        self.p1host_last_data_time[(host, port)] = datetime.datetime.now()
-        self.logger.debug("DEBUG| reset_p1host_timeout reset for {}".format((host, port)))
+                self.reconnect_tcp_input(source, "timeout")
+        self.call_later(self.stall_check_interval, self.check_stalls)
+
+    def update_prometheus_internals(self):
+        """ snapshot the exporter internals for prometheus, runs from the event loop every prometheus_interval """
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                if labels:
+                    lines.append("{}{{{}}} {}".format(name, prometheus_labels(labels), value))
+                else:
+                    lines.append("{} {}".format(name, value))
+
+        def histogram(name, help_text, timers):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} histogram".format(name))
+            for stage, timer in timers.items():
+                cumulative = 0
+                for bound, count in zip(timer.buckets + ("+Inf",), timer.counts):
+                    cumulative += count
+                    lines.append("{}_bucket{{stage=\"{}\",le=\"{}\"}} {}".format(name, stage, bound, cumulative))
+                lines.append("{}_sum{{stage=\"{}\"}} {}".format(name, stage, timer.total))
+                lines.append("{}_count{{stage=\"{}\"}} {}".format(name, stage, timer.count))
+
+        def summary(name, help_text, total, count):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} summary".format(name))
+            lines.append("{}_sum {}".format(name, total))
+            lines.append("{}_count {}".format(name, count))
+
+        input_stats = self.input_stats()
+        metric("dsmr_exporter_telegrams_total", "counter", "telegrams per input and result",
+               [((("input", name), ("result", result)), value)
+                for name, stats in input_stats.items() for result, value in stats.items()])
+        reconnect_stats = self.reconnect_stats()
+        for stat, kind in (("attempts", "counter"), ("connects", "counter"), ("failures", "counter"),
+                           ("consecutive_failures", "gauge")):
+            metric("dsmr_exporter_tcp_connect_{}{}".format(stat, "_total" if kind == "counter" else ""), kind,
+                   "tcp input connect {}".format(stat.replace('_', ' ')),
+                   [((("input", name),), stats[stat]) for name, stats in reconnect_stats.items()])
+        metric("dsmr_exporter_tcp_connect_latency_seconds", "gauge", "duration of the last successful tcp connect",
+               [((("input", name),), stats["last_connect_latency"]) for name, stats in reconnect_stats.items()
+                if stats["last_connect_latency"] is not None])
+        metric("dsmr_exporter_queue_depth", "gauge", "items waiting per pipeline stage",
+               [((("stage", stage),), depth) for stage, depth in self.queue_depths().items()])
+        worker_stats = list(self.worker_stats.values())
+        metric("dsmr_exporter_dropped_telegrams_total", "counter", "telegrams dropped because a queue was full",
+               [((), self.dropped_telegrams + sum(stats["dropped"] for stats in worker_stats))])
+        summary("dsmr_exporter_parse_seconds", "time spent parsing telegrams",
+                self.parse_seconds + sum(stats["parse_seconds"] for stats in worker_stats),
+                self.parsed_telegrams + sum(stats["parsed"] for stats in worker_stats))
+        histogram("dsmr_exporter_stage_seconds", "duration per pipeline stage", self.stage_timers())
+        if self.supervisor is not None:
+            metric("dsmr_exporter_worker_restarts_total", "counter", "restarts per worker process",
+                   [((("worker", worker),), self.supervisor.restarts[worker])
+                    for worker in range(len(self.supervisor.shards))])
+        output_stats = self.output_stats()
+        metric("dsmr_exporter_output_documents_total", "counter", "documents per output and result",
+               [((("output", name), ("result", result)), stats[result])
+                for name, stats in output_stats.items() for result in ("sent", "failed", "dropped")])
+        metric("dsmr_exporter_output_backlog", "gauge", "documents waiting in the backlog of an output",
+               [((("output", name),), stats["backlog"]) for name, stats in output_stats.items()])
+        for sink in self.outputs:
+            if isinstance(sink, BatchingSink):
+                summary("dsmr_exporter_{}_request_seconds".format(sink.name),
+                        "duration of {} output requests".format(sink.name), sink.request_seconds, sink.requests)
+        if self.elastic_output is not None:
+            metric("dsmr_exporter_output_latency_seconds", "gauge",
+                   "age of the oldest document of the last acknowledged elasticsearch batch",
+                   [((), self.elastic_output.latency)])
+        self.prometheus.set_internal_metrics("\n".join(lines) + "\n")
+        self.call_later(self.prometheus_interval, self.update_prometheus_internals)
 
     def stop(self):
-        for s in self.p1hosts:
-            try:
-                s.close()
-            except:
-                pass
-        for sp in self.p1serial_ports:
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.resolver is not None:
+            self.resolver.shutdown(wait=False, cancel_futures=True)
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        self.stop_pipeline()
+        for source in self.tcp_inputs.values():
+            self.cancel_timer(source.retry_timer)
+            if source.connecting is not None:
+                source.connecting.close()
+        for source in self.sources.values():
             try:
-                sp.close()
+                source.fileobj.close()
             except:
                 pass
+        self.selector.close()
         try:
             self.elastic_host.close()
         except:
             pass
 
 
+def run_worker(worker, serial_inputs, tcp_inputs, documents, settings, logger_name, log_level):
+    """ entry point of a worker process: read and parse a share of the inputs, forward the documents """
+    logger = logging.getLogger(logger_name)
+    logger.setLevel(log_level)
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    # don't wait for the supervisor to read the last batches when exiting
+    documents.cancel_join_thread()
+    de = DsmrExporter()
+    de.set_logger(logger)
+    for name, value in settings.items():
+        setattr(de, name, value)
+    de.capture_name = "p1-worker{}".format(worker)
+    de.add_output(ForwardSink(documents, worker, logger, queue_size=de.queue_size))
+    for serial_port in serial_inputs:
+        de.connect_serial_input(serial_port)
+    for host, port in tcp_inputs:
+        de.connect_tcp_input(host, port)
+
+    def send_stats():
+        try:
+            documents.put_nowait(("stats", worker, de.worker_stats_snapshot()))
+        except queue.Full:
+            pass
+        de.call_later(WorkerSupervisor.stats_interval, send_stats)
+
+    de.call_later(WorkerSupervisor.stats_interval, send_stats)
+    # the supervisor stops workers with SIGTERM, close the capture file like on ctrl-c
+    signal.signal(signal.SIGTERM, de.request_stop)
+    try:
+        de.run()
+    except KeyboardInterrupt:
+        pass
+    de.stop()
+
+
+class WorkerSupervisor:
+    """
+    spreads the inputs over worker processes
+
+    every worker reads and parses its share of the inputs and sends the documents in batches over its own
+    multiprocessing queue to this process.  A reader thread per queue passes them on to one receiver thread,
+    which hands them to the outputs of the exporter (aggregation runs in that thread only).  Workers that exit
+    are restarted after restart_delay seconds with a new queue, the others keep running: a worker killed while
+    writing to its queue can leave the lock of the queue held or a message cut off, only its old reader hangs
+    on that.  Workers are spawned, not forked, because the supervisor runs output threads when it restarts one.
+    """
+    stats_interval = 1
+    restart_delay = 5
+    context = multiprocessing.get_context("spawn")
+
+    def __init__(self, exporter, serial_inputs, tcp_inputs, workers, logger, queue_size=1000):
+        self.exporter = exporter
+        self.logger = logger
+        shards = [([], []) for _ in range(workers)]
+        for index, serial_port in enumerate(serial_inputs):
+            shards[index % workers][0].append(serial_port)
+        for index, host in enumerate(tcp_inputs, len(serial_inputs)):
+            shards[index % workers][1].append(host)
+        self.shards = [shard for shard in shards if shard[0] or shard[1]]
+        self.queue_size = queue_size
+        self.queues = {}
+        self.readers = {}
+        self.received = queue.Queue(queue_size)
+        self.processes = {}
+        self.restarts = collections.Counter()
+        self.restarting = set()
+        self.receiver = None
+        self.settings = {}
+
+    def start(self):
+        self.settings = {name: getattr(self.exporter, name) for name in (
+            'socket_stall_detect_timeout', 'reconnect_min_delay', 'reconnect_max_delay', 'tcp_buffer_size',
+            'queue_size', 'profile_interval', 'profile_sampling', 'capture_dir', 'capture_interval',
+            'derived_metrics')}
+        self.receiver = threading.Thread(target=self.receive_loop, name="dsmr-receiver", daemon=True)
+        self.receiver.start()
+        for worker in range(len(self.shards)):
+            self.start_worker(worker)
+        self.exporter.call_later(self.stats_interval, self.check_workers)
+
+    def start_worker(self, worker):
+        self.restarting.discard(worker)
+        serial_inputs, tcp_inputs = self.shards[worker]
+        documents = self.queues[worker] = self.context.Queue(self.queue_size)
+        process = self.context.Process(target=run_worker, name="dsmr-worker-{}".format(worker), daemon=True,
+                                          args=(worker, serial_inputs, tcp_inputs, documents, self.settings,
+                                                self.logger.name, self.logger.getEffectiveLevel()))
+        process.start()
+        reader = self.readers[worker] = threading.Thread(target=self.read_worker, args=(worker, documents),
+                                                         name="dsmr-receiver-{}".format(worker), daemon=True)
+        reader.start()
+        self.processes[worker] = process
+        self.logger.info("- worker {} (pid {}) inputs: {}".format(
+            worker, process.pid, ", ".join(serial_inputs + ["{}:{}".format(*host) for host in tcp_inputs])))
+
+    def check_workers(self):
+        """ timer in the event loop of the supervisor, schedules a restart for workers that exited """
+        for worker, process in self.processes.items():
+            if process.exitcode is not None and worker not in self.restarting:
+                self.logger.warning("WARNING| worker {} exited with code {}, restarting in {}s".format(
+                    worker, process.exitcode, self.restart_delay))
+                self.restarting.add(worker)
+                self.restarts[worker] += 1
+                self.exporter.call_later(self.restart_delay, self.start_worker, worker)
+        self.exporter.call_later(self.stats_interval, self.check_workers)
+
+    def read_worker(self, worker, documents):
+        """ reader thread of the queue of one worker, ends when the worker got a new queue or on stop """
+        while 1:
+            try:
+                message = documents.get(timeout=self.stats_interval)
+            except queue.Empty:
+                if self.queues.get(worker) is not documents:
+                    break
+                continue
+            self.received.put(message)
+        documents.close()
+
+    def receive_loop(self):
+        aggregator = self.exporter.aggregator
+        timeout = None if aggregator is None else aggregator.window
+        next_expiry_check = time.monotonic()
+        while 1:
+            try:
+                message = self.received.get(timeout=timeout)
+            except queue.Empty:
+                message = False
+            if message is None:
+                if aggregator is not None:
+                    self.exporter.flush_aggregator(expired=False)
+                return
+            if message:
+                kind, worker, payload = message
+                if kind == "documents":
+                    for doc in payload:
+                        self.exporter.publish(doc)
+                else:
+                    self.exporter.worker_stats[worker] = payload
+            if aggregator is not None and time.monotonic() >= next_expiry_check:
+                next_expiry_check = time.monotonic() + aggregator.window
+                self.exporter.flush_aggregator()
+
+    def stop(self, timeout=10):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout)
+        # the readers pass on what the workers sent before they stopped
+        self.queues = {}
+        deadline = time.monotonic() + timeout
+        for reader in self.readers.values():
+            reader.join(max(deadline - time.monotonic(), 0))
+        if self.receiver is not None:
+            self.received.put(None)
+            self.receiver.join(timeout)
+            self.receiver = None
+
+
+class ConfigFile:
+    """
+    ini file with the long command line options in a [dsmr_exporter] section, like
+
+        [dsmr_exporter]
+        p1-host = 192.168.1.10:8088,192.168.1.11:8088
+        elastic-interval = 10
+    """
+    section = "dsmr_exporter"
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+
+    def read(self):
+        parser = configparser.ConfigParser(interpolation=None)
+        with open(self.path) as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            parser.read_file(f)
+        if not parser.has_section(self.section):
+            return {}
+        return dict(parser.items(self.section))
+
+    def changed(self):
+        try:
+            return os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return False
+
+    @staticmethod
+    def defaults(ap, values):
+        """ argparse defaults for the values of the config file, unknown options raise ValueError """
+        actions = {option[2:]: action for action in ap._actions for option in action.option_strings
+                   if option.startswith('--')}
+        defaults = {}
+        for key, value in values.items():
+            action = actions.get(key)
+            if action is None or key == 'config':
+                raise ValueError("unknown option '{}'".format(key))
+            if action.nargs == 0:
+                defaults[action.dest] = value.strip().lower() in ('1', 'yes', 'true', 'on')
+            elif isinstance(action, argparse._AppendAction):
+                defaults[action.dest] = [value]
+            else:
+                defaults[action.dest] = value
+        return defaults
+
+
+def parse_p1_hosts(values):
+    """ {(host, port number): None} for the comma separated host:port lists of --p1-host, ValueError when not valid """
+    p1_hosts = {}
+    for hosts in values:
+        if hosts is not None:
+            for host in hosts.split(','):
+                host = host.strip()
+                if host == '':
+                    continue
+                try:
+                    # TODO: regex instead split, create more robust input checking
+                    name, port = host.split(':')
+                    port = int(port)
+                except ValueError:
+                    raise ValueError("host not parsable {}".format(host))
+                if port < 1 or port > 65535:
+                    raise ValueError("not a valid port: {}".format(host))
+                p1_hosts[(name, port)] = None
+    return p1_hosts
+
+
+def parse_p1_serial(values):
+    return [port.strip() for ports in values if ports is not None for port in ports.split(',') if port.strip()]
+
+
+def parser_defaults(ap):
+    """ the defaults of the options as defined, before a config file changes them """
+    return {action.dest: action.default for action in ap._actions if action.default != argparse.SUPPRESS}
+
+
+def parse_options(ap, defaults, args=None):
+    """
+    parse the command line over defaults (the parser defaults updated with the config file).  Options given on the
+    command line replace the default, also the options that can be given multiple times: argparse would append them
+    to the default list.
+    """
+    appended = [action.dest for action in ap._actions if isinstance(action, argparse._AppendAction)]
+    ap.set_defaults(**defaults)
+    ap.set_defaults(**{dest: [] for dest in appended})
+    options = ap.parse_args(args)
+    for dest in appended:
+        if not getattr(options, dest):
+            setattr(options, dest, defaults[dest])
+    return options
+
+
+def reload_config(de, ap, defaults, options, logger, args=None):
+    """
+    apply a changed config file: inputs are added or removed, batching settings change in place.  A file that is not
+    valid changes nothing.  args is the command line, sys.argv by default.
+    """
+    try:
+        new_options = parse_options(ap, dict(defaults, **ConfigFile.defaults(ap, de.config.read())), args)
+        p1_hosts = parse_p1_hosts(new_options.p1_host)
+    except (OSError, configparser.Error, ValueError) as e:
+        # nothing is applied, the inputs and outputs keep running with the config they have
+        logger.error("ERROR| config file {} not reloaded: {}".format(de.config.path, e))
+        return
+    except SystemExit:
+        logger.error("ERROR| config file {} not reloaded".format(de.config.path))
+        return
+    logger.info("- reloading config file {}".format(de.config.path))
+    reloaded = ['p1_host', 'p1_serial']
+    if de.supervisor is None:
+        de.update_inputs(parse_p1_serial(new_options.p1_serial), p1_hosts.keys())
+    else:
+        reloaded = []
+    if new_options.elastic_interval < 1 or new_options.elastic_batch_size < 1 or \
+            new_options.elastic_backlog_size < new_options.elastic_batch_size:
+        logger.error("ERROR| invalid elastic interval, batch or backlog size, output settings not changed")
+    else:
+        de.update_output_settings(new_options.elastic_batch_size, new_options.elastic_interval,
+                                  new_options.elastic_backlog_size, new_options.elastic_backlog_policy)
+        reloaded += ['elastic_interval', 'elastic_batch_size', 'elastic_backlog_size', 'elastic_backlog_policy']
+    # remember the settings in use, so every reload warns about the settings that still need a restart
+    for name in reloaded:
+        setattr(options, name, getattr(new_options, name))
+    for name, value in sorted(vars(new_options).items()):
+        if value != getattr(options, name):
+            logger.warning("WARNING| {} changed, restart to apply it".format(name.replace('_', '-')))
+
+
+def import_send(sink, batch, attempts=8):
+    """ send one bulk request of an import, retrying backpressure and rejected documents """
+    for attempt in range(attempts):
+        try:
+            batch = sink.send(batch)
+        except OutputError as e:
+            sink.logger.warning("WARNING| elasticsearch {}, retrying".format(e))
+        if not batch:
+            return
+        time.sleep(min(2 ** attempt, 60))
+    sink.failed += len(batch)
+    sink.logger.error("ERROR| {} documents not indexed after {} attempts".format(len(batch), attempts))
+
+
+def import_file(path, settings, derived=None):
+    """
+    frame, parse and index one capture file or p1 log (plain or gzip), runs in an import worker process
+
+    derived carries the previous telegram of every input over from the previous file, returns the path and the
+    counters of the file
+    """
+    logger = logging.getLogger(settings["logger_name"])
+    logger.setLevel(settings["log_level"])
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+    start = time.monotonic()
+    de = DsmrExporter()
+    de.set_logger(logger)
+    de.derived = derived
+    sink = None
+    if not settings["dry_run"]:
+        elasticsearch = import_optional('elasticsearch')
+        sink = ElasticBulkSink(elasticsearch.Elasticsearch([settings["elastic_host"]]), settings["elastic_index"],
+                               logger, template=False, document_time=True)
+    framer = TelegramFramer()
+    default_labels = {"serial.port": settings["input_name"] or path}
+    parse_telegram = de.parse_telegram
+    batch_size = settings["batch_size"]
+    batch = []
+    parsed = 0
+    try:
+        with open(path, 'rb') as f:
+            chunks = gzip_chunks(f) if path.endswith('.gz') else read_chunks(f)
+            for received, labels, data in read_capture(chunks):
+                for raw_telegram in framer.feed(data):
+                    # captured telegrams passed the crc check before they were written, gzip checks the rest
+                    if received is None and not framer.verify(raw_telegram):
+                        continue
+                    doc = parse_telegram(labels or default_labels, raw_telegram, received)
+                    if doc is None:
+                        continue
+                    if received is None and "0-0:1.0.0" in doc:
+                        # a p1 log without capture markers, the meter time is the best receive time
+                        doc['@timestamp'] = doc["0-0:1.0.0"].astimezone(datetime.timezone.utc)
+                    parsed += 1
+                    if sink is not None:
+                        batch.append(sink.prepare(doc))
+                        if len(batch) >= batch_size:
+                            import_send(sink, batch)
+                            batch = []
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        # a capture file that was being written when the exporter stopped ends in the middle of a telegram
+        logger.warning("WARNING| {} read until error: {}".format(path, e))
+    if batch:
+        import_send(sink, batch)
+    result = dict(framer.stats(), parsed=parsed, seconds=time.monotonic() - start)
+    if sink is not None:
+        result.update(indexed=sink.sent, failed=sink.failed)
+    return path, result
+
+
+def import_files(paths, settings):
+    """ import files one after the other in one import worker process, the derived fields continue across files """
+    logger = logging.getLogger(settings["logger_name"])
+    derived = DerivedMetrics(logger) if settings["derived"] else None
+    return [import_file(path, settings, derived) for path in paths]
+
+
+def import_groups(paths, input_name=None):
+    """
+    the files of one capture (p1-<start>.gz, p1-worker<n>-<start>.gz in one directory) in time order, so the telegrams
+    of an input reach DerivedMetrics in order.  p1 logs are an input of their own, or together with --input-name.
+    """
+    groups = {}
+    for path in paths:
+        match = CAPTURE_FILE_NAME.match(os.path.basename(path))
+        if match is not None:
+            key = (os.path.dirname(os.path.abspath(path)), match.group(1))
+        else:
+            key = (None, input_name) if input_name else (path, None)
+        groups.setdefault(key, []).append(path)
+    # the largest groups first, so no process is left with a big group at the end
+    return sorted((sorted(group) for group in groups.values()),
+                  key=lambda group: sum(map(os.path.getsize, group)), reverse=True)
+
+
+def import_main(argv):
+    """ dsmr_exporter.py import: index captured telegrams or p1 logs with a process pool """
+    appname = os.path.splitext(os.path.basename(__file__))[0]
+    logger = logging.getLogger(appname)
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    ap = argparse.ArgumentParser(prog="{} import".format(os.path.basename(__file__)),
+                                 description='index capture files (--capture-dir) or p1 logs, plain or gzip, into '
+                                             'elasticsearch.  Documents get the same id as live documents, importing '
+                                             'a file again replaces them.')
+    ap.add_argument('files', nargs='+', help="capture files or p1 logs")
+    ap.add_argument('--elastic-host',
+                    default=os.getenv('ELASTIC_HOST', 'localhost:9200'),
+                    help="elasticsearch_host<:port>\nEnvironment var: ELASTIC_HOST"
+                    )
+    ap.add_argument('--elastic-index', '--index',
+                    default=os.getenv('ELASTIC_INDEX', 'dsmr-%Y.%m'),
+                    help="elasticsearch index name, strftime is applied to the telegram time\n"
+                         "Environment var: ELASTIC_INDEX"
+                    )
+    ap.add_argument('--elastic-batch-size',
+                    type=int,
+                    default=5000,
+                    help="documents in one bulk request"
+                    )
+    ap.add_argument('--elastic-no-template',
+                    action='store_true',
+                    help="don't install the index template"
+                    )
+    ap.add_argument('--processes',
+                    type=int,
+                    default=os.cpu_count(),
+                    help="files imported in parallel, default is the number of cpu cores"
+                    )
+    ap.add_argument('--input-name',
+                    help="serial.port of the telegrams in p1 logs without capture markers, default is the file name"
+                    )
+    ap.add_argument('--derived',
+                    action='store_true',
+                    help="add the derived fields, like the exporter with --derived"
+                    )
+    ap.add_argument('--dry-run',
+                    action='store_true',
+                    help="only read and parse the files"
+                    )
+    ap.add_argument('--debug', '-d',
+                    action="store_true",
+                    help="set log level to debug"
+                    )
+    options = ap.parse_args(argv)
+    if options.debug:
+        logger.setLevel(logging.DEBUG)
+    if options.processes < 1 or options.elastic_batch_size < 1:
+        die("FATAL| processes and batch size must be at least 1")
+    missing = [path for path in options.files if not os.path.isfile(path)]
+    if missing:
+        die("FATAL| files not found: {}".format(", ".join(missing)))
+
+    if not options.dry_run and not options.elastic_no_template:
+        elasticsearch = import_optional('elasticsearch')
+        sink = ElasticBulkSink(elasticsearch.Elasticsearch([options.elastic_host]), options.elastic_index, logger)
+        try:
+            sink.setup_index()
+        except OutputError as e:
+            die("FATAL| elasticsearch {}".format(e))
+
+    settings = {"elastic_host": options.elastic_host, "elastic_index": options.elastic_index,
+                "batch_size": options.elastic_batch_size, "input_name": options.input_name,
+                "derived": options.derived, "dry_run": options.dry_run, "logger_name": logger.name, "log_level": logger.getEffectiveLevel()}
+    if options.derived:
+        groups = import_groups(options.files, options.input_name)
+    else:
+        # the largest files first, so no process is left with a big file at the end
+        groups = [[path] for path in sorted(options.files, key=os.path.getsize, reverse=True)]
+    processes = min(options.processes, len(groups))
+    logger.info("importing {} files with {} processes".format(len(options.files), processes))
+    start = time.monotonic()
+    totals = collections.Counter()
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        for results in pool.imap_unordered(functools.partial(import_files, settings=settings), groups):
+            for path, result in results:
+                totals.update(result)
+                logger.info("- {}: {} telegrams, {} indexed, {} failed, {} crc errors in {:.1f}s".format(
+                    path, result["parsed"], result.get("indexed", 0), result.get("failed", 0),
+                    result["crc_failed"], result["seconds"]))
+    seconds = time.monotonic() - start
+    logger.info("imported {} telegrams in {:.1f}s ({:.0f} telegrams/s), {} indexed, {} failed, {} crc errors".format(
+        totals["parsed"], seconds, totals["parsed"] / max(seconds, 0.001), totals["indexed"], totals["failed"],
+        totals["crc_failed"]))
+    if totals["failed"]:
+        sys.exit(1)
+
+
 def die(text=""):
     sys.stderr.write("ERROR| {}\nexiting.".format(text))
     sys.exit(1)
 
 
 def main():
+    if sys.argv[1:2] == ['import']:
+        import_main(sys.argv[2:])
+        return
     appname = os.path.splitext(os.path.basename(__file__))[0]
     logger = logging.getLogger(appname)
     logger.setLevel(logging.INFO)
@@ -323,7 +3284,7 @@ def main():
     logger.addHandler(console)
     # log.addHandler(logging.handlers.RotatingFileHandler('/var/log/{}.log'.format(progname), maxBytes=100000))
 
-    ap = argparse.ArgumentParser(description='dsmr p1 data exporter to elasticsearch')
+    ap = argparse.ArgumentParser(description='dsmr p1 data exporter to elasticsearch, influxdb, mqtt and prometheus')
     ap.add_argument('--p1-host',
                     action='append',
                     default=[os.getenv('P1_HOST')],
@@ -335,6 +3296,10 @@ def main():
                     default=[os.getenv('P1_SERIAL')],
                     help="serial ports used as p1 data source (multiple times possible)\nEnvironment var: P1_SERIAL"
                     )
+    ap.add_argument('--output',
+                    default=os.getenv('DSMR_OUTPUT', 'elasticsearch'),
+                    help="outputs, comma separated: elasticsearch, influxdb, mqtt, file\nEnvironment var: DSMR_OUTPUT"
+                    )
     ap.add_argument('--elastic-host',
                     default=[os.getenv('ELASTIC_HOST', 'localhost:9200')],
                     help="elasticsearch_host<:port>\nEnvironment var: ELASTIC_HOST"
@@ -349,19 +3314,163 @@ def main():
                     )
     ap.add_argument('--elastic-interval', '-i',
                     type=int,
-                    default=os.getenv('ELASTIC_INTERVAL'),
-                    help="elasticsearch publish interval, minimal is 1\nEnvironment var: ELASTIC_INTERVAL "
-                         "NOT_IMPLEMENTED"
+                    default=os.getenv('ELASTIC_INTERVAL', 1),
+                    help="elasticsearch publish interval in seconds, minimal is 1\nEnvironment var: ELASTIC_INTERVAL"
+                    )
+    ap.add_argument('--aggregate',
+                    action='store_true',
+                    default=os.getenv('DSMR_AGGREGATE'),
+                    help="send one document per input every --elastic-interval seconds instead of every telegram, "
+                         "with the average, minimum and maximum of instantaneous values\nEnvironment var: "
+                         "DSMR_AGGREGATE"
+                    )
+    ap.add_argument('--derived',
+                    action='store_true',
+                    default=os.getenv('DSMR_DERIVED'),
+                    help="add derived fields to every document: energy and gas since the previous telegram, net "
+                         "power, phase imbalance and totals of the day\nEnvironment var: DSMR_DERIVED"
+                    )
+    ap.add_argument('--elastic-batch-size',
+                    type=int,
+                    default=os.getenv('ELASTIC_BATCH_SIZE', 500),
+                    help="maximum number of documents in one bulk request\nEnvironment var: ELASTIC_BATCH_SIZE"
+                    )
+    ap.add_argument('--elastic-backlog-size',
+                    type=int,
+                    default=os.getenv('ELASTIC_BACKLOG_SIZE', 100000),
+                    help="maximum number of documents kept in memory while elasticsearch is unavailable\n"
+                         "Environment var: ELASTIC_BACKLOG_SIZE"
+                    )
+    ap.add_argument('--elastic-backlog-policy',
+                    choices=ElasticBulkSink.overflow_policies,
+                    default=os.getenv('ELASTIC_BACKLOG_POLICY', 'drop-oldest'),
+                    help="documents to drop when the backlog is full\nEnvironment var: ELASTIC_BACKLOG_POLICY"
+                    )
+    ap.add_argument('--spool-dir',
+                    default=os.getenv('DSMR_SPOOL_DIR'),
+                    help="directory for a disk spool per output, documents are written to disk before they are sent "
+                         "and replayed in order after an outage or restart\nEnvironment var: DSMR_SPOOL_DIR"
+                    )
+    ap.add_argument('--spool-size',
+                    type=int,
+                    default=os.getenv('DSMR_SPOOL_SIZE', 1024),
+                    help="maximum size in MB of each output spool, the oldest documents are dropped beyond it\n"
+                         "Environment var: DSMR_SPOOL_SIZE"
+                    )
+    ap.add_argument('--workers',
+                    type=int,
+                    default=os.getenv('DSMR_WORKERS', 1),
+                    help="number of worker processes the inputs are spread over, each worker reads and parses its "
+                         "inputs and sends the documents to the outputs in this process\nEnvironment var: DSMR_WORKERS"
+                    )
+    ap.add_argument('--profile',
+                    type=int,
+                    nargs='?',
+                    const=60,
+                    default=os.getenv('DSMR_PROFILE'),
+                    help="log the duration of every pipeline stage every PROFILE seconds (default 60)\n"
+                         "Environment var: DSMR_PROFILE"
+                    )
+    ap.add_argument('--profile-sampling',
+                    action='store_true',
+                    default=os.getenv('DSMR_PROFILE_SAMPLING'),
+                    help="add the functions seen by a sampling profiler of all threads to the --profile report\n"
+                         "Environment var: DSMR_PROFILE_SAMPLING"
+                    )
+    ap.add_argument('--queue-size',
+                    type=int,
+                    default=os.getenv('DSMR_QUEUE_SIZE', 1000),
+                    help="maximum number of telegrams waiting between the input, parser and writer stages\n"
+                         "Environment var: DSMR_QUEUE_SIZE"
                     )
     ap.add_argument('--elastic-index', '--index',
                     default=os.getenv('ELASTIC_INDEX', 'dsmr-%Y.%m'),
                     help="elasticsearch index name.  Default is 'dsmr-%%Y.%%m', will be parsed with python strftime("
                          "'%%Y.%%m') Environment var: ELASTIC_INDEX"
                     )
+    ap.add_argument('--elastic-no-template',
+                    action='store_true',
+                    default=os.getenv('ELASTIC_NO_TEMPLATE'),
+                    help="don't install the index template, for clusters where the mappings are managed elsewhere\n"
+                         "Environment var: ELASTIC_NO_TEMPLATE"
+                    )
+    ap.add_argument('--elastic-rollover',
+                    action='store_true',
+                    default=os.getenv('ELASTIC_ROLLOVER'),
+                    help="write to an index alias rolled over by an ilm policy (at 10gb or 30 days) instead of a "
+                         "strftime index name, the alias is --elastic-index up to the first %%\n"
+                         "Environment var: ELASTIC_ROLLOVER"
+                    )
+    ap.add_argument('--elastic-retention',
+                    type=int,
+                    default=os.getenv('ELASTIC_RETENTION'),
+                    help="with --elastic-rollover, delete indices this many days after their rollover\n"
+                         "Environment var: ELASTIC_RETENTION"
+                    )
+    ap.add_argument('--elastic-synthetic-source',
+                    action='store_true',
+                    default=os.getenv('ELASTIC_SYNTHETIC_SOURCE'),
+                    help="don't store _source but rebuild it from doc values, needs elasticsearch 8.4 or newer\n"
+                         "Environment var: ELASTIC_SYNTHETIC_SOURCE"
+                    )
     ap.add_argument('--elastic-create-dashboards', '-c',
                     action='store_true',
                     help="uploads the default dashboards into elasticsearch TODO"
                     )
+    ap.add_argument('--influx-url',
+                    default=os.getenv('INFLUX_URL'),
+                    help="influxdb write url, like http://localhost:8086/write?db=dsmr or "
+                         "http://localhost:8086/api/v2/write?org=home&bucket=dsmr\nEnvironment var: INFLUX_URL"
+                    )
+    ap.add_argument('--influx-token',
+                    default=os.getenv('INFLUX_TOKEN'),
+                    help="influxdb 2.x api token\nEnvironment var: INFLUX_TOKEN"
+                    )
+    ap.add_argument('--mqtt-host',
+                    default=os.getenv('MQTT_HOST', 'localhost:1883'),
+                    help="mqtt broker host<:port>\nEnvironment var: MQTT_HOST"
+                    )
+    ap.add_argument('--mqtt-topic',
+                    default=os.getenv('MQTT_TOPIC', 'dsmr'),
+                    help="mqtt topic prefix, documents are published on <topic>/<meter>\nEnvironment var: MQTT_TOPIC"
+                    )
+    ap.add_argument('--output-file',
+                    default=os.getenv('DSMR_OUTPUT_FILE'),
+                    help="file the file output appends json documents to\nEnvironment var: DSMR_OUTPUT_FILE"
+                    )
+    ap.add_argument('--capture-dir',
+                    default=os.getenv('DSMR_CAPTURE_DIR'),
+                    help="write the raw telegrams with their receive time to gzip files in this directory, they can "
+                         "be indexed again with the import command\nEnvironment var: DSMR_CAPTURE_DIR"
+                    )
+    ap.add_argument('--capture-interval',
+                    type=int,
+                    default=int(os.getenv('DSMR_CAPTURE_INTERVAL', '3600')),
+                    help="seconds per capture file\nEnvironment var: DSMR_CAPTURE_INTERVAL"
+                    )
+    ap.add_argument('--prometheus-port',
+                    type=int,
+                    default=os.getenv('PROMETHEUS_PORT'),
+                    help="serve the latest meter values and exporter metrics on http://<host>:<port>/metrics\n"
+                         "Environment var: PROMETHEUS_PORT"
+                    )
+    ap.add_argument('--store-port',
+                    type=int,
+                    default=os.getenv('DSMR_STORE_PORT'),
+                    help="keep the recent values of every meter in memory and serve range queries on "
+                         "http://<host>:<port>/query\nEnvironment var: DSMR_STORE_PORT"
+                    )
+    ap.add_argument('--store-size',
+                    type=int,
+                    default=int(os.getenv('DSMR_STORE_SIZE', '3600')),
+                    help="samples kept per meter in the in-memory store, 8 bytes per field per sample\n"
+                         "Environment var: DSMR_STORE_SIZE"
+                    )
+    ap.add_argument('--config',
+                    default=os.getenv('DSMR_CONFIG'),
+                    help="ini config file with the long options in a [dsmr_exporter] section, inputs and batch "
+                         "settings are reloaded when the file changes or on SIGHUP\nEnvironment var: DSMR_CONFIG"
+                    )
     ap_logging_group = ap.add_mutually_exclusive_group()
     ap_logging_group.add_argument(
         '--quiet', '-q',
@@ -375,7 +3484,17 @@ def main():
         default=os.getenv('DSMR_DEBUG'),
         help="debug output"
     )
-    options = ap.parse_args()
+    defaults = parser_defaults(ap)
+    options = parse_options(ap, defaults)
+    config = None
+    if options.config:
+        config = ConfigFile(options.config)
+        try:
+            options = parse_options(ap, dict(defaults, **ConfigFile.defaults(ap, config.read())))
+        except (OSError, configparser.Error, ValueError) as e:
+            die("FATAL| config file {}: {}".format(options.config, e))
+    # main() changes some options in place, reloads compare with the options as parsed
+    parsed_options = argparse.Namespace(**vars(options))
 
     if options.debug and options.quiet:
         die('FATAL| log option --debug and --quiet can not be used together')
@@ -388,9 +3507,20 @@ def main():
     de.set_logger(logger)
     logger.info("starting {} {}".format(appname, __version__))
 
+    outputs = [output.strip() for output in options.output.split(',') if output.strip()]
+    for output in outputs:
+        if output not in ('elasticsearch', 'influxdb', 'mqtt', 'file'):
+            die("FATAL| unknown output '{}'".format(output))
+    if not outputs and options.prometheus_port is None and options.store_port is None:
+        die("FATAL| no outputs defined")
+
     # SERIAL INPUT
-    import serial.tools.list_ports
-    detected_ports = [tuple(p) for p in list(serial.tools.list_ports.comports())]
+    detected_ports = []
+    if any(options.p1_serial):
+        if serial is None:
+            die("FATAL| pyserial library not found, please install by typing 'pip3 install pyserial'")
+        import serial.tools.list_ports
+        detected_ports = [tuple(p) for p in list(serial.tools.list_ports.comports())]
     available_serial = {}
 
     # filter port path
@@ -398,43 +3528,44 @@ def main():
         available_serial[detected_port[0]] = detected_port[1:]
 
     p1_serial = {}
-    for ports in options.p1_serial:
-        if ports is not None:
-            for port in ports.split(','):
-                if port not in available_serial:
-                    ap.print_usage()
-                    valid_serial = ""
-                    for detected_port in detected_ports:
-                        valid_serial += "    {}{}{}\n".format(detected_port[0].ljust(20), detected_port[1].ljust(20),
-                                                              detected_port[2])
-                    die("FATAL| port {} is not a valid com port\nvalid ports are:\n{}".format(port, valid_serial))
-                else:
-                    p1_serial[port] = available_serial[port]
+    for port in parse_p1_serial(options.p1_serial):
+        if port not in available_serial:
+            ap.print_usage()
+            valid_serial = ""
+            for detected_port in detected_ports:
+                valid_serial += "    {}{}{}\n".format(detected_port[0].ljust(20), detected_port[1].ljust(20),
+                                                      detected_port[2])
+            die("FATAL| port {} is not a valid com port\nvalid ports are:\n{}".format(port, valid_serial))
+        else:
+            p1_serial[port] = available_serial[port]
 
     # TCP INPUT
     # TODO ipv6 ip's
-    # TODO https://docs.python.org/3.6/library/selectors.html#module-selectors
-    p1_hosts = {}
-    for hosts in options.p1_host:
-        if hosts is not None:
-            for host in hosts.split(','):
-                # logger.debug("host={}".format(host))
-                if host == '':
-                    continue
-                try:
-                    # TODO: regex instead split, create more robust input checking
-                    host, port = host.split(':')
-                    p1_hosts[(host, port)] = None
-                except ValueError:
-                    die("FATAL| host not parsable {}".format(host))
-            break
+    try:
+        p1_hosts = parse_p1_hosts(options.p1_host)
+    except ValueError as e:
+        die("FATAL| {}".format(e))
 
     if p1_hosts == {} and p1_serial == {}:
         ap.print_usage()
         die("FATAL| no valid p1-host or serial inputs defined")
 
+    if options.workers < 1:
+        die("FATAL| the number of workers must be at least 1")
+    if options.workers > 1:
+        # the workers connect the inputs, only check the hosts here
+        for host, port in p1_hosts.keys():
+            try:
+                socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)
+            except socket.gaierror:
+                die("FATAL| dsmr host not resolvable: {}:{}".format(host, port))
+            except ValueError:
+                die("FATAL| dsmr host port is not valid: {}:{}".format(host, port))
+        de.supervisor = WorkerSupervisor(de, list(p1_serial), list(p1_hosts), options.workers, logger,
+                                         queue_size=options.queue_size)
+
     # connect serial input
-    for serial_port in p1_serial.keys():
+    for serial_port in p1_serial.keys() if de.supervisor is None else ():
         try:
             de.connect_serial_input(serial_port)
         except serial.serialutil.SerialException as e:
@@ -445,57 +3576,166 @@ def main():
             die("FATAL | {}".format(e))
 
     # connect input tcp host
-    for host, port in p1_hosts.keys():
+    for host, port in p1_hosts.keys() if de.supervisor is None else ():
         try:
             de.connect_tcp_input(host, port)
         except socket.gaierror:
             die("FATAL| dsmr host not resolvable: {}:{}".format(host, port))
-        except TimeoutError:
-            die("FATAL| timeout for input host {}:{}".format(host, port))
         except Exception as e:
             die("FATAL| error while connecting input host {}:{}.\nERROR| {}".format(host, port, e))
 
-    # elastic output
-    # todo regex parse hostname with capture group to make it more robust
-    # todo: elastic connect faster detect faults
-    if type(options.elastic_host) is type([]):
-        options.elastic_host = options.elastic_host[0]
-    if ':' in options.elastic_host:
-        elastic_host, elastic_port = options.elastic_host.split(':')
-    else:
-        elastic_host = options.elastic_host
-        elastic_port = 9200
-
-    try:
-        de.connect_elastic_output(elastic_host, elastic_port)
-        logger.debug("DEBUG| elastic output ready")
-    except ValueError:
-        die("FATAL| elastic port '{}' is not a valid port".format(elastic_port))
-    except socket.gaierror:
-        die("FATAL| elasticsearch hostname '{}' not resolvable".format(elastic_host))
-    except elasticsearch.exceptions.ConnectionError:
-        die("FATAL| elasticsearch not reachable")
-
+    if options.elastic_interval < 1:
+        die("FATAL| elastic interval must be at least 1 second")
+    if options.elastic_batch_size < 1 or options.elastic_backlog_size < options.elastic_batch_size:
+        die("FATAL| elastic backlog size must be at least the batch size (minimal 1)")
     de.elastic_index = options.elastic_index
+    de.elastic_template = not options.elastic_no_template
+    de.elastic_synthetic_source = bool(options.elastic_synthetic_source)
+    if options.elastic_rollover:
+        de.elastic_rollover = True
+        de.elastic_index = options.elastic_index.split('%', 1)[0].rstrip('-_.') or 'dsmr'
+        if options.elastic_retention is not None and int(options.elastic_retention) < 1:
+            die("FATAL| elastic retention must be at least 1 day")
+        de.elastic_retention = options.elastic_retention and int(options.elastic_retention)
+    elif options.elastic_retention is not None:
+        die("FATAL| --elastic-retention needs --elastic-rollover")
+    de.elastic_interval = options.elastic_interval
+    de.elastic_batch_size = options.elastic_batch_size
+    de.elastic_backlog_size = options.elastic_backlog_size
+    de.elastic_backlog_policy = options.elastic_backlog_policy
+    if options.spool_dir:
+        if options.spool_size < 1:
+            die("FATAL| spool size must be at least 1 MB")
+        de.spool_dir = options.spool_dir
+        de.spool_size = options.spool_size * 1024 * 1024
+    if options.queue_size < 1:
+        die("FATAL| queue size must be at least 1")
+    de.queue_size = options.queue_size
+    if options.capture_dir:
+        if options.capture_interval < 1:
+            die("FATAL| capture interval must be at least 1 second")
+        try:
+            os.makedirs(options.capture_dir, exist_ok=True)
+        except OSError as e:
+            die("FATAL| can not create capture directory: {}".format(e))
+        de.capture_dir = options.capture_dir
+        de.capture_interval = options.capture_interval
+        logger.info("- capturing raw telegrams in '{}'".format(options.capture_dir))
+    if options.profile is not None:
+        if int(options.profile) < 1:
+            die("FATAL| profile interval must be at least 1 second")
+        de.profile_interval = int(options.profile)
+        de.profile_sampling = bool(options.profile_sampling)
+    if options.derived:
+        de.derived_metrics = True
+    if options.aggregate:
+        de.aggregator = TelegramAggregator(options.elastic_interval)
 
     serial_ports_string = ", ".join(map(str, p1_serial.keys()))
     hosts = ", ".join(["{}:{}".format(host, port) for host, port in p1_hosts.keys()])
 
     logger.info("- serial inputs are: '{}'".format(serial_ports_string))
     logger.info("- tcp inputs are:    '{}'".format(hosts))
-    logger.info("- output host:       '{}' on port:{}, with user:'{}' and index pattern:'{}'".format(elastic_host,
-                                                                                                     elastic_port,
-                                                                                                     options.elastic_user,
-                                                                                                     options.elastic_index))
+
+    # elastic output
+    if 'elasticsearch' in outputs:
+        # todo regex parse hostname with capture group to make it more robust
+        # todo: elastic connect faster detect faults
+        if type(options.elastic_host) is type([]):
+            options.elastic_host = options.elastic_host[0]
+        if ':' in options.elastic_host:
+            elastic_host, elastic_port = options.elastic_host.split(':')
+        else:
+            elastic_host = options.elastic_host
+            elastic_port = 9200
+        try:
+            de.connect_elastic_output(elastic_host, elastic_port)
+            logger.debug("DEBUG| elastic output ready")
+        except ImportError as e:
+            die("FATAL| {}".format(e))
+        except ValueError:
+            die("FATAL| elastic port '{}' is not a valid port".format(elastic_port))
+        except socket.gaierror:
+            die("FATAL| elasticsearch hostname '{}' not resolvable".format(elastic_host))
+        except OSError as e:
+            die("FATAL| can not open spool: {}".format(e))
+        logger.info("- output host:       '{}' on port:{}, with user:'{}' and index pattern:'{}'".format(
+            elastic_host, elastic_port, options.elastic_user, de.elastic_index))
+
+    # influxdb output
+    if 'influxdb' in outputs:
+        if not options.influx_url:
+            die("FATAL| the influxdb output needs --influx-url")
+        try:
+            de.add_output(InfluxLineSink(options.influx_url, logger, token=options.influx_token,
+                                         batch_size=options.elastic_batch_size, interval=options.elastic_interval,
+                                         backlog_size=options.elastic_backlog_size,
+                                         overflow_policy=options.elastic_backlog_policy,
+                                         queue_size=options.queue_size, spool=de.open_spool(InfluxLineSink.name)))
+        except OSError as e:
+            die("FATAL| can not open spool: {}".format(e))
+        logger.info("- influxdb output:   '{}'".format(options.influx_url))
+
+    # mqtt output
+    if 'mqtt' in outputs:
+        mqtt_host, _, mqtt_port = options.mqtt_host.partition(':')
+        try:
+            de.add_output(MqttSink(mqtt_host, int(mqtt_port or 1883), logger, topic=options.mqtt_topic,
+                                   queue_size=options.queue_size))
+        except (ImportError, ValueError) as e:
+            die("FATAL| mqtt output: {}".format(e))
+        logger.info("- mqtt output:       '{}' with topic '{}'".format(options.mqtt_host, options.mqtt_topic))
+
+    # file output
+    if 'file' in outputs:
+        if not options.output_file:
+            die("FATAL| the file output needs --output-file")
+        try:
+            de.add_output(FileSink(options.output_file, logger, queue_size=options.queue_size))
+        except OSError as e:
+            die("FATAL| can not open output file: {}".format(e))
+        logger.info("- file output:       '{}'".format(options.output_file))
+
+    if options.prometheus_port is not None:
+        de.prometheus = PrometheusSink(logger, queue_size=options.queue_size)
+        try:
+            de.prometheus.listen(options.prometheus_port)
+        except OSError as e:
+            die("FATAL| can not listen on prometheus port {}: {}".format(options.prometheus_port, e))
+        de.add_output(de.prometheus)
+        logger.info("- prometheus metrics on port {}".format(options.prometheus_port))
+
+    if options.store_port is not None:
+        if options.store_size < 1:
+            die("FATAL| --store-size must be at least 1")
+        store = RecentStore(logger, size=options.store_size, queue_size=options.queue_size)
+        try:
+            store.listen(options.store_port)
+        except OSError as e:
+            die("FATAL| can not listen on store port {}: {}".format(options.store_port, e))
+        de.add_output(store)
+        logger.info("- in-memory store:   {} samples per meter, queries on port {}".format(options.store_size,
+                                                                                         options.store_port))
+
+    if config is not None:
+        de.config = config
+        de.config_reload = functools.partial(reload_config, de, ap, defaults, parsed_options, logger)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, de.request_reload)
+        logger.info("- config file:       '{}', reloaded on change or SIGHUP".format(config.path))
+
     # main loop
+    # systemctl stop and docker stop send SIGTERM: stop the same way as on ctrl-c, so the capture file is complete
+    # and the outputs send what they hold
+    signal.signal(signal.SIGTERM, de.request_stop)
+    if de.supervisor is not None:
+        de.supervisor.start()
     try:
         de.run()
-    except elasticsearch.exceptions.RequestError as e:
-        # RequestError(400, 'mapper_parsing_exception', 'Could not dynamically add mapping for field [host.name]. Existing mapping for [host] must be of type object but found [text].')
-        die("FATAL ERROR| {}".format(e))
+        logger.info("stopping {} on SIGTERM".format(appname))
     except KeyboardInterrupt:
-        de.stop()
         logger.info("stopping {} by user request".format(appname))
+    de.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,525 @@
+#!/usr/bin/env python3
+"""
+p1 simulator and benchmark for dsmr_exporter
+
+  dsmr_simulator.py tcp --meters 5 --port 8000     serve telegrams on tcp ports 8000-8004, like esp8266 bridges
+  dsmr_simulator.py pty --meters 2                 serve telegrams on pseudo terminals, use them with --p1-serial
+  dsmr_simulator.py elastic --port 9200            stub elasticsearch (_bulk) and influxdb (write) endpoint
+  dsmr_simulator.py bench --meters 50              run the exporter against simulated meters and report numbers
+"""
+import argparse
+import datetime
+import http.server
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import socket
+import sys
+import threading
+import time
+import tty
+
+import dsmr_exporter
+
+
+class SimulatedMeter:
+    """ a meter with increasing registers, renders dsmr 4 or 5 telegrams with a valid crc """
+    headers = {4: "/KFM5KAIFA-METER", 5: "/ISK5\\2M550T-1012"}
+    versions = {4: "42", 5: "50"}
+
+    def __init__(self, number, version=5):
+        if version not in self.headers:
+            raise ValueError("not a supported dsmr version: {}".format(version))
+        self.number = number
+        self.version = version
+        self.identifier = "E00{:013d}".format(number).encode().hex().upper()
+        self.gas_identifier = "G00{:013d}".format(number).encode().hex().upper()
+        self.delivered = [1000.0 + number, 2000.0 + number]
+        self.returned = [10.0, 20.0]
+        self.gas = 500.0 + number
+        self.power_failures = 0
+        self.last_update = time.time()
+        self.sent = 0
+
+    @staticmethod
+    def timestamp(now):
+        return now.strftime("%y%m%d%H%M%S") + ("S" if time.localtime(now.timestamp()).tm_isdst > 0 else "W")
+
+    def update(self, now):
+        """ advance the registers with a random load since the previous telegram """
+        elapsed = max(now - self.last_update, 0)
+        self.last_update = now
+        self.power = random.uniform(0.1, 4.0)
+        self.solar = random.uniform(0.0, 2.0) if 8 <= time.localtime(now).tm_hour < 18 else 0.0
+        tariff = 0 if time.localtime(now).tm_hour < 7 or time.localtime(now).tm_hour >= 23 else 1
+        self.tariff = tariff + 1
+        self.delivered[tariff] += self.power * elapsed / 3600
+        self.returned[tariff] += self.solar * elapsed / 3600
+        self.gas += random.uniform(0.0, 0.3) * elapsed / 3600
+
+    def telegram(self, now=None):
+        if now is None:
+            now = time.time()
+        self.update(now)
+        stamp = self.timestamp(datetime.datetime.fromtimestamp(now))
+        phase_power = [self.power / 3] * 3
+        voltages = [random.uniform(225.0, 235.0) for _ in range(3)]
+        lines = [
+            self.headers[self.version],
+            "",
+            "1-3:0.2.8({})".format(self.versions[self.version]),
+            "0-0:1.0.0({})".format(stamp),
+            "0-0:96.1.1({})".format(self.identifier),
+            "1-0:1.8.1({:010.3f}*kWh)".format(self.delivered[0]),
+            "1-0:1.8.2({:010.3f}*kWh)".format(self.delivered[1]),
+            "1-0:2.8.1({:010.3f}*kWh)".format(self.returned[0]),
+            "1-0:2.8.2({:010.3f}*kWh)".format(self.returned[1]),
+            "0-0:96.14.0({:04d})".format(self.tariff),
+            "1-0:1.7.0({:06.3f}*kW)".format(self.power),
+            "1-0:2.7.0({:06.3f}*kW)".format(self.solar),
+            "0-0:96.7.21({:05d})".format(self.power_failures),
+            "0-0:96.7.9({:05d})".format(0),
+            "1-0:99.97.0(1)(0-0:96.7.19)(101208152415W)(0000000240*s)",
+            "1-0:32.32.0(00000)",
+            "1-0:32.36.0(00000)",
+            "0-0:96.13.0()",
+        ]
+        for index, group in enumerate((32, 52, 72)):
+            lines.append("1-0:{}.7.0({:05.1f}*V)".format(group, voltages[index]))
+        for index, group in enumerate((31, 51, 71)):
+            lines.append("1-0:{}.7.0({:03d}*A)".format(group, int(phase_power[index] * 1000 / voltages[index])))
+        for index, group in enumerate((21, 41, 61)):
+            lines.append("1-0:{}.7.0({:06.3f}*kW)".format(group, phase_power[index]))
+        for group in (22, 42, 62):
+            lines.append("1-0:{}.7.0({:06.3f}*kW)".format(group, self.solar / 3))
+        lines += [
+            "0-1:24.1.0(003)",
+            "0-1:96.1.0({})".format(self.gas_identifier),
+            "0-1:24.2.1({})({:09.3f}*m3)".format(stamp, self.gas),
+        ]
+        body = ("\r\n".join(lines) + "\r\n!").encode()
+        self.sent += 1
+        return body + "{:04X}\r\n".format(dsmr_exporter.crc16(body)).encode()
+
+
+def fragments(data, fragment):
+    """ split data in random chunks of at most fragment bytes, no splitting when fragment is 0 """
+    if not fragment:
+        return [data]
+    chunks = []
+    offset = 0
+    while offset < len(data):
+        size = random.randint(1, fragment)
+        chunks.append(data[offset:offset + size])
+        offset += size
+    return chunks
+
+
+def send_telegrams(meter, write, interval, fragment=0, fragment_delay=0.0, stop=None):
+    """ write a telegram every interval seconds until stop is set or write raises OSError """
+    next_telegram = time.monotonic()
+    while stop is None or not stop.is_set():
+        for chunk in fragments(meter.telegram(), fragment):
+            write(chunk)
+            if fragment_delay:
+                time.sleep(fragment_delay)
+        next_telegram += interval
+        delay = next_telegram - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_telegram = time.monotonic()
+
+
+class TcpSimulator:
+    """ one listening tcp port per meter, every client gets a telegram stream """
+
+    def __init__(self, meters, address="127.0.0.1", port=0, interval=1, fragment=0, fragment_delay=0.0,
+                 logger=None):
+        self.meters = meters
+        self.interval = interval
+        self.fragment = fragment
+        self.fragment_delay = fragment_delay
+        self.logger = logger or logging.getLogger("dsmr_simulator")
+        self.stop_event = threading.Event()
+        self.listeners = []
+        for index, meter in enumerate(meters):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((address, port + index if port else 0))
+            listener.listen(4)
+            self.listeners.append((listener, meter))
+
+    @property
+    def ports(self):
+        return [listener.getsockname()[1] for listener, _ in self.listeners]
+
+    def start(self):
+        for listener, meter in self.listeners:
+            threading.Thread(target=self.accept_loop, args=(listener, meter), daemon=True).start()
+
+    def accept_loop(self, listener, meter):
+        while not self.stop_event.is_set():
+            try:
+                client, address = listener.accept()
+            except OSError:
+                return
+            self.logger.debug("DEBUG| meter {} client {} connected".format(meter.number, address))
+            threading.Thread(target=self.client_loop, args=(client, meter), daemon=True).start()
+
+    def client_loop(self, client, meter):
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            send_telegrams(meter, client.sendall, self.interval, self.fragment, self.fragment_delay, self.stop_event)
+        except OSError:
+            pass
+        finally:
+            client.close()
+
+    def stop(self):
+        self.stop_event.set()
+        for listener, _ in self.listeners:
+            listener.close()
+
+
+class PtySimulator:
+    """ one pseudo terminal pair per meter, the slave device stands in for a p1 serial port """
+
+    def __init__(self, meters, interval=1, fragment=0, fragment_delay=0.0):
+        self.meters = meters
+        self.interval = interval
+        self.fragment = fragment
+        self.fragment_delay = fragment_delay
+        self.stop_event = threading.Event()
+        self.terminals = []
+        for meter in meters:
+            master, slave = os.openpty()
+            tty.setraw(slave)
+            self.terminals.append((master, slave, meter))
+
+    @property
+    def devices(self):
+        return [os.ttyname(slave) for _, slave, _ in self.terminals]
+
+    def start(self):
+        for master, _, meter in self.terminals:
+            threading.Thread(target=self.write_loop, args=(master, meter), daemon=True).start()
+
+    def write_loop(self, master, meter):
+        def write(data):
+            view = memoryview(data)
+            while view:
+                view = view[os.write(master, view):]
+
+        try:
+            send_telegrams(meter, write, self.interval, self.fragment, self.fragment_delay, self.stop_event)
+        except OSError:
+            pass
+
+    def stop(self):
+        self.stop_event.set()
+        for master, slave, _ in self.terminals:
+            os.close(master)
+            os.close(slave)
+
+
+class StubStats:
+    """ documents and requests seen by the stub endpoint, with the delay between @timestamp and arrival """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+        self.documents = 0
+        self.latencies = []
+
+    def add(self, documents, latencies):
+        with self.lock:
+            self.requests += 1
+            self.documents += documents
+            self.latencies.extend(latencies)
+
+    def snapshot(self):
+        with self.lock:
+            return {"requests": self.requests, "rejected": self.rejected, "documents": self.documents,
+                    "latencies": list(self.latencies)}
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    """ accepts elasticsearch _bulk and influxdb write requests without storing anything """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("X-Elastic-Product", "Elasticsearch")
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_HEAD(self):
+        self.reply(200)
+
+    def do_GET(self):
+        if self.path == "/":
+            self.reply(200, {"name": "dsmr-simulator", "cluster_name": "stub", "tagline": "You Know, for Search",
+                             "version": {"number": "7.17.0", "build_flavor": "default"}})
+        else:
+            self.reply(200, {})
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        stats = self.server.stats
+        if self.server.reject_rate and random.random() < self.server.reject_rate:
+            with stats.lock:
+                stats.rejected += 1
+            self.reply(503, {"error": "stub rejected the request", "status": 503})
+            return
+        now = time.time()
+        path = self.path.partition("?")[0]
+        if path.endswith("/_bulk"):
+            documents = [json.loads(line) for line in body.splitlines()[1::2]]
+            latencies = [now - datetime.datetime.fromisoformat(doc["@timestamp"]).timestamp()
+                         for doc in documents if "@timestamp" in doc]
+            stats.add(len(documents), latencies)
+            self.reply(200, {"took": 1, "errors": False,
+                             "items": [{"index": {"status": 201}} for _ in documents]})
+        elif path.endswith("/write"):
+            lines = [line for line in body.decode().splitlines() if line]
+            latencies = [now - int(line.rsplit(" ", 1)[1]) / 1e9 for line in lines if line.count(" ") >= 2]
+            stats.add(len(lines), latencies)
+            self.reply(204)
+        else:
+            self.reply(200, {"acknowledged": True})
+
+
+def stub_server(address="127.0.0.1", port=0, reject_rate=0.0):
+    server = http.server.ThreadingHTTPServer((address, port), StubHandler)
+    server.daemon_threads = True
+    server.stats = StubStats()
+    server.reject_rate = reject_rate
+    return server
+
+
+def percentiles(samples, points=(50, 90, 99)):
+    """ returns {point: value} for the given percentiles, and the maximum """
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    result = {point: samples[min(len(samples) - 1, int(len(samples) * point / 100))] for point in points}
+    result["max"] = samples[-1]
+    return result
+
+
+def rss_bytes():
+    """ current resident memory of this process """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peer_process(connection, meters, version, interval, fragment, fragment_delay, reject_rate):
+    """ runs the simulated meters and the stub endpoint in a separate process, so they don't share the gil """
+    simulator = TcpSimulator([SimulatedMeter(number, version) for number in range(meters)], interval=interval,
+                             fragment=fragment, fragment_delay=fragment_delay)
+    server = stub_server(reject_rate=reject_rate)
+    simulator.start()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection.send((simulator.ports, server.server_address[1]))
+    connection.recv()
+    simulator.stop()
+    stats = server.stats.snapshot()
+    stats["telegrams"] = sum(meter.sent for meter in simulator.meters)
+    connection.send(stats)
+    server.shutdown()
+
+
+def benchmark(meters=10, duration=30, interval=1, version=5, fragment=0, fragment_delay=0.0, output="influxdb",
+              batch_size=500, flush_interval=1, queue_size=1000, reject_rate=0.0, logger=None):
+    """ run the exporter against simulated tcp meters and a stub endpoint, returns the measurements """
+    logger = logger or logging.getLogger("dsmr_simulator")
+    connection, peer_connection = multiprocessing.Pipe()
+    peer = multiprocessing.Process(target=peer_process, daemon=True,
+                                   args=(peer_connection, meters, version, interval, fragment, fragment_delay,
+                                         reject_rate))
+    peer.start()
+    ports, stub_port = connection.recv()
+
+    de = dsmr_exporter.DsmrExporter()
+    de.set_logger(logger)
+    de.queue_size = queue_size
+    de.elastic_interval = flush_interval
+    de.elastic_batch_size = batch_size
+    de.elastic_index = "dsmr-bench-%Y.%m"
+    if output == "elasticsearch":
+        de.connect_elastic_output("127.0.0.1", stub_port)
+    else:
+        de.add_output(dsmr_exporter.InfluxLineSink("http://127.0.0.1:{}/write?db=dsmr".format(stub_port), logger,
+                                                   batch_size=batch_size, interval=flush_interval,
+                                                   queue_size=queue_size))
+    for port in ports:
+        de.connect_tcp_input("127.0.0.1", port)
+
+    # per telegram and per request timings, wrapped around the exporter stages
+    parse_samples = []
+    request_samples = []
+    parse_telegram = de.parse_telegram
+
+    def timed_parse(labels, raw_telegram, received=None):
+        start = time.perf_counter()
+        doc = parse_telegram(labels, raw_telegram, received)
+        parse_samples.append(time.perf_counter() - start)
+        return doc
+    de.parse_telegram = timed_parse
+
+    for sink in de.outputs:
+        def timed_send(batch, send=sink.send):
+            start = time.perf_counter()
+            try:
+                return send(batch)
+            finally:
+                request_samples.append(time.perf_counter() - start)
+        sink.send = timed_send
+
+    rss_start = rss_bytes()
+    rss_peak = [rss_start]
+
+    def sample_memory():
+        rss_peak[0] = max(rss_peak[0], rss_bytes())
+        de.call_later(1, sample_memory)
+
+    de.call_later(1, sample_memory)
+    de.call_later(duration, de.stop_loop)
+    start = time.monotonic()
+    de.run()
+    # drain the pipeline while the stub endpoint is still up
+    de.stop()
+    connection.send("stop")
+    peer_stats = connection.recv()
+    elapsed = time.monotonic() - start
+    peer.join(5)
+    input_stats = de.input_stats().values()
+    return {
+        "meters": meters,
+        "duration": elapsed,
+        "telegrams_sent": peer_stats["telegrams"],
+        "telegrams_accepted": sum(stats["accepted"] for stats in input_stats),
+        "crc_failed": sum(stats["crc_failed"] for stats in input_stats),
+        "telegrams_parsed": de.parsed_telegrams,
+        "telegrams_dropped": de.dropped_telegrams,
+        "telegrams_per_second": de.parsed_telegrams / elapsed,
+        "documents_stored": peer_stats["documents"],
+        "requests": peer_stats["requests"],
+        "requests_rejected": peer_stats["rejected"],
+        "latency": {
+            "parse": percentiles(parse_samples),
+            "output_request": percentiles(request_samples),
+            "end_to_end": percentiles(peer_stats["latencies"]),
+        },
+        "rss_start": rss_start,
+        "rss_peak": max(rss_peak[0], rss_bytes()),
+    }
+
+
+def print_report(result, out=sys.stdout):
+    out.write("meters:     {meters}, {duration:.1f}s\n".format(**result))
+    out.write("telegrams:  sent {telegrams_sent}, accepted {telegrams_accepted}, crc failed {crc_failed}, "
+              "parsed {telegrams_parsed}, dropped {telegrams_dropped}, {telegrams_per_second:.1f}/s\n".format(**result))
+    out.write("documents:  stored {documents_stored} in {requests} requests, {requests_rejected} rejected\n".format(
+        **result))
+    out.write("{:<16}{:>10}{:>10}{:>10}{:>10}\n".format("latency ms", "p50", "p90", "p99", "max"))
+    for stage, values in result["latency"].items():
+        out.write("{:<16}{}\n".format(stage, "".join("{:>10.3f}".format(values.get(point, 0) * 1000)
+                                                      for point in (50, 90, 99, "max"))))
+    out.write("memory:     rss {:.1f} MB at start, {:.1f} MB peak\n".format(result["rss_start"] / 1048576,
+                                                                          result["rss_peak"] / 1048576))
+
+
+def wait_forever(simulator):
+    try:
+        while 1:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+def main():
+    logger = logging.getLogger("dsmr_simulator")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    ap = argparse.ArgumentParser(description='dsmr p1 simulator and dsmr_exporter benchmark')
+    commands = ap.add_subparsers(dest='command', required=True)
+    for command in ("tcp", "pty", "bench"):
+        p = commands.add_parser(command)
+        p.add_argument('--meters', type=int, default=1, help="number of simulated meters")
+        p.add_argument('--dsmr-version', type=int, choices=(4, 5), default=5, help="dsmr version of the telegrams")
+        p.add_argument('--interval', type=float, default=1,
+                       help="seconds between telegrams per meter, dsmr 5 meters send every second, dsmr 4 every 10")
+        p.add_argument('--fragment', type=int, default=0,
+                       help="split telegrams in random chunks of at most this many bytes")
+        p.add_argument('--fragment-delay', type=float, default=0.0, help="seconds between the chunks of a telegram")
+        if command == "tcp":
+            p.add_argument('--address', default="0.0.0.0", help="listen address")
+            p.add_argument('--port', type=int, default=8000, help="port of the first meter, one port per meter")
+        if command == "bench":
+            p.add_argument('--duration', type=float, default=30, help="seconds to run")
+            p.add_argument('--output', choices=("elasticsearch", "influxdb"), default="influxdb",
+                           help="exporter output sending to the stub endpoint")
+            p.add_argument('--batch-size', type=int, default=500, help="documents per output request")
+            p.add_argument('--flush-interval', type=float, default=1, help="seconds between output requests")
+            p.add_argument('--queue-size', type=int, default=1000, help="exporter queue size")
+            p.add_argument('--reject-rate', type=float, default=0.0,
+                           help="fraction of output requests the stub answers with 503")
+            p.add_argument('--json', action='store_true', help="print the results as json")
+    p = commands.add_parser("elastic")
+    p.add_argument('--address', default="0.0.0.0", help="listen address")
+    p.add_argument('--port', type=int, default=9200, help="listen port")
+    p.add_argument('--reject-rate', type=float, default=0.0, help="fraction of requests answered with 503")
+    options = ap.parse_args()
+
+    if options.command == "elastic":
+        server = stub_server(options.address, options.port, options.reject_rate)
+        logger.info("- stub elasticsearch and influxdb endpoint on {}:{}".format(*server.server_address))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("documents received: {documents} in {requests} requests".format(**server.stats.snapshot()))
+        return
+
+    if options.command == "bench":
+        result = benchmark(options.meters, options.duration, options.interval, options.dsmr_version,
+                           options.fragment, options.fragment_delay, options.output, options.batch_size,
+                           options.flush_interval, options.queue_size, options.reject_rate, logger)
+        if options.json:
+            print(json.dumps(result, indent=2))
+        else:
+            print_report(result)
+        return
+
+    meters = [SimulatedMeter(number, options.dsmr_version) for number in range(options.meters)]
+    if options.command == "tcp":
+        simulator = TcpSimulator(meters, options.address, options.port, options.interval, options.fragment,
+                                 options.fragment_delay, logger)
+        logger.info("- meters on {} ports {}".format(options.address, ", ".join(map(str, simulator.ports))))
+    else:
+        simulator = PtySimulator(meters, options.interval, options.fragment, options.fragment_delay)
+        logger.info("- meters on {}".format(", ".join(simulator.devices)))
+    simulator.start()
+    wait_forever(simulator)
+
+
+if __name__ == "__main__":
+    main()
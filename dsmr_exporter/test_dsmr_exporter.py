@@ -0,0 +1,660 @@
+"""
+tests of the framer, the obis line parser, the disk spool, the outputs, aggregation, derived fields, config
+precedence, stall detection, capture files and the index mapping
+
+run from the repository root with: python -m pytest -q
+"""
+import argparse
+import datetime
+import gzip
+import logging
+import os
+import queue
+import threading
+
+import pytest
+
+import dsmr_exporter
+import dsmr_simulator
+
+
+logger = logging.getLogger("test")
+
+
+def telegrams(count=3, version=5):
+    meter = dsmr_simulator.SimulatedMeter(1, version=version)
+    return [meter.telegram(1700000000.0 + second) for second in range(count)]
+
+
+def utc(second):
+    return datetime.datetime.fromtimestamp(1700000000 + second, datetime.timezone.utc)
+
+
+def verified(framer, data_chunks):
+    return [telegram for data in data_chunks for telegram in framer.feed(data) if framer.verify(telegram)]
+
+
+# framer and crc
+
+def test_framer_one_telegram_per_read():
+    sent = telegrams()
+    framer = dsmr_exporter.TelegramFramer()
+    assert verified(framer, sent) == sent
+    assert framer.stats() == {"accepted": 3, "crc_failed": 0, "truncated": 0}
+
+
+@pytest.mark.parametrize("size", [1, 7, 64, 1000])
+def test_framer_split_reads(size):
+    sent = telegrams()
+    data = b"".join(sent)
+    framer = dsmr_exporter.TelegramFramer()
+    assert verified(framer, [data[i:i + size] for i in range(0, len(data), size)]) == sent
+    assert framer.stats()["accepted"] == 3
+
+
+def test_framer_merged_reads_and_garbage():
+    sent = telegrams()
+    framer = dsmr_exporter.TelegramFramer()
+    # noise before the first header is skipped, several telegrams in one read are all returned
+    assert verified(framer, [b"\x00noise\r\n" + b"".join(sent)]) == sent
+
+
+def test_framer_truncated_telegram():
+    first, second = telegrams(2)
+    framer = dsmr_exporter.TelegramFramer()
+    # the meter restarts in the middle of a telegram, the next header starts over
+    assert verified(framer, [first[:len(first) // 2], second]) == [second]
+    assert framer.stats()["truncated"] == 1
+
+
+def test_framer_crc_accept_and_reject():
+    telegram = telegrams(1)[0]
+    end = telegram.rindex(b"!")
+    assert int(telegram[end + 1:].strip(), 16) == dsmr_exporter.crc16(telegram[:end + 1])
+    framer = dsmr_exporter.TelegramFramer()
+    assert framer.verify(telegram)
+    corrupted = telegram.replace(b"1-0:1.8.1(0", b"1-0:1.8.1(9", 1)
+    assert corrupted != telegram
+    assert not framer.verify(corrupted)
+    wrong_crc = "{:04X}".format(dsmr_exporter.crc16(telegram[:end + 1]) ^ 1).encode()
+    assert not framer.verify(telegram[:end + 1] + wrong_crc + b"\r\n")
+    assert not framer.verify(telegram[:end + 1] + b"XYZW\r\n")
+    assert framer.stats() == {"accepted": 1, "crc_failed": 3, "truncated": 0}
+
+
+def test_framer_dsmr4_and_bare_trailer():
+    telegram = telegrams(1, version=4)[0]
+    framer = dsmr_exporter.TelegramFramer()
+    assert verified(framer, [telegram]) == [telegram]
+    # dsmr 2.2 and 3 have no crc after the '!'
+    assert framer.verify(b"/ISK5MT382-1000\r\n\r\n1-0:1.8.1(00001.001*kWh)\r\n!\r\n")
+
+
+# obis line parser
+
+def exporter():
+    de = dsmr_exporter.DsmrExporter()
+    de.set_logger(logger)
+    return de
+
+
+def test_obis_line_values():
+    de = exporter()
+    raw_telegram = telegrams(1)[0]
+    doc = de.parse_telegram({"serial.port": "/dev/ttyUSB0"}, raw_telegram, 1700000000.0)
+    assert doc["serial.port"] == "/dev/ttyUSB0"
+    assert doc["@timestamp"] == utc(0)
+    assert doc["1-3:0.2.8"] == "50"
+    # the simulator writes the local time
+    assert doc["0-0:1.0.0"].replace(tzinfo=None) == datetime.datetime.fromtimestamp(1700000000)
+    power = raw_telegram.split(b"1-0:1.7.0(", 1)[1].split(b"*", 1)[0]
+    assert doc["1-0:1.7.0"] == float(power)
+    assert doc["0-0:96.7.21"] == 0
+    assert doc["0-1:24.2.1"] == 501.0
+    assert doc["0-1:24.2.1_timestamp"] == doc["0-0:1.0.0"]
+    # the power failure log stays a string, the decoded events are a field of their own
+    assert doc["1-0:99.97.0"] == "1)(0-0:96.7.19)(101208152415W)(0000000240*s"
+    assert [event["duration"] for event in doc["1-0:99.97.0_events"]] == [240]
+
+
+def test_obis_line_not_valid():
+    de = exporter()
+    doc = de.telegram_to_json(["1-0:1.7.0(abc*kW)", "1-0:2.7.0(01.5*kW", "no-obis(1)", "1-0:99.1.0(12.5*kW)",
+                               "1-0:99.2.0(x)(on)", "0-0:1.0.0(231114221320X)", "1-0:1.8.1(000010.5*kWh)"], 0)
+    # unknown codes are kept, the last group as number or string
+    assert {key: value for key, value in doc.items() if key != "@timestamp"} == {
+        "1-0:99.1.0": 12.5, "1-0:99.2.0": "on", "1-0:1.8.1": 10.5}
+
+
+def test_obis_line_cache_keeps_repeating_codes():
+    de = exporter()
+    de.obis_cache_trial_size = 10
+    raw_telegrams = telegrams(30)
+    docs = [de.parse_telegram({}, raw_telegram, 0) for raw_telegram in raw_telegrams]
+    assert "0-0:96.1.1" in de.obis_cached_codes
+    assert "0-0:1.0.0" not in de.obis_cached_codes
+    # the simulated gas reading has the telegram time, it never repeats
+    assert "0-1:24.2.1" not in de.obis_cached_codes
+    assert not any(line.startswith("0-1:24.2.1(") for line in de.obis_line_cache)
+    uncached = exporter()
+    uncached.obis_cached_codes = set()
+    assert [uncached.parse_telegram({}, raw_telegram, 0) for raw_telegram in raw_telegrams] == docs
+
+
+# disk spool
+
+def test_spool_read_ack_rewind(tmp_path):
+    spool = dsmr_exporter.DiskSpool(str(tmp_path))
+    for number in range(5):
+        spool.append({"n": number})
+    assert len(spool) == 5
+    assert spool.read(2) == [{"n": 0}, {"n": 1}]
+    spool.rewind()
+    assert spool.read(2) == [{"n": 0}, {"n": 1}]
+    spool.ack()
+    assert len(spool) == 3
+    assert spool.read(10) == [{"n": 2}, {"n": 3}, {"n": 4}]
+    spool.rewind()
+    spool.close()
+
+
+def test_spool_continues_after_restart(tmp_path):
+    spool = dsmr_exporter.DiskSpool(str(tmp_path), segment_size=40)
+    for number in range(10):
+        spool.append({"n": number})
+    spool.read(4)
+    spool.ack()
+    # read but not acknowledged when the exporter stops
+    spool.read(3)
+    spool.close()
+
+    spool = dsmr_exporter.DiskSpool(str(tmp_path), segment_size=40)
+    assert len(spool) == 6
+    spool.append({"n": 10})
+    assert [entry["n"] for entry in spool.read(100)] == [4, 5, 6, 7, 8, 9, 10]
+    spool.ack()
+    assert len(spool) == 0
+    # the completely sent segments are removed
+    assert spool.segments[0] == spool.read_segment
+    spool.close()
+
+
+def test_spool_drops_oldest_segment_when_full(tmp_path):
+    spool = dsmr_exporter.DiskSpool(str(tmp_path), segment_size=40, max_size=100)
+    for number in range(20):
+        spool.append({"n": number})
+    assert spool.dropped > 0
+    assert len(spool) == 20 - spool.dropped
+    assert [entry["n"] for entry in spool.read(100)][-1] == 19
+    spool.close()
+
+
+# batching output
+
+class FlakySink(dsmr_exporter.BatchingSink):
+    name = "flaky"
+
+    def __init__(self, failures=0, reject=(), **kwargs):
+        super().__init__(logger, **kwargs)
+        self.failures = failures
+        self.reject = set(reject)
+        self.batches = []
+
+    def send(self, batch):
+        if self.failures:
+            self.failures -= 1
+            raise dsmr_exporter.OutputError("connection refused")
+        self.batches.append(batch)
+        rejected = [entry for entry in batch if entry["n"] in self.reject]
+        self.reject.clear()
+        return rejected
+
+
+def test_batching_retry_backoff(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dsmr_exporter.time, "monotonic", lambda: now[0])
+    sink = FlakySink(failures=3, batch_size=2, max_retry_delay=3)
+    for number in range(3):
+        sink.add({"n": number})
+    delays = []
+    while sink.failures:
+        assert sink.flush_due()
+        sink.flush()
+        delays.append(sink.retry_delay)
+        # nothing is sent before the backoff passed
+        now[0] += sink.retry_delay - 0.5
+        assert not sink.flush_due()
+        now[0] += 0.5
+    assert delays == [1, 2, 3]
+    assert sink.retries == 3
+    sink.flush_if_due()
+    now[0] += sink.interval
+    sink.flush_if_due()
+    # the failed batch went back in front of the backlog, in order
+    assert sink.batches == [[{"n": 0}, {"n": 1}], [{"n": 2}]]
+    assert (sink.retry_delay, sink.retry_at) == (0, 0)
+
+
+def test_batching_due_by_enqueue_time(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dsmr_exporter.time, "monotonic", lambda: now[0])
+    for spool in (None, dsmr_exporter.DiskSpool(str(tmp_path))):
+        now[0] = 1000.0
+        sink = FlakySink(batch_size=2, interval=5, spool=spool)
+        for number in range(3):
+            sink.add({"n": number})
+        # the writer was busy, the document left after a full batch is due interval seconds after it was enqueued
+        now[0] = 1003.0
+        sink.flush_if_due()
+        assert sink.batches == [[{"n": 0}, {"n": 1}]]
+        now[0] = 1005.0
+        assert sink.flush_due()
+        sink.flush()
+        # a document after an idle period waits for more, it isn't sent alone right away
+        now[0] = 1100.0
+        sink.add({"n": 3})
+        assert not sink.flush_due(now=1104.9)
+        assert sink.flush_due(now=1105.0)
+        sink.close()
+
+    documents = queue.Queue()
+    forward = dsmr_exporter.ForwardSink(documents, 1, logger, batch_size=10, interval=0.2)
+    now[0] = 2000.0
+    forward.add({"n": 0})
+    now[0] = 2000.1
+    forward.flush_if_due()
+    assert documents.empty()
+    now[0] = 2000.2
+    forward.flush_if_due()
+    assert documents.get_nowait() == ("documents", 1, [{"n": 0}])
+
+
+def test_batching_rejected_documents_and_overflow(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dsmr_exporter.time, "monotonic", lambda: now[0])
+    sink = FlakySink(reject=[1], batch_size=3, backlog_size=3)
+    for number in range(4):
+        sink.add({"n": number})
+    # drop-oldest
+    assert sink.dropped == 1
+    sink.flush()
+    assert sink.batches == [[{"n": 1}, {"n": 2}, {"n": 3}]]
+    assert list(sink.backlog) == [{"n": 1}]
+    assert sink.retry_delay == 1
+    now[0] += 1
+    sink.flush_if_due()
+    assert sink.batches[-1] == [{"n": 1}]
+    with pytest.raises(ValueError):
+        FlakySink(overflow_policy="drop-all")
+
+
+def test_batching_spool_retry(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(dsmr_exporter.time, "monotonic", lambda: now[0])
+    sink = FlakySink(failures=1, batch_size=2, spool=dsmr_exporter.DiskSpool(str(tmp_path)))
+    for number in range(3):
+        sink.add({"n": number})
+    sink.flush()
+    assert sink.backlog_size() == 3
+    now[0] += sink.retry_delay
+    sink.flush_if_due()
+    now[0] += sink.interval
+    sink.flush_if_due()
+    assert sink.batches == [[{"n": 0}, {"n": 1}], [{"n": 2}]]
+    assert sink.backlog_size() == 0
+    sink.close()
+
+
+# prometheus and the recent values store
+
+def test_prometheus_one_family_per_name():
+    sink = dsmr_exporter.PrometheusSink(logger)
+    sink.add({"serial.port": "/dev/ttyUSB0", "0-1:24.2.1": 501.0, "1-0:1.7.0": 3.307, "0-0:96.1.1": "4530"})
+    # a belgian meter, its gas reading has the same metric name
+    sink.add({"host.name": "meter", "host.port": 2000, "0-1:24.2.3": 12.5})
+    sink.set_internal_metrics("# internal")
+    lines = sink.render().decode().split("\n")
+    name = "dsmr_mbus_1_meter_reading_m3_total"
+    assert lines.count("# TYPE {} counter".format(name)) == 1
+    assert "# HELP {} 0-1:24.2.1/0-1:24.2.3 mbus.1.meter_reading".format(name) in lines
+    start = lines.index("# TYPE {} counter".format(name))
+    assert sorted(lines[start + 1:start + 3]) == [
+        '{}{{host_name="meter",host_port="2000"}} 12.5'.format(name),
+        '{}{{serial_port="/dev/ttyUSB0"}} 501.0'.format(name)]
+    assert 'dsmr_electricity_power_to_client_total_kw{serial_port="/dev/ttyUSB0"} 3.307' in lines
+    assert lines[-1] == "# internal"
+    # a new telegram replaces all samples of its meter
+    sink.add({"serial.port": "/dev/ttyUSB0", "1-0:1.7.0": 1.0})
+    output = sink.render().decode()
+    assert '{}{{serial_port="/dev/ttyUSB0"}}'.format(name) not in output
+    assert 'dsmr_electricity_power_to_client_total_kw{serial_port="/dev/ttyUSB0"} 1.0' in output
+
+
+def test_recent_store_query():
+    store = dsmr_exporter.RecentStore(logger, size=4)
+    for second in range(6):
+        store.add({"@timestamp": utc(second), "serial.port": "a", "1-0:1.7.0": float(second),
+                   "0-0:96.1.1": "4530"})
+    store.add({"@timestamp": utc(6), "serial.port": "a", "1-0:2.7.0": 1.0})
+    # the ring buffer keeps the last 4 samples, a field missing in a telegram has no point there
+    start, end = 1700000000, 1700000010
+    assert store.describe() == {"a": {"fields": ["1-0:1.7.0", "1-0:2.7.0"], "samples": 4,
+                                      "start": start + 3, "end": start + 6}}
+    assert store.query("a", ["1-0:1.7.0"], start, end)["fields"] == {
+        "1-0:1.7.0": [[start + 3, 3.0], [start + 4, 4.0], [start + 5, 5.0]]}
+    assert store.query("a", ["1-0:1.7.0"], start, start + 4)["fields"]["1-0:1.7.0"] == [[start + 3, 3.0],
+                                                                                       [start + 4, 4.0]]
+    assert store.query("a", ["1-0:1.7.0"], start, end, step=2, aggregate="max")["fields"]["1-0:1.7.0"] == [
+        [start + 2, 3.0], [start + 4, 5.0]]
+    assert store.query("a", ["1-0:1.7.0"], start, end, step=10)["fields"]["1-0:1.7.0"] == [[start, 4.0]]
+    status, body = store.handle_request("/query?meter=a&field=1-0:2.7.0&start={}&end={}".format(start, end))
+    assert (status, body["fields"]) == (200, {"1-0:2.7.0": [[start + 6, 1.0]]})
+    assert store.handle_request("/query?meter=b")[0] == 404
+    assert store.handle_request("/query?field=1-0:1.7.0")[0] == 400
+    assert store.handle_request("/query?meter=a&aggregate=median")[0] == 400
+    assert store.handle_request("/query?meter=a&step=0")[0] == 400
+    assert store.handle_request("/metrics")[0] == 404
+
+
+# aggregation and derived fields
+
+def test_aggregator_windows():
+    aggregator = dsmr_exporter.TelegramAggregator(10)
+    finished = []
+    for second, power in ((0, 1.0), (4, 2.0), (9, 3.0), (10, 5.0)):
+        finished += aggregator.add({"@timestamp": utc(second), "serial.port": "/dev/ttyUSB0", "1-0:1.7.0": power,
+                                    "1-0:1.8.1": 100.0 + second, "derived.energy.to_client": 0.5})
+    # 1700000000 is a multiple of 10, the telegram at +10 closes the first window
+    assert len(finished) == 1
+    doc = finished[0]
+    assert doc["@timestamp"] == utc(0)
+    assert doc["aggregate.count"] == 3
+    assert doc["aggregate.window"] == 10
+    assert doc["1-0:1.7.0"] == pytest.approx(2.0)
+    assert (doc["1-0:1.7.0_min"], doc["1-0:1.7.0_max"]) == (1.0, 3.0)
+    assert doc["1-0:1.8.1"] == 109.0
+    assert doc["derived.energy.to_client"] == 1.5
+    assert aggregator.flush_expired(now=1700000025) == []
+    assert [doc["aggregate.count"] for doc in aggregator.flush_expired(now=1700000030)] == [1]
+    assert aggregator.flush_all() == []
+
+
+def test_aggregated_document_id_differs_from_raw():
+    raw = {"@timestamp": utc(3), "serial.port": "a", "0-0:96.1.1": "M",
+           "0-0:1.0.0": utc(3).astimezone(dsmr_exporter.DSMR_TIMEZONES['W'])}
+    aggregator = dsmr_exporter.TelegramAggregator(10)
+    aggregator.add(dict(raw))
+    aggregated = aggregator.flush_all()[0]
+    assert dsmr_exporter.document_id(aggregated) != dsmr_exporter.document_id(raw)
+
+
+def meter_doc(second, delivered, gas=500.0):
+    meter_time = utc(second).astimezone(dsmr_exporter.DSMR_TIMEZONES['W'])
+    return {"@timestamp": utc(second), "serial.port": "/dev/ttyUSB0", "0-0:1.0.0": meter_time,
+            "1-0:1.8.1": delivered, "1-0:1.8.2": 10.0, "0-1:24.2.1": gas}
+
+
+def test_derived_deltas_and_counter_reset():
+    derived = dsmr_exporter.DerivedMetrics(logger)
+    first = derived.add(meter_doc(0, 100.0))
+    assert "derived.interval" not in first
+    second = derived.add(meter_doc(10, 100.5, 500.1))
+    assert second["derived.interval"] == 10
+    assert second["derived.energy.to_client"] == pytest.approx(0.5)
+    assert second["derived.mbus.1.delta"] == pytest.approx(0.1)
+    # a replaced meter: no delta for the register that went down, the next telegram continues from it
+    reset = derived.add(meter_doc(20, 1.0, 500.1))
+    assert derived.resets == 1
+    assert reset["derived.energy.to_client"] == 0
+    after = derived.add(meter_doc(30, 1.25, 500.1))
+    assert after["derived.energy.to_client"] == pytest.approx(0.25)
+    assert after["derived.today.to_client.total"] == pytest.approx(0.75)
+
+
+def test_derived_meter_time_not_advancing():
+    derived = dsmr_exporter.DerivedMetrics(logger)
+    derived.add(meter_doc(0, 100.0))
+    assert "derived.interval" not in derived.add(meter_doc(0, 100.0))
+
+
+# config precedence
+
+def config_parser():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--p1-host', action='append', default=[None])
+    ap.add_argument('--p1-serial', action='append', default=[None])
+    ap.add_argument('--elastic-interval', type=int, default=5)
+    ap.add_argument('--elastic-batch-size', type=int, default=500)
+    ap.add_argument('--elastic-backlog-size', type=int, default=100000)
+    ap.add_argument('--elastic-backlog-policy', default='drop-oldest')
+    ap.add_argument('--aggregate', action='store_true')
+    ap.add_argument('--config')
+    return ap
+
+
+def config_options(tmp_path, text, args):
+    path = tmp_path / "dsmr.ini"
+    path.write_text("[dsmr_exporter]\n" + text)
+    ap = config_parser()
+    defaults = dsmr_exporter.parser_defaults(ap)
+    return dsmr_exporter.parse_options(ap, dict(defaults, **dsmr_exporter.ConfigFile.defaults(
+        ap, dsmr_exporter.ConfigFile(str(path)).read())), args)
+
+
+def test_config_file_values(tmp_path):
+    options = config_options(tmp_path, "p1-host = a:1,b:2\nelastic-interval = 10\naggregate = yes\n", [])
+    assert dsmr_exporter.parse_p1_hosts(options.p1_host) == {("a", 1): None, ("b", 2): None}
+    assert options.elastic_interval == 10
+    assert options.aggregate is True
+
+
+def test_command_line_overrides_config_file(tmp_path):
+    options = config_options(tmp_path, "p1-host = a:1,b:2\nelastic-interval = 10\n",
+                             ["--p1-host", "c:3", "--p1-host", "d:4", "--elastic-interval", "20"])
+    assert dsmr_exporter.parse_p1_hosts(options.p1_host) == {("c", 3): None, ("d", 4): None}
+    assert options.elastic_interval == 20
+
+
+def test_config_reload_reverts_removed_options(tmp_path):
+    ap = config_parser()
+    defaults = dsmr_exporter.parser_defaults(ap)
+    config = dsmr_exporter.ConfigFile(str(tmp_path / "dsmr.ini"))
+    (tmp_path / "dsmr.ini").write_text("[dsmr_exporter]\np1-host = a:1\nelastic-interval = 10\n")
+    dsmr_exporter.parse_options(ap, dict(defaults, **dsmr_exporter.ConfigFile.defaults(ap, config.read())), [])
+    (tmp_path / "dsmr.ini").write_text("[dsmr_exporter]\n")
+    options = dsmr_exporter.parse_options(ap, dict(defaults, **dsmr_exporter.ConfigFile.defaults(
+        ap, config.read())), [])
+    assert options.p1_host == [None]
+    assert options.elastic_interval == 5
+
+
+def test_config_file_unknown_option(tmp_path):
+    with pytest.raises(ValueError):
+        config_options(tmp_path, "p1-hosts = a:1\n", [])
+
+
+@pytest.mark.parametrize("hosts", ["a", "a:1:2", "a:1830O", "a:0", "a:65536"])
+def test_p1_host_not_valid(hosts):
+    with pytest.raises(ValueError):
+        dsmr_exporter.parse_p1_hosts([hosts])
+
+
+def test_bad_reload_keeps_running_inputs(tmp_path):
+    ap = config_parser()
+    defaults = dsmr_exporter.parser_defaults(ap)
+    path = tmp_path / "dsmr.ini"
+    path.write_text("[dsmr_exporter]\np1-host = 127.0.0.1:18300\n")
+    options = dsmr_exporter.parse_options(ap, dict(defaults, **dsmr_exporter.ConfigFile.defaults(
+        ap, dsmr_exporter.ConfigFile(str(path)).read())), [])
+    de = dsmr_exporter.DsmrExporter()
+    de.set_logger(logger)
+    de.config = dsmr_exporter.ConfigFile(str(path))
+    de.connect_tcp_input("127.0.0.1", 18300)
+    try:
+        path.write_text("[dsmr_exporter]\np1-host = 127.0.0.1:18300,127.0.0.1:1830O\nelastic-interval = 9\n")
+        dsmr_exporter.reload_config(de, ap, defaults, options, logger, [])
+        assert list(de.tcp_inputs) == [("127.0.0.1", 18300)]
+        assert de.resolving == {}
+        assert de.elastic_interval == 1
+
+        path.write_text("[dsmr_exporter]\np1-host = 127.0.0.1:18301\n")
+        dsmr_exporter.reload_config(de, ap, defaults, options, logger, [])
+        # the new input is resolved in a thread, the removed one is closed right away
+        assert list(de.tcp_inputs) == []
+        assert list(de.resolving) == [("127.0.0.1", 18301)]
+        de.resolving[("127.0.0.1", 18301)].result(10)
+        de.finish_add_tcp_input("127.0.0.1", 18301, de.resolving[("127.0.0.1", 18301)])
+        assert list(de.tcp_inputs) == [("127.0.0.1", 18301)]
+    finally:
+        de.stop()
+
+
+# rate limited warnings
+
+def test_warning_limiter(caplog):
+    warnings = dsmr_exporter.WarningLimiter(logger, interval=60)
+    with caplog.at_level(logging.WARNING, logger="test"):
+        for _ in range(5):
+            warnings.warning("crc", "WARNING| crc error for input %s", "a")
+        warnings.warning("queue", "WARNING| parse queue full")
+        warnings.next_time["crc"] = 0
+        warnings.warning("crc", "WARNING| crc error for input %s", "a")
+    assert caplog.messages == ["WARNING| crc error for input a", "WARNING| parse queue full",
+                               "WARNING| crc error for input a, 4 more since the previous warning"]
+
+
+# stall detection
+
+def test_stall_wheel():
+    wheel = dsmr_exporter.StallWheel()
+    wheel.tick = 100
+    first = dsmr_exporter.P1Source("a", {})
+    second = dsmr_exporter.P1Source("b", {})
+    wheel.schedule(first, 102.5)
+    # a deadline that passed already comes up at the next check
+    wheel.schedule(second, 50)
+    assert (first.stall_tick, second.stall_tick) == (103, 101)
+    assert wheel.expired(100.9) == []
+    assert wheel.expired(101.9) == [second]
+    assert second.stall_tick is None
+    # data arrived, the deadline moves
+    wheel.schedule(first, 105)
+    assert wheel.expired(104) == []
+    assert wheel.expired(107) == [first]
+    wheel.schedule(second, 108)
+    wheel.remove(second)
+    assert wheel.expired(110) == []
+    assert wheel.slots == {}
+
+
+# worker processes
+
+def test_worker_restart_gets_new_queue():
+    supervisor = dsmr_exporter.WorkerSupervisor(exporter(), [], [("meter", 2000)], 1, logger)
+    supervisor.stats_interval = 0.05
+    documents = supervisor.queues[0] = supervisor.context.Queue()
+    reader = threading.Thread(target=supervisor.read_worker, args=(0, documents), daemon=True)
+    reader.start()
+    documents.put(("stats", 0, {"parsed": 1}))
+    assert supervisor.received.get(timeout=5) == ("stats", 0, {"parsed": 1})
+    # a killed worker can leave its queue locked, the restarted worker gets a new one and the old reader ends
+    supervisor.queues[0] = supervisor.context.Queue()
+    reader.join(5)
+    assert not reader.is_alive()
+
+
+# capture and import
+
+def read_capture_file(path):
+    framer = dsmr_exporter.TelegramFramer()
+    with open(path, 'rb') as f:
+        return [(received, labels, raw_telegram)
+                for received, labels, data in dsmr_exporter.read_capture(dsmr_exporter.gzip_chunks(f, 100))
+                for raw_telegram in framer.feed(data)]
+
+
+def import_settings(**settings):
+    return dict({"logger_name": "test", "log_level": logging.WARNING, "dry_run": True, "input_name": None,
+                 "batch_size": 100, "elastic_host": None, "elastic_index": None}, **settings)
+
+
+def test_capture_write_and_read(tmp_path):
+    sent = telegrams(5)
+    capture = dsmr_exporter.TelegramCapture(str(tmp_path), interval=3600)
+    for second, raw_telegram in enumerate(sent):
+        capture.write(1700000000.0 + second, {"serial.port": "/dev/ttyUSB0"}, raw_telegram)
+    capture.close()
+    assert capture.path == str(tmp_path / "p1-20231114T220000Z.gz")
+    assert read_capture_file(capture.path) == [(1700000000.0 + second, {"serial.port": "/dev/ttyUSB0"}, raw_telegram)
+                                               for second, raw_telegram in enumerate(sent)]
+    path, result = dsmr_exporter.import_file(capture.path, import_settings())
+    assert result["parsed"] == 5
+
+
+def test_capture_restart_never_appends(tmp_path):
+    first, second = telegrams(2)
+    capture = dsmr_exporter.TelegramCapture(str(tmp_path))
+    capture.write(1700000000.0, {}, first)
+    capture.close()
+    # a restart in the same interval
+    capture = dsmr_exporter.TelegramCapture(str(tmp_path))
+    capture.write(1700000005.0, {}, second)
+    capture.close()
+    paths = sorted(str(path) for path in tmp_path.iterdir())
+    assert [os.path.basename(path) for path in paths] == ["p1-20231114T220000Z.gz", "p1-20231114T221325Z.gz"]
+    assert [raw_telegram for path in paths for _, _, raw_telegram in read_capture_file(path)] == [first, second]
+    assert dsmr_exporter.import_groups(paths) == [paths]
+
+
+def test_capture_truncated_file(tmp_path, caplog):
+    sent = telegrams(20)
+    capture = dsmr_exporter.TelegramCapture(str(tmp_path), flush_interval=0)
+    for second, raw_telegram in enumerate(sent):
+        capture.write(1700000000.0 + second, {}, raw_telegram)
+        if second == 9:
+            # the exporter is killed, the file ends after the last flush
+            killed = (tmp_path / os.path.basename(capture.path)).read_bytes()
+    capture.close()
+    path = tmp_path / "p1-killed-20231114T220000Z.gz"
+    path.write_bytes(killed)
+    with pytest.raises(EOFError):
+        read_capture_file(str(path))
+    with caplog.at_level(logging.WARNING, logger="test"):
+        _, result = dsmr_exporter.import_file(str(path), import_settings())
+    assert result["parsed"] == 10
+    assert "read until error" in caplog.text
+    # a file cut in the middle of a telegram
+    path.write_bytes(killed[:len(killed) - 20])
+    _, result = dsmr_exporter.import_file(str(path), import_settings())
+    assert 0 < result["parsed"] < 10
+
+
+def test_capture_gzip_members_and_padding(tmp_path):
+    sent = telegrams(2)
+    path = tmp_path / "p1.gz"
+    path.write_bytes(gzip.compress(sent[0]) + b"\0" * 8 + gzip.compress(sent[1]))
+    with open(path, 'rb') as f:
+        assert b"".join(dsmr_exporter.gzip_chunks(f, 7)) == b"".join(sent)
+
+
+def test_import_groups(tmp_path):
+    names = ["p1-20231114T230000Z.gz", "p1-20231114T220000Z.gz", "p1-worker1-20231114T220000Z.gz", "a.log", "b.log"]
+    for size, name in enumerate(names):
+        (tmp_path / name).write_bytes(b"x" * (size + 1))
+    paths = [str(tmp_path / name) for name in names]
+    # largest group first, the files of a group in time order
+    assert dsmr_exporter.import_groups(paths) == [[paths[4]], [paths[3]], [paths[1], paths[0]], [paths[2]]]
+    assert dsmr_exporter.import_groups(paths, input_name="meter") == [
+        [paths[3], paths[4]], [paths[1], paths[0]], [paths[2]]]
+
+
+# elasticsearch mapping
+
+def test_mapping_has_no_path_conflicts():
+    properties = dsmr_exporter.elastic_mappings()["properties"]
+    assert dsmr_exporter.mapping_path_conflicts(properties) == []
+    assert "derived.today.to_client.total" in properties
+
+
+def test_mapping_path_conflicts():
+    assert dsmr_exporter.mapping_path_conflicts(["a.b", "a.b.c", "a.bc", "d"]) == ["a.b"]